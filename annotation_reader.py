@@ -0,0 +1,135 @@
+import argparse
+import collections
+import os
+import time
+from typing import Collection, Dict, Iterator, List, NamedTuple, Optional, Union
+
+import numpy
+from lxml import etree
+
+from mask_codec import decode_mask
+
+NODE_TAGS = ("Node", "CropObject")
+OPTIONAL_FIELDS = frozenset(["mask", "links", "data"])
+
+
+class NodeRecord(NamedTuple):
+    """ One node of an annotation file. The id, class name and bounding box are always read,
+    fields that were not requested from ``iterate_nodes`` are None. """
+    id: int
+    class_name: str
+    top: int
+    left: int
+    width: int
+    height: int
+    mask: Optional[numpy.ndarray] = None
+    inlinks: Optional[List[int]] = None
+    outlinks: Optional[List[int]] = None
+    data: Optional[Dict[str, Union[str, int, float, list]]] = None
+
+
+def parse_links(links_text: Optional[str]) -> List[int]:
+    if not links_text:
+        return []
+    return list(map(int, links_text.split()))
+
+
+def parse_data_item(value_type: str, value: Optional[str]) -> Union[str, int, float, list]:
+    """ Converts the text of a ``<DataItem>`` according to its type, like ``mung.io.read_nodes_from_file`` does """
+    if value_type == 'int':
+        return int(value)
+    if value_type == 'float':
+        return float(value)
+    if value_type.startswith('list'):
+        if value is None:
+            return []
+        value_factory = str
+        if value_type.endswith('[int]'):
+            value_factory = int
+        elif value_type.endswith('[float]'):
+            value_factory = float
+        return list(map(value_factory, value.split()))
+    return value
+
+
+def read_root_attributes(path: str) -> Dict[str, str]:
+    """ Returns the attributes of the root element, e.g., ``dataset`` and ``document``, without reading the nodes """
+    for _, element in etree.iterparse(path, events=("start",)):
+        return dict(element.attrib)
+    return {}
+
+
+def iterate_nodes(path: str, fields: Collection[str] = OPTIONAL_FIELDS) -> Iterator[NodeRecord]:
+    """ Reads the nodes of an annotation file one at a time. Every node element is discarded as soon as
+    it has been read, so the memory needed does not grow with the size of the file.
+
+    :param fields: The optional fields that should be read, any of ``mask``, ``links`` and ``data``.
+        Leaving out ``mask`` avoids decoding the masks, which is the most expensive part of reading a file.
+    """
+    unknown_fields = set(fields) - OPTIONAL_FIELDS
+    if unknown_fields:
+        raise ValueError("Unknown fields {0}, expected any of {1}".format(sorted(unknown_fields),
+                                                                          sorted(OPTIONAL_FIELDS)))
+    read_mask, read_links, read_data = "mask" in fields, "links" in fields, "data" in fields
+    skipped_tags = set()
+    if not read_mask:
+        skipped_tags.add("Mask")
+    if not read_links:
+        skipped_tags.update(("Inlinks", "Outlinks"))
+    if not read_data:
+        skipped_tags.add("Data")
+
+    for _, node in etree.iterparse(path, events=("end",), tag=NODE_TAGS):
+        # A single pass over the children, that does not even touch the text of skipped fields
+        texts = {}
+        data = None
+        for child in node:
+            tag = child.tag
+            if tag in skipped_tags:
+                continue
+            if tag == "Data":
+                data = child
+            else:
+                texts[tag] = child.text
+
+        height, width = int(texts["Height"]), int(texts["Width"])
+        record = NodeRecord(id=int(float(texts["Id"])), class_name=texts.get("ClassName", texts.get("MLClassName")),
+                            top=int(texts["Top"]), left=int(texts["Left"]), width=width, height=height)
+        if read_mask and texts.get("Mask") is not None:
+            record = record._replace(mask=decode_mask(texts["Mask"], (height, width)))
+        if read_links:
+            record = record._replace(inlinks=parse_links(texts.get("Inlinks")),
+                                     outlinks=parse_links(texts.get("Outlinks")))
+        if data is not None:
+            record = record._replace(data={item.get("key"): parse_data_item(item.get("type"), item.text)
+                                           for item in data.iterfind("DataItem")})
+
+        # Free the node and everything that was read before it
+        node.clear()
+        while node.getprevious() is not None:
+            del node.getparent()[0]
+        yield record
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Counts the classes of all nodes in the annotation files '
+                                                 'with the streaming reader')
+    parser.add_argument('--source_directory', type=str, default="v2.0",
+                        help='Directory of the MUSCIMA++ dataset v2.0 or newer')
+    parser.add_argument('--fields', type=str, nargs="*", default=[],
+                        help='Optional fields that should be read as well, e.g., mask links data')
+
+    flags = parser.parse_args()
+
+    annotations_directory = os.path.join(flags.source_directory, "data/annotations")
+    class_counts = collections.Counter()
+    start = time.perf_counter()
+    for annotation_file in sorted(os.listdir(annotations_directory)):
+        if annotation_file.endswith(".xml"):
+            class_counts.update(record.class_name for record in
+                                iterate_nodes(os.path.join(annotations_directory, annotation_file), flags.fields))
+    duration = time.perf_counter() - start
+
+    for class_name, count in class_counts.most_common():
+        print("{0:<30} {1:>7}".format(class_name, count))
+    print("Read {0} nodes in {1:.2f} s".format(sum(class_counts.values()), duration))
@@ -0,0 +1,54 @@
+import argparse
+import os
+import time
+from typing import List, Tuple
+from xml.etree.ElementTree import parse
+
+from mung.node import Node
+
+from mask_codec import decode_masks, encode_masks
+
+
+def read_masks(annotations_directory: str, number_of_files: int) -> Tuple[List[str], List[Tuple[int, int]]]:
+    mask_strings, shapes = [], []
+    annotation_files = sorted(f for f in os.listdir(annotations_directory) if f.endswith(".xml"))
+    for annotation_file in annotation_files[:number_of_files]:
+        for node in parse(os.path.join(annotations_directory, annotation_file)).getroot():
+            mask_strings.append(node.findtext("Mask"))
+            shapes.append((int(node.findtext("Height")), int(node.findtext("Width"))))
+    return mask_strings, shapes
+
+
+def measure(description: str, function, number_of_masks: int) -> float:
+    start = time.perf_counter()
+    function()
+    duration = time.perf_counter() - start
+    print("{0:<45} {1:>10.0f} masks/sec".format(description, number_of_masks / duration))
+    return duration
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compares the throughput of the batch mask codec with decoding '
+                                                 'and encoding masks one by one through mung')
+    parser.add_argument('--source_directory', type=str, default="v2.0",
+                        help='Directory of the MUSCIMA++ dataset v2.0 or newer')
+    parser.add_argument('--files', type=int, default=10, help='Number of annotation files to read masks from')
+
+    flags = parser.parse_args()
+
+    mask_strings, shapes = read_masks(os.path.join(flags.source_directory, "data/annotations"), flags.files)
+    print("Measuring {0} masks with {1} pixels".format(len(mask_strings), sum(h * w for h, w in shapes)))
+
+    text_decoding = measure("Decoding with Node.decode_mask", lambda: [Node.decode_mask(m, shape=s)
+                                                                     for m, s in zip(mask_strings, shapes)],
+                            len(mask_strings))
+    batch_decoding = measure("Decoding with mask_codec.decode_masks", lambda: decode_masks(mask_strings, shapes),
+                             len(mask_strings))
+    masks = decode_masks(mask_strings, shapes)
+    text_encoding = measure("Encoding with Node.encode_mask_rle", lambda: [Node.encode_mask_rle(m) for m in masks],
+                            len(mask_strings))
+    batch_encoding = measure("Encoding with mask_codec.encode_masks", lambda: encode_masks(masks),
+                             len(mask_strings))
+
+    print("Decoding speedup: {0:.1f}x, encoding speedup: {1:.1f}x".format(text_decoding / batch_decoding,
+                                                                        text_encoding / batch_encoding))
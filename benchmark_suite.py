@@ -0,0 +1,348 @@
+import argparse
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+from xml.etree.ElementTree import parse
+
+import numpy
+
+from annotation_reader import iterate_nodes
+from benchmark_upgrade import best_time, best_upgrade_time
+from mask_codec import decode_masks, encode_masks
+from upgrade_rules import load_script
+from xml_writer import write_pretty_element_tree
+
+RESULTS_FORMAT_VERSION = 1
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+upgrade_to_v2_0 = load_script(os.path.join(SCRIPT_DIRECTORY, "upgrade_v1.0_to_v2.0.py"))
+upgrade_to_v2_1 = load_script(os.path.join(SCRIPT_DIRECTORY, "upgrade_v2.0_to_v2.1.py"))
+upgrade_to_v2_1_directly = load_script(os.path.join(SCRIPT_DIRECTORY, "upgrade_v1.0_to_v2.1.py"))
+
+# Small stages barely touch the memory, so their peak RSS may differ by a few pages between runs
+MEMORY_SLACK_BYTES = 8 * 1024 * 1024
+
+
+class Measurement(NamedTuple):
+    document: str
+    nodes: int
+    bytes: int
+    seconds: float
+    peak_rss_bytes: int
+    rss_increase_bytes: int
+
+
+def peak_rss_bytes() -> int:
+    """ The peak resident set size of this process so far """
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+def measure_in_child(connection, function: Callable, arguments: tuple) -> None:
+    # Like timeit, the garbage collector is disabled, so its pauses do not distort the measured times
+    gc.disable()
+    rss_before = peak_rss_bytes()
+    try:
+        seconds, nodes = function(*arguments)
+    except Exception as exception:
+        connection.send((None, "{0}: {1}".format(type(exception).__name__, exception)))
+        return
+    connection.send(((seconds, nodes, peak_rss_bytes(), peak_rss_bytes() - rss_before), None))
+
+
+def run_isolated(function: Callable, *arguments) -> Tuple[float, int, int, int]:
+    """ Runs a benchmark in a new process, so its peak RSS is not raised by the benchmarks that ran before.
+    The benchmark returns its duration and the number of nodes it processed.
+
+    :returns: The duration, the number of nodes, the peak RSS of the process and how much the benchmark
+        increased it over the RSS the process started with.
+    """
+    start_methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("fork" if "fork" in start_methods else "spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=measure_in_child, args=(sender, function, arguments))
+    process.start()
+    sender.close()
+    try:
+        result, error = receiver.recv()
+    except EOFError:
+        result, error = None, "Benchmark process exited with code {0}".format(process.exitcode)
+    process.join()
+    if error is not None:
+        raise RuntimeError(error)
+    return result
+
+
+def benchmark_parse_v1_0(path: str, repetitions: int, scratch_directory: str) -> Tuple[float, int]:
+    seconds = best_time(lambda: upgrade_to_v2_0.parse(path), repetitions)
+    return seconds, len(parse(path).findall("*/CropObject"))
+
+
+def benchmark_read_crop_objects(path: str, repetitions: int, scratch_directory: str) -> Tuple[float, int]:
+    tree = upgrade_to_v2_0.parse(path)
+    seconds = best_time(lambda: upgrade_to_v2_0.read_crop_objects(tree), repetitions)
+    return seconds, len(tree.findall("*/CropObject"))
+
+
+def benchmark_upgrade_v1_0_to_v2_0(path: str, repetitions: int, scratch_directory: str) -> Tuple[float, int]:
+    return best_upgrade_time(upgrade_to_v2_0, path, repetitions), len(parse(path).findall("*/CropObject"))
+
+
+def benchmark_write_v2_0(path: str, repetitions: int, scratch_directory: str) -> Tuple[float, int]:
+    tree = upgrade_to_v2_0.parse(path)
+    document = os.path.splitext(os.path.basename(path))[0]
+    nodes = upgrade_to_v2_0.upgrade_xml_file(tree, upgrade_to_v2_0.read_crop_objects(tree), "MUSCIMA-pp_2.0",
+                                             document).getroot()
+    output_path = os.path.join(scratch_directory, document + ".xml")
+    return best_time(lambda: write_pretty_element_tree(output_path, nodes), repetitions), len(nodes)
+
+
+def benchmark_parse_v2_0(path: str, repetitions: int, scratch_directory: str) -> Tuple[float, int]:
+    """ Reads the nodes with their links and data, but without decoding their masks """
+    seconds = best_time(lambda: list(iterate_nodes(path, fields=("links", "data"))), repetitions)
+    return seconds, len(parse(path).getroot())
+
+
+def benchmark_decode_masks(path: str, repetitions: int, scratch_directory: str) -> Tuple[float, int]:
+    root = parse(path).getroot()
+    mask_strings = [node.findtext("Mask") for node in root]
+    shapes = [(int(node.findtext("Height")), int(node.findtext("Width"))) for node in root]
+    return best_time(lambda: decode_masks(mask_strings, shapes), repetitions), len(root)
+
+
+def benchmark_upgrade_v2_0_to_v2_1(path: str, repetitions: int, scratch_directory: str) -> Tuple[float, int]:
+    nodes = upgrade_to_v2_1.read_nodes(path)
+    return best_time(lambda: upgrade_to_v2_1.upgrade_xml_file(nodes), repetitions), len(nodes)
+
+
+def benchmark_encode_masks(path: str, repetitions: int, scratch_directory: str) -> Tuple[float, int]:
+    nodes = upgrade_to_v2_1.read_nodes(path)
+    return best_time(lambda: encode_masks([node.mask for node in nodes]), repetitions), len(nodes)
+
+
+def benchmark_write_v2_1(path: str, repetitions: int, scratch_directory: str) -> Tuple[float, int]:
+    document = os.path.splitext(os.path.basename(path))[0]
+    nodes = upgrade_to_v2_1.upgrade_xml_file(upgrade_to_v2_1.read_nodes(path))
+    mask_strings = encode_masks([node.mask for node in nodes])
+    output_path = os.path.join(scratch_directory, document + ".xml")
+    seconds = best_time(lambda: upgrade_to_v2_1.write_nodes_to_pretty_xml_file(
+        nodes, output_path, document, "MUSCIMA-pp_2.1", mask_strings), repetitions)
+    return seconds, len(nodes)
+
+
+def count_nodes(paths: List[str]) -> int:
+    return sum(len(list(iterate_nodes(path, fields=()))) for path in paths)
+
+
+def benchmark_convert_corpus(converter: str, paths: List[str], scratch_directory: str) -> Tuple[float, int]:
+    """ Converts the files one after another in this process, like the upgrade scripts do with a single worker """
+    start = time.perf_counter()
+    for path in paths:
+        output_path = os.path.join(scratch_directory, os.path.basename(path))
+        if converter == "v1.0_to_v2.0":
+            upgrade_to_v2_0.convert_annotation_file(path, output_path, "MUSCIMA-pp_2.0")
+        elif converter == "v2.0_to_v2.1":
+            upgrade_to_v2_1.convert_annotation_file(path, output_path, os.path.splitext(os.path.basename(path))[0])
+        else:
+            upgrade_to_v2_1_directly.convert_annotation_file(path, output_path, "MUSCIMA-pp_2.1")
+    return time.perf_counter() - start, count_nodes(paths)
+
+
+# Benchmarks of a single file, grouped by the version of the files they read
+FILE_BENCHMARKS = {"v1.0": [("parse_v1.0", benchmark_parse_v1_0),
+                            ("read_crop_objects", benchmark_read_crop_objects),
+                            ("upgrade_xml_file_v1.0_to_v2.0", benchmark_upgrade_v1_0_to_v2_0),
+                            ("write_v2.0", benchmark_write_v2_0)],
+                   "v2.0": [("parse_v2.0", benchmark_parse_v2_0),
+                            ("decode_masks", benchmark_decode_masks),
+                            ("upgrade_xml_file_v2.0_to_v2.1", benchmark_upgrade_v2_0_to_v2_1),
+                            ("encode_masks", benchmark_encode_masks),
+                            ("write_v2.1", benchmark_write_v2_1)],
+                   }
+CORPUS_BENCHMARKS = [("convert_corpus_v1.0_to_v2.0", "v1.0_to_v2.0", "v1.0"),
+                     ("convert_corpus_v2.0_to_v2.1", "v2.0_to_v2.1", "v2.0"),
+                     ("convert_corpus_v1.0_to_v2.1", "v1.0_to_v2.1", "v1.0")]
+
+
+def summarize(measurements: List[Measurement]) -> Dict:
+    """ Sums up the measurements of a benchmark. The memory per node is the slope of the increase of the RSS
+    over the number of nodes, if the benchmark was measured on files of different sizes. """
+    seconds = sum(m.seconds for m in measurements)
+    nodes = sum(m.nodes for m in measurements)
+    size = sum(m.bytes for m in measurements)
+    node_counts = numpy.array([m.nodes for m in measurements], dtype=numpy.float64)
+    rss_bytes_per_node = None
+    if len(set(node_counts.tolist())) > 1:
+        rss_bytes_per_node = float(numpy.polyfit(node_counts, [m.rss_increase_bytes for m in measurements], 1)[0])
+    return {"seconds": seconds,
+            "nodes": nodes,
+            "bytes": size,
+            "nodes_per_second": nodes / seconds if seconds > 0 else None,
+            "megabytes_per_second": size / (1024 * 1024) / seconds if seconds > 0 else None,
+            "peak_rss_bytes": max(m.peak_rss_bytes for m in measurements),
+            "rss_increase_bytes": max(m.rss_increase_bytes for m in measurements),
+            "rss_bytes_per_node": rss_bytes_per_node,
+            "files": [m._asdict() for m in measurements],
+            }
+
+
+def run_benchmarks(paths: Dict[str, List[str]], corpus_paths: Dict[str, List[str]], repetitions: int) -> Dict:
+    """ Runs every file benchmark on every file of its version and every corpus conversion once
+
+    :param paths: The files to measure for each version, ``v1.0`` and ``v2.0``.
+    :param corpus_paths: All files of each version, for the conversions of the whole corpus.
+    """
+    benchmarks = {}
+    scratch_directory = tempfile.mkdtemp(prefix="muscima-pp-benchmark.")
+    try:
+        for version, file_benchmarks in FILE_BENCHMARKS.items():
+            for name, benchmark in file_benchmarks:
+                measurements = []
+                for path in paths[version]:
+                    seconds, nodes, peak_rss, rss_increase = run_isolated(benchmark, path, repetitions,
+                                                                          scratch_directory)
+                    measurements.append(Measurement(os.path.splitext(os.path.basename(path))[0], nodes,
+                                                    os.path.getsize(path), seconds, peak_rss, rss_increase))
+                benchmarks[name] = summarize(measurements)
+                print_benchmark(name, benchmarks[name])
+
+        for name, converter, version in CORPUS_BENCHMARKS:
+            if not corpus_paths.get(version):
+                continue
+            seconds, nodes, peak_rss, rss_increase = run_isolated(benchmark_convert_corpus, converter,
+                                                                  corpus_paths[version], scratch_directory)
+            benchmarks[name] = summarize([Measurement("corpus", nodes, sum(map(os.path.getsize,
+                                                                              corpus_paths[version])),
+                                                      seconds, peak_rss, rss_increase)])
+            print_benchmark(name, benchmarks[name])
+    finally:
+        shutil.rmtree(scratch_directory)
+    return benchmarks
+
+
+def print_benchmark(name: str, result: Dict, change: Optional[float] = None) -> None:
+    print("{0:<32} {1:>9.1f} ms {2:>11.0f} nodes/s {3:>7.2f} MB/s {4:>8.1f} MB peak RSS{5}".format(
+        name, result["seconds"] * 1000, result["nodes_per_second"] or 0, result["megabytes_per_second"] or 0,
+        result["peak_rss_bytes"] / (1024 * 1024), "" if change is None else " {0:>+7.1%}".format(change)))
+
+
+def compare_to_baseline(results: Dict, baseline: Dict, time_tolerance: float,
+                        memory_tolerance: float) -> List[str]:
+    """ Compares the throughput and memory of every benchmark that is in both results.
+
+    :returns: A description of every regression, i.e., of every benchmark whose throughput dropped by more than
+        ``time_tolerance`` or whose RSS increase grew by more than ``memory_tolerance`` (relative to the baseline).
+    """
+    differing_settings = sorted(key for key, value in results["settings"].items()
+                                if baseline["settings"].get(key) != value)
+    if differing_settings:
+        print("The baseline was measured with different {0}, so the results may not be "
+              "comparable".format(", ".join(differing_settings)))
+    regressions = []
+    for name, result in results["benchmarks"].items():
+        baseline_result = baseline["benchmarks"].get(name)
+        if baseline_result is None or not baseline_result["nodes_per_second"] or not result["nodes_per_second"]:
+            continue
+        slowdown = baseline_result["nodes_per_second"] / result["nodes_per_second"] - 1
+        if slowdown > time_tolerance:
+            regressions.append("{0} is {1:.0%} slower: {2:.0f} nodes/s instead of {3:.0f} nodes/s".format(
+                name, slowdown, result["nodes_per_second"], baseline_result["nodes_per_second"]))
+        allowed_rss_increase = baseline_result["rss_increase_bytes"] * (1 + memory_tolerance) + MEMORY_SLACK_BYTES
+        if result["rss_increase_bytes"] > allowed_rss_increase:
+            regressions.append("{0} needs {1:.1f} MB more memory instead of {2:.1f} MB".format(
+                name, result["rss_increase_bytes"] / (1024 * 1024),
+                baseline_result["rss_increase_bytes"] / (1024 * 1024)))
+    return regressions
+
+
+def list_annotation_files(directory: str) -> List[str]:
+    return sorted(os.path.join(directory, f) for f in os.listdir(directory) if f.endswith(".xml"))
+
+
+def files_across_sizes(directory: str, number_of_files: int) -> List[str]:
+    """ Selects files evenly spread from the smallest to the largest one, ordered by size, so that the
+    measurements show how time and memory grow with the number of nodes """
+    paths = sorted(list_annotation_files(directory), key=os.path.getsize)
+    if number_of_files <= 0 or len(paths) == 0:
+        return []
+    positions = numpy.unique(numpy.linspace(0, len(paths) - 1, min(number_of_files, len(paths))).round())
+    return [paths[int(position)] for position in positions]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measures reading, upgrading and writing the MUSCIMA++ annotations '
+                                                 'and compares the results to a saved baseline')
+    parser.add_argument('--v1_0_directory', type=str, default="v1.0",
+                        help='Directory of the MUSCIMA++ dataset v1.0')
+    parser.add_argument('--v2_0_directory', type=str, default="v2.0",
+                        help='Directory of the MUSCIMA++ dataset v2.0')
+    parser.add_argument('--files', type=int, default=10,
+                        help='Number of files, from the smallest to the largest one, that the stages are '
+                             'measured on')
+    parser.add_argument('--repetitions', type=int, default=5,
+                        help='How often each stage is repeated on a file (the best time is reported)')
+    parser.add_argument("--skip_corpus", action="store_true",
+                        help="Do not measure the conversion of the whole corpus, which takes about a minute.")
+    parser.add_argument("--output", type=str, default="benchmark_results.json",
+                        help="File, where the results are written to as JSON.")
+    parser.add_argument("--baseline", type=str, default="benchmark_baseline.json",
+                        help="Results of an earlier run, that the results are compared to. It must exist, "
+                             "unless --save_baseline is given.")
+    parser.add_argument("--save_baseline", action="store_true",
+                        help="Store the results as the new baseline instead of comparing them to it.")
+    parser.add_argument("--time_tolerance", type=float, default=0.25,
+                        help="Relative drop of the throughput of a benchmark, that counts as a regression.")
+    parser.add_argument("--memory_tolerance", type=float, default=0.25,
+                        help="Relative growth of the memory of a benchmark, that counts as a regression.")
+
+    flags = parser.parse_args()
+    if not flags.save_baseline and not os.path.exists(flags.baseline):
+        parser.error("No baseline {0} to compare to, store one with --save_baseline".format(flags.baseline))
+
+    v1_0_source = os.path.join(flags.v1_0_directory, "data/cropobjects_withstaff")
+    v2_0_source = os.path.join(flags.v2_0_directory, "data/annotations")
+    v1_0_paths = files_across_sizes(v1_0_source, flags.files)
+    # The same documents in both versions, so the stages of the upgrade can be compared
+    v2_0_paths = [os.path.join(v2_0_source, os.path.basename(path)) for path in v1_0_paths
+                  if os.path.exists(os.path.join(v2_0_source, os.path.basename(path)))]
+    corpus_paths = {} if flags.skip_corpus else {"v1.0": list_annotation_files(v1_0_source),
+                                                 "v2.0": list_annotation_files(v2_0_source)}
+
+    results = {"version": RESULTS_FORMAT_VERSION,
+               "settings": {"documents": [os.path.basename(path) for path in v1_0_paths],
+                            "repetitions": flags.repetitions,
+                            "corpus": not flags.skip_corpus},
+               "environment": {"python": platform.python_version(), "numpy": numpy.__version__,
+                               "platform": platform.platform(), "processor": platform.processor(),
+                               "cpus": os.cpu_count()},
+               "benchmarks": run_benchmarks({"v1.0": v1_0_paths, "v2.0": v2_0_paths}, corpus_paths,
+                                            flags.repetitions),
+               }
+    with open(flags.output, "w") as file:
+        json.dump(results, file, indent=4)
+
+    if flags.save_baseline:
+        if os.path.abspath(flags.output) != os.path.abspath(flags.baseline):
+            shutil.copyfile(flags.output, flags.baseline)
+        print("Saved the results as the baseline {0}".format(flags.baseline))
+    else:
+        with open(flags.baseline) as file:
+            baseline = json.load(file)
+        print("Compared to the baseline {0}:".format(flags.baseline))
+        for name, result in results["benchmarks"].items():
+            baseline_result = baseline["benchmarks"].get(name)
+            if baseline_result is not None and baseline_result["nodes_per_second"] and result["nodes_per_second"]:
+                print_benchmark(name, result, result["nodes_per_second"] / baseline_result["nodes_per_second"] - 1)
+        regressions = compare_to_baseline(results, baseline, flags.time_tolerance, flags.memory_tolerance)
+        for regression in regressions:
+            print("Regression: {0}".format(regression))
+        if regressions:
+            raise SystemExit("{0} benchmarks regressed against {1}".format(len(regressions), flags.baseline))
+        print("No regressions against the baseline")
@@ -0,0 +1,79 @@
+import argparse
+import os
+import time
+from typing import List, Callable
+
+from muscima.cropobject import CropObject
+
+from upgrade_rules import load_script
+
+
+def largest_files(directory: str, number_of_files: int) -> List[str]:
+    paths = [os.path.join(directory, f) for f in os.listdir(directory) if f.endswith(".xml")]
+    return sorted(paths, key=os.path.getsize, reverse=True)[:number_of_files]
+
+
+def best_time(function: Callable, repetitions: int) -> float:
+    times = []
+    for _ in range(repetitions):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def best_upgrade_time(upgrade_script, annotation_file_path: str, repetitions: int) -> float:
+    """ The upgrade modifies the tree and the crop objects in place, so every repetition gets freshly parsed ones. """
+    times = []
+    for _ in range(repetitions):
+        tree = upgrade_script.parse(annotation_file_path)
+        crop_objects = upgrade_script.read_crop_objects(tree)
+        start = time.perf_counter()
+        upgrade_script.upgrade_xml_file(tree, crop_objects, "MUSCIMA-pp_2.0", "benchmark")
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def resolve_links_by_scanning(crop_objects: List[CropObject]) -> None:
+    for crop_object in crop_objects:
+        crop_object.get_inlink_objects(crop_objects)
+        crop_object.get_outlink_objects(crop_objects)
+
+
+def resolve_links_with_index(upgrade_script, crop_objects: List[CropObject], crop_object_nodes) -> None:
+    index = upgrade_script.DocumentIndex(crop_objects, crop_object_nodes)
+    for crop_object in crop_objects:
+        index.get_inlink_objects(crop_object)
+        index.get_outlink_objects(crop_object)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measures the link resolution of the v1.0 to v2.0 upgrade '
+                                                 'on the largest MUSCIMA++ v1.0 pages')
+    parser.add_argument('--source_directory', type=str, default="v1.0",
+                        help='Directory of the MUSCIMA++ dataset v1.0')
+    parser.add_argument('--files', type=int, default=5, help='Number of largest files to measure')
+    parser.add_argument('--repetitions', type=int, default=3,
+                        help='How often each measurement is repeated (the best time is reported)')
+
+    flags = parser.parse_args()
+
+    upgrade_script = load_script(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                              "upgrade_v1.0_to_v2.0.py"))
+    source = os.path.join(flags.source_directory, "data/cropobjects_withstaff")
+
+    print("{0:<40} {1:>6} {2:>12} {3:>12} {4:>8} {5:>12}".format("Document", "Nodes", "Scan [ms]", "Index [ms]",
+                                                                "Speedup", "Upgrade [ms]"))
+    for annotation_file_path in largest_files(source, flags.files):
+        tree = upgrade_script.parse(annotation_file_path)
+        crop_objects = upgrade_script.read_crop_objects(tree)
+        crop_object_nodes = tree.findall("*/CropObject")
+
+        scan_time = best_time(lambda: resolve_links_by_scanning(crop_objects), flags.repetitions)
+        index_time = best_time(lambda: resolve_links_with_index(upgrade_script, crop_objects, crop_object_nodes),
+                               flags.repetitions)
+        upgrade_time = best_upgrade_time(upgrade_script, annotation_file_path, flags.repetitions)
+
+        print("{0:<40} {1:>6} {2:>12.1f} {3:>12.1f} {4:>7.1f}x {5:>12.1f}".format(
+            os.path.splitext(os.path.basename(annotation_file_path))[0], len(crop_objects), scan_time * 1000,
+            index_time * 1000, scan_time / index_time, upgrade_time * 1000))
@@ -0,0 +1,341 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from xml.etree.ElementTree import Element, SubElement, parse
+
+import numpy
+from tqdm import tqdm
+
+from annotation_reader import parse_links
+from mask_codec import decode_runs, encode_masks, is_canonical, parse_runs
+from upgrade_rules import compute_file_hash
+from xml_writer import write_pretty_xml_file
+
+CACHE_FORMAT_VERSION = 1
+MANIFEST_FILE_NAME = "manifest.json"
+CACHE_MANIFEST_KEYS = ("version", "class_names", "documents", "document_offsets", "data")
+
+# Per-node columns, each stored as a separate .npy file, so they can be memory-mapped independently.
+# The links are stored in CSR form: the ids of the inlinks of the node with index i
+# are inlinks[inlink_offsets[i]:inlink_offsets[i + 1]], and the same holds for outlinks and masks.
+NODE_COLUMNS = {"ids": numpy.int32,
+                "class_codes": numpy.int16,
+                "tops": numpy.int32,
+                "lefts": numpy.int32,
+                "widths": numpy.int32,
+                "heights": numpy.int32,
+                "has_mask": numpy.bool_,
+                "has_inlinks_element": numpy.bool_,
+                "has_outlinks_element": numpy.bool_,
+                "mask_offsets": numpy.int64,
+                "inlink_offsets": numpy.int64,
+                "inlinks": numpy.int32,
+                "outlink_offsets": numpy.int64,
+                "outlinks": numpy.int32,
+                "masks": numpy.uint8,
+                }
+
+
+def list_annotation_files(annotations_directory: str) -> List[str]:
+    return sorted(f for f in os.listdir(annotations_directory) if f.endswith(".xml"))
+
+
+class AnnotationCorpus(object):
+    """ Memory-mapped view on a compiled annotation corpus. Opening it only maps the column files,
+    node data is read from disk when it is accessed. Nodes are addressed by their global index,
+    the nodes of a document are a contiguous range of indices, see ``document_range``. """
+
+    def __init__(self, cache_directory: str):
+        with open(os.path.join(cache_directory, MANIFEST_FILE_NAME)) as file:
+            self.manifest = json.load(file)
+        if self.manifest["version"] != CACHE_FORMAT_VERSION:
+            raise ValueError("Corpus cache in {0} has version {1}, expected {2}".format(
+                cache_directory, self.manifest["version"], CACHE_FORMAT_VERSION))
+
+        self.class_names = self.manifest["class_names"]  # type: List[str]
+        self.documents = [document["name"] for document in self.manifest["documents"]]  # type: List[str]
+        self.document_offsets = numpy.array(self.manifest["document_offsets"], dtype=numpy.int64)
+        self.__document_indices = {name: i for i, name in enumerate(self.documents)}
+        self.__data = {int(index): items for index, items in self.manifest["data"].items()}
+
+        for column in NODE_COLUMNS:
+            setattr(self, column, numpy.load(os.path.join(cache_directory, column + ".npy"), mmap_mode="r"))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def document_range(self, document: str) -> range:
+        document_index = self.__document_indices[document]
+        return range(int(self.document_offsets[document_index]), int(self.document_offsets[document_index + 1]))
+
+    def class_name(self, node_index: int) -> str:
+        return self.class_names[self.class_codes[node_index]]
+
+    def get_inlinks(self, node_index: int) -> numpy.ndarray:
+        return self.inlinks[self.inlink_offsets[node_index]:self.inlink_offsets[node_index + 1]]
+
+    def get_outlinks(self, node_index: int) -> numpy.ndarray:
+        return self.outlinks[self.outlink_offsets[node_index]:self.outlink_offsets[node_index + 1]]
+
+    def get_packed_mask(self, node_index: int) -> Optional[numpy.ndarray]:
+        """ Returns the bits of the mask (packed with ``numpy.packbits`` in C order) as a view
+        into the memory-mapped mask blob, without copying anything. """
+        if not self.has_mask[node_index]:
+            return None
+        return self.masks[self.mask_offsets[node_index]:self.mask_offsets[node_index + 1]]
+
+    def get_mask(self, node_index: int) -> Optional[numpy.ndarray]:
+        packed_mask = self.get_packed_mask(node_index)
+        if packed_mask is None:
+            return None
+        height, width = int(self.heights[node_index]), int(self.widths[node_index])
+        return numpy.unpackbits(packed_mask, count=height * width).reshape(height, width)
+
+    def node_to_element(self, node_index: int, mask_string: str) -> Element:
+        element = Element("Node")
+        SubElement(element, "Id").text = str(self.ids[node_index])
+        SubElement(element, "ClassName").text = self.class_name(node_index)
+        SubElement(element, "Top").text = str(self.tops[node_index])
+        SubElement(element, "Left").text = str(self.lefts[node_index])
+        SubElement(element, "Width").text = str(self.widths[node_index])
+        SubElement(element, "Height").text = str(self.heights[node_index])
+        SubElement(element, "Mask").text = mask_string
+        if self.has_inlinks_element[node_index]:
+            SubElement(element, "Inlinks").text = " ".join(map(str, self.get_inlinks(node_index).tolist()))
+        if self.has_outlinks_element[node_index]:
+            SubElement(element, "Outlinks").text = " ".join(map(str, self.get_outlinks(node_index).tolist()))
+        if node_index in self.__data:
+            data = SubElement(element, "Data")
+            for key, value_type, value in self.__data[node_index]:
+                SubElement(data, "DataItem", attrib={"key": key, "type": value_type}).text = value
+        return element
+
+    def write_document(self, document: str, path: str) -> None:
+        """ Writes the document back in the XML format of ``CVC-MUSCIMA_Schema.xsd``. The file is
+        byte-identical to the annotation file that the corpus was compiled from. """
+        attributes = self.manifest["documents"][self.__document_indices[document]]["attributes"]
+        node_indices = self.document_range(document)
+        mask_strings = encode_masks([self.get_mask(i) for i in node_indices])
+        write_pretty_xml_file(path, "Nodes", dict(attributes),
+                              (self.node_to_element(i, mask_string) for i, mask_string in zip(node_indices,
+                                                                                              mask_strings)))
+
+
+def read_document(path: str) -> Tuple[List[Tuple[str, str]], Dict[str, list]]:
+    """ Parses one annotation file into the root attributes and lists of per-node values """
+    root = parse(path).getroot()
+    columns = {column: [] for column in NODE_COLUMNS}
+    columns["class_names"] = []
+    columns["data"] = []
+    for node in root:
+        columns["ids"].append(int(node.findtext("Id")))
+        columns["class_names"].append(node.findtext("ClassName"))
+        columns["tops"].append(int(node.findtext("Top")))
+        columns["lefts"].append(int(node.findtext("Left")))
+        columns["widths"].append(int(node.findtext("Width")))
+        columns["heights"].append(int(node.findtext("Height")))
+        columns["has_mask"].append(node.findtext("Mask") != "None")
+        columns["inlinks"].append(parse_links(node.findtext("Inlinks")))
+        columns["outlinks"].append(parse_links(node.findtext("Outlinks")))
+        columns["has_inlinks_element"].append(node.find("Inlinks") is not None)
+        columns["has_outlinks_element"].append(node.find("Outlinks") is not None)
+        data = node.find("Data")
+        columns["data"].append(None if data is None else [(item.get("key"), item.get("type"), item.text)
+                                                          for item in data.findall("DataItem")])
+
+    present = [i for i, has_mask in enumerate(columns["has_mask"]) if has_mask]
+    values, lengths, run_offsets = parse_runs([root[i].findtext("Mask") for i in present])
+    non_canonical_masks = numpy.flatnonzero(~is_canonical(values, lengths, run_offsets))
+    if len(non_canonical_masks) > 0:
+        raise ValueError("{0}: mask of node {1} is not in the canonical run-length encoding and could not be "
+                         "restored exactly".format(path, columns["ids"][present[non_canonical_masks[0]]]))
+    masks = decode_runs(values, lengths, run_offsets, [(columns["heights"][i], columns["widths"][i]) for i in present])
+    columns["masks"] = [numpy.zeros(0, numpy.uint8)] * len(columns["ids"])
+    for i, mask in zip(present, masks):
+        columns["masks"][i] = numpy.packbits(mask)
+    return list(root.attrib.items()), columns
+
+
+def read_cached_document(corpus: AnnotationCorpus, document: str) -> Dict[str, list]:
+    """ Reads the per-node values of an unchanged document from an existing cache, instead of parsing it again """
+    node_indices = corpus.document_range(document)
+    columns = {column: [] for column in NODE_COLUMNS}
+    columns["class_names"] = [corpus.class_name(i) for i in node_indices]
+    columns["data"] = [corpus.manifest["data"].get(str(i)) for i in node_indices]
+    for column in ("ids", "tops", "lefts", "widths", "heights", "has_mask", "has_inlinks_element",
+                   "has_outlinks_element"):
+        columns[column] = getattr(corpus, column)[node_indices.start:node_indices.stop].tolist()
+    for i in node_indices:
+        columns["masks"].append(numpy.array(corpus.masks[corpus.mask_offsets[i]:corpus.mask_offsets[i + 1]]))
+        columns["inlinks"].append(corpus.get_inlinks(i).tolist())
+        columns["outlinks"].append(corpus.get_outlinks(i).tolist())
+    return columns
+
+
+def concatenate_with_offsets(arrays: list, dtype) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    offsets = numpy.zeros(len(arrays) + 1, dtype=numpy.int64)
+    offsets[1:] = numpy.cumsum([len(array) for array in arrays])
+    if len(arrays) == 0:
+        return numpy.zeros(0, dtype=dtype), offsets
+    return numpy.concatenate([numpy.asarray(array, dtype=dtype) for array in arrays]), offsets
+
+
+def load_corpus_if_valid(cache_directory: str) -> Optional[AnnotationCorpus]:
+    if not os.path.exists(os.path.join(cache_directory, MANIFEST_FILE_NAME)):
+        return None
+    try:
+        return AnnotationCorpus(cache_directory)
+    except (ValueError, KeyError, OSError):
+        return None
+
+
+def is_replaceable_directory(directory: str, manifest_file_name: str, manifest_keys: Tuple[str, ...]) -> bool:
+    """ :returns: Whether a build may delete the directory to replace it, because it does not exist, is empty,
+        or holds a manifest with all of the given keys, so it was written by the same kind of build. """
+    if not os.path.exists(directory):
+        return True
+    if not os.path.isdir(directory):
+        return False
+    if not os.listdir(directory):
+        return True
+    try:
+        with open(os.path.join(directory, manifest_file_name)) as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        return False
+    return isinstance(manifest, dict) and all(key in manifest for key in manifest_keys)
+
+
+def compile_corpus(annotations_directory: str, cache_directory: str, workers: int = 1) -> AnnotationCorpus:
+    """ Compiles all annotation files of a directory into a binary corpus cache and returns it.
+    Documents whose source hash did not change are copied from the existing cache instead of
+    being parsed again. If nothing changed at all, the existing cache is returned as it is.
+
+    :param workers: Number of processes that parse the changed documents in parallel.
+    """
+    if not is_replaceable_directory(cache_directory, MANIFEST_FILE_NAME, CACHE_MANIFEST_KEYS):
+        raise ValueError("{0} is not a corpus cache and is not empty, refusing to replace it".format(cache_directory))
+    annotation_files = list_annotation_files(annotations_directory)
+    source_hashes = {f: compute_file_hash(os.path.join(annotations_directory, f)) for f in annotation_files}
+
+    previous_corpus = load_corpus_if_valid(cache_directory)
+    previous_documents = {}
+    if previous_corpus is not None:
+        previous_documents = {d["file"]: d for d in previous_corpus.manifest["documents"]}
+        if {f: d["hash"] for f, d in previous_documents.items()} == source_hashes:
+            return previous_corpus
+
+    changed_files = [f for f in annotation_files if f not in previous_documents
+                     or previous_documents[f]["hash"] != source_hashes[f]]
+    changed_paths = [os.path.join(annotations_directory, f) for f in changed_files]
+    parsed_documents = {}
+    if workers > 1 and len(changed_files) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parsed_documents = dict(zip(changed_files, tqdm(executor.map(read_document, changed_paths),
+                                                            "Parsing annotations", total=len(changed_files))))
+
+    documents = []
+    document_columns = []
+    for annotation_file in tqdm(annotation_files, "Compiling annotations"):
+        previous_document = previous_documents.get(annotation_file)
+        if previous_document is not None and previous_document["hash"] == source_hashes[annotation_file]:
+            attributes = previous_document["attributes"]
+            columns = read_cached_document(previous_corpus, previous_document["name"])
+        elif annotation_file in parsed_documents:
+            attributes, columns = parsed_documents.pop(annotation_file)
+        else:
+            attributes, columns = read_document(os.path.join(annotations_directory, annotation_file))
+        documents.append({"name": os.path.splitext(annotation_file)[0], "file": annotation_file,
+                          "hash": source_hashes[annotation_file], "attributes": attributes})
+        document_columns.append(columns)
+
+    class_names = sorted(set(c for columns in document_columns for c in columns["class_names"]))
+    class_codes = {class_name: code for code, class_name in enumerate(class_names)}
+    all_data = [items for columns in document_columns for items in columns["data"]]
+
+    temporary_directory = tempfile.mkdtemp(prefix=os.path.basename(os.path.normpath(cache_directory)) + ".",
+                                           dir=os.path.dirname(os.path.abspath(cache_directory)))
+    for column in ("ids", "tops", "lefts", "widths", "heights", "has_mask", "has_inlinks_element",
+                   "has_outlinks_element"):
+        values = [value for columns in document_columns for value in columns[column]]
+        numpy.save(os.path.join(temporary_directory, column + ".npy"), numpy.array(values, NODE_COLUMNS[column]))
+    numpy.save(os.path.join(temporary_directory, "class_codes.npy"),
+               numpy.array([class_codes[c] for columns in document_columns for c in columns["class_names"]],
+                           NODE_COLUMNS["class_codes"]))
+    for column, offsets_column in (("masks", "mask_offsets"), ("inlinks", "inlink_offsets"),
+                                   ("outlinks", "outlink_offsets")):
+        values, offsets = concatenate_with_offsets([value for columns in document_columns
+                                                    for value in columns[column]], NODE_COLUMNS[column])
+        numpy.save(os.path.join(temporary_directory, column + ".npy"), values)
+        numpy.save(os.path.join(temporary_directory, offsets_column + ".npy"), offsets)
+
+    document_offsets = numpy.zeros(len(documents) + 1, dtype=numpy.int64)
+    document_offsets[1:] = numpy.cumsum([len(columns["ids"]) for columns in document_columns])
+    manifest = {"version": CACHE_FORMAT_VERSION,
+                "class_names": class_names,
+                "documents": documents,
+                "document_offsets": document_offsets.tolist(),
+                "data": {str(i): items for i, items in enumerate(all_data) if items is not None},
+                }
+    with open(os.path.join(temporary_directory, MANIFEST_FILE_NAME), "w") as file:
+        json.dump(manifest, file)
+
+    del previous_corpus
+    if os.path.exists(cache_directory):
+        shutil.rmtree(cache_directory)
+    os.replace(temporary_directory, cache_directory)
+    return AnnotationCorpus(cache_directory)
+
+
+def verify_corpus(corpus: AnnotationCorpus, annotations_directory: str) -> List[str]:
+    """ Writes every document of the corpus back to XML and returns the documents,
+    that are not byte-identical to their source files. """
+    differing_documents = []
+    file_descriptor, temporary_file = tempfile.mkstemp(suffix=".xml")
+    os.close(file_descriptor)
+    for document in tqdm(corpus.manifest["documents"], "Verifying documents"):
+        corpus.write_document(document["name"], temporary_file)
+        with open(temporary_file, "rb") as written, \
+                open(os.path.join(annotations_directory, document["file"]), "rb") as source:
+            if written.read() != source.read():
+                differing_documents.append(document["name"])
+    os.remove(temporary_file)
+    return differing_documents
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compiles the MUSCIMA++ annotations into a binary, '
+                                                 'memory-mappable corpus cache')
+    parser.add_argument('--source_directory', type=str, default="v2.0",
+                        help='Directory of the MUSCIMA++ dataset v2.0 or newer')
+    parser.add_argument("--cache_directory", type=str, default=None,
+                        help="Directory, where the compiled corpus is stored. "
+                             "Defaults to data/corpus_cache inside of the source directory.")
+    parser.add_argument("--verify", action="store_true",
+                        help="Check that every document can be written back to identical XML.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Number of processes that parse changed annotation files in parallel.")
+
+    flags = parser.parse_args()
+    annotations_directory = os.path.join(flags.source_directory, "data/annotations")
+    cache_directory = flags.cache_directory or os.path.join(flags.source_directory, "data/corpus_cache")
+
+    corpus = compile_corpus(annotations_directory, cache_directory, flags.workers)
+
+    start = time.perf_counter()
+    corpus = AnnotationCorpus(cache_directory)
+    print("Opened {0} documents with {1} nodes in {2:.1f} ms".format(len(corpus.documents), len(corpus),
+                                                                      (time.perf_counter() - start) * 1000))
+
+    if flags.verify:
+        differing_documents = verify_corpus(corpus, annotations_directory)
+        for document in differing_documents:
+            print("Document {0} could not be restored exactly".format(document))
+        if differing_documents:
+            raise SystemExit("{0} documents differ".format(len(differing_documents)))
+        print("All documents were restored exactly")
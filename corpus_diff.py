@@ -0,0 +1,322 @@
+import argparse
+import collections
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from annotation_reader import iterate_nodes
+from upgrade_rules import compute_file_hash
+
+# Where the annotations are stored inside of the dataset directories of the different versions
+ANNOTATION_SUBDIRECTORIES = ("data/annotations", "data/cropobjects_withstaff")
+
+Box = Tuple[int, int, int, int]
+# Class of the nodes that edges point to, but that do not exist in the document
+MISSING_NODE = "(missing node)"
+# Version of ``read_structure`` and ``structure_hash``, stored with the cached structure hashes
+STRUCTURE_HASH_VERSION = 1
+
+
+class DocumentDiff(NamedTuple):
+    """ The differences between two versions of a document. Matched nodes have the same id and box, or were
+    renumbered (same box, different id) or moved (same id, different box). New nodes that share the box of an
+    old node were split off from it, e.g., the dynamics letters of v2.0, all other unmatched nodes were
+    dropped or added. Classes are counted by name, edges by the classes of their nodes. """
+    document: str
+    status: str  # identical, unchanged, changed, only_old or only_new
+    nodes: collections.Counter  # matched, renamed, renumbered, moved, split, dropped and added nodes
+    class_mapping: collections.Counter  # (old class, new class) of the matched nodes
+    split_classes: collections.Counter  # (class of the old node, class of the node split off from it)
+    dropped_classes: collections.Counter
+    added_classes: collections.Counter
+    added_edges: collections.Counter  # (class of the source, class of the target) in the new version
+    removed_edges: collections.Counter  # (class of the source, class of the target) in the old version
+    dropped_ids: List[int]
+    added_ids: List[int]
+
+
+class DocumentStructure(NamedTuple):
+    classes: Dict[int, str]
+    boxes: Dict[int, Box]
+    edges: frozenset
+
+
+def find_annotations_directory(directory: str) -> str:
+    """ Accepts the dataset directory of any version, or the directory of the annotation files itself """
+    for subdirectory in ANNOTATION_SUBDIRECTORIES:
+        if os.path.isdir(os.path.join(directory, subdirectory)):
+            return os.path.join(directory, subdirectory)
+    return directory
+
+
+def read_structure(path: str) -> DocumentStructure:
+    classes, boxes, edges = {}, {}, set()
+    for record in iterate_nodes(path, fields=["links"]):
+        classes[record.id] = record.class_name
+        boxes[record.id] = (record.top, record.left, record.height, record.width)
+        edges.update((record.id, outlink) for outlink in record.outlinks)
+    return DocumentStructure(classes, boxes, frozenset(edges))
+
+
+def structure_hash(structure: DocumentStructure) -> str:
+    """ Hashes the node set and the edge set independently of the order of the nodes in the file """
+    sha1 = hashlib.sha1()
+    for node_id in sorted(structure.classes):
+        sha1.update("{0} {1} {2}\n".format(node_id, structure.classes[node_id], structure.boxes[node_id]).encode())
+    sha1.update(b"edges\n")
+    for edge in sorted(structure.edges):
+        sha1.update("{0} {1}\n".format(*edge).encode())
+    return sha1.hexdigest()
+
+
+def match_nodes(old: DocumentStructure, new: DocumentStructure) -> Tuple[Dict[int, int], collections.Counter]:
+    """ Matches the old nodes to new nodes, first by id and box, then by box only and finally by id only.
+
+    :returns: The id of the matching new node for every matched old node and how many nodes were matched,
+        renumbered and moved.
+    """
+    matches = {node_id: node_id for node_id in old.boxes
+               if node_id in new.boxes and old.boxes[node_id] == new.boxes[node_id]}
+    matched_new_ids = set(matches.values())
+    counts = collections.Counter()
+
+    unmatched_old_ids_by_box = collections.defaultdict(collections.deque)  # type: Dict[Box, collections.deque]
+    for node_id in sorted(old.boxes):
+        if node_id not in matches:
+            unmatched_old_ids_by_box[old.boxes[node_id]].append(node_id)
+    for node_id in sorted(new.boxes):
+        if node_id not in matched_new_ids and unmatched_old_ids_by_box.get(new.boxes[node_id]):
+            matches[unmatched_old_ids_by_box[new.boxes[node_id]].popleft()] = node_id
+            matched_new_ids.add(node_id)
+            counts["renumbered"] += 1
+
+    for node_id in sorted(old.boxes):
+        if node_id not in matches and node_id in new.boxes and node_id not in matched_new_ids:
+            matches[node_id] = node_id
+            matched_new_ids.add(node_id)
+            counts["moved"] += 1
+    counts["matched"] = len(matches)
+    return matches, counts
+
+
+def diff_structures(document: str, old: DocumentStructure, new: DocumentStructure) -> DocumentDiff:
+    matches, nodes = match_nodes(old, new)
+    matched_new_ids = set(matches.values())
+    class_mapping = collections.Counter((old.classes[old_id], new.classes[new_id])
+                                        for old_id, new_id in matches.items())
+    nodes["renamed"] = sum(count for (old_class, new_class), count in class_mapping.items() if old_class != new_class)
+
+    old_ids_by_box = collections.defaultdict(list)  # type: Dict[Box, List[int]]
+    for node_id in sorted(old.boxes):
+        old_ids_by_box[old.boxes[node_id]].append(node_id)
+    split_classes, added_classes = collections.Counter(), collections.Counter()
+    added_ids = []
+    for node_id in sorted(new.boxes):
+        if node_id in matched_new_ids:
+            continue
+        if new.boxes[node_id] in old_ids_by_box:
+            # A node is not split off from the nodes that link to it or to another node with the same box,
+            # e.g., a dynamics text that consists of a single letter has the same box as that letter
+            candidates = old_ids_by_box[new.boxes[node_id]]
+            origins = [c for c in candidates if (matches.get(c), node_id) not in new.edges
+                       and not any((c, other) in old.edges for other in candidates)] or candidates
+            split_classes[(old.classes[origins[0]], new.classes[node_id])] += 1
+        else:
+            added_classes[new.classes[node_id]] += 1
+            added_ids.append(node_id)
+    dropped_ids = [node_id for node_id in sorted(old.boxes) if node_id not in matches]
+    nodes["split"] = sum(split_classes.values())
+    nodes["added"] = len(added_ids)
+    nodes["dropped"] = len(dropped_ids)
+
+    # Old edges are compared in terms of the new ids, edges of dropped nodes can not be translated
+    translated_edges = {(matches[source], matches[target]): (source, target) for source, target in old.edges
+                        if source in matches and target in matches}
+    removed_edges = collections.Counter(
+        (old.classes.get(source, MISSING_NODE), old.classes.get(target, MISSING_NODE)) for source, target in old.edges
+        if source not in matches or target not in matches)
+    removed_edges.update((old.classes[source], old.classes[target])
+                         for new_edge, (source, target) in translated_edges.items() if new_edge not in new.edges)
+    added_edges = collections.Counter((new.classes.get(source, MISSING_NODE), new.classes.get(target, MISSING_NODE))
+                                      for source, target in new.edges if (source, target) not in translated_edges)
+
+    return DocumentDiff(document, "changed", nodes, class_mapping, split_classes,
+                        collections.Counter(old.classes[node_id] for node_id in dropped_ids), added_classes,
+                        added_edges, removed_edges, dropped_ids, added_ids)
+
+
+def empty_diff(document: str, status: str) -> DocumentDiff:
+    return DocumentDiff(document, status, collections.Counter(), collections.Counter(), collections.Counter(),
+                        collections.Counter(), collections.Counter(), collections.Counter(), collections.Counter(),
+                        [], [])
+
+
+def diff_document(document: str, old_path: Optional[str],
+                  new_path: Optional[str]) -> Tuple[DocumentDiff, Optional[str], Optional[str]]:
+    """ Compares two versions of a document. Documents with the same hash of their node and edge sets are
+    reported as unchanged without matching their nodes.
+
+    :returns: The differences and the structure hashes of the old and the new file, if they were parsed.
+    """
+    if new_path is None:
+        return empty_diff(document, "only_old"), None, None
+    if old_path is None:
+        return empty_diff(document, "only_new"), None, None
+    old, new = read_structure(old_path), read_structure(new_path)
+    old_structure_hash, new_structure_hash = structure_hash(old), structure_hash(new)
+    if old_structure_hash == new_structure_hash:
+        return empty_diff(document, "unchanged"), old_structure_hash, new_structure_hash
+    return diff_structures(document, old, new), old_structure_hash, new_structure_hash
+
+
+def diff_corpora(old_directory: str, new_directory: str, workers: int,
+                 structure_hashes: Optional[Dict[str, str]] = None) -> List[DocumentDiff]:
+    """ Compares all documents of two annotation directories in parallel. Documents are paired by their
+    file name, without the extension. Byte-identical files are not parsed at all.
+
+    :param structure_hashes: The structure hashes of previously parsed files, keyed by the hash of the files.
+        Documents whose files both have the same structure hash in it are reported as unchanged without
+        parsing them. The hashes of all files parsed now are added to it.
+    """
+    structure_hashes = {} if structure_hashes is None else structure_hashes
+    old_files = {os.path.splitext(f)[0]: os.path.join(old_directory, f)
+                 for f in os.listdir(old_directory) if f.endswith(".xml")}
+    new_files = {os.path.splitext(f)[0]: os.path.join(new_directory, f)
+                 for f in os.listdir(new_directory) if f.endswith(".xml")}
+    file_hashes = {path: compute_file_hash(path) for path in list(old_files.values()) + list(new_files.values())}
+    documents = sorted(set(old_files) | set(new_files))
+
+    diffs = {}  # type: Dict[str, DocumentDiff]
+    for document in documents:
+        if document not in old_files or document not in new_files:
+            continue
+        old_file_hash, new_file_hash = file_hashes[old_files[document]], file_hashes[new_files[document]]
+        if old_file_hash == new_file_hash:
+            diffs[document] = empty_diff(document, "identical")
+        elif old_file_hash in structure_hashes and \
+                structure_hashes[old_file_hash] == structure_hashes.get(new_file_hash):
+            diffs[document] = empty_diff(document, "unchanged")
+
+    parsed_documents = [document for document in documents if document not in diffs]
+    with ProcessPoolExecutor(max_workers=max(1, workers)) as executor:
+        results = executor.map(diff_document, parsed_documents, [old_files.get(d) for d in parsed_documents],
+                               [new_files.get(d) for d in parsed_documents])
+        for document, (diff, old_structure_hash, new_structure_hash) in zip(parsed_documents, results):
+            diffs[document] = diff
+            if old_structure_hash is not None:
+                structure_hashes[file_hashes[old_files[document]]] = old_structure_hash
+                structure_hashes[file_hashes[new_files[document]]] = new_structure_hash
+    return [diffs[document] for document in documents]
+
+
+def load_structure_hashes(path: str) -> Dict[str, str]:
+    """ Returns the cached structure hashes, or an empty dictionary if there are none of the current version """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        cache = json.load(file)
+    if cache.get("version") != STRUCTURE_HASH_VERSION:
+        return {}
+    return cache.get("structure_hashes", {})
+
+
+def save_structure_hashes(path: str, structure_hashes: Dict[str, str]) -> None:
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w") as file:
+        json.dump({"version": STRUCTURE_HASH_VERSION, "structure_hashes": structure_hashes}, file)
+    os.replace(temporary_path, path)
+
+
+def sum_diffs(diffs: Sequence[DocumentDiff]) -> Dict[str, collections.Counter]:
+    totals = {field: collections.Counter() for field in ("nodes", "class_mapping", "split_classes",
+                                                         "dropped_classes", "added_classes", "added_edges",
+                                                         "removed_edges")}
+    for diff in diffs:
+        for field, total in totals.items():
+            total.update(getattr(diff, field))
+    return totals
+
+
+def format_key(key) -> str:
+    if isinstance(key, tuple):
+        return " -> ".join(map(str, key))
+    return str(key)
+
+
+def print_histogram(title: str, histogram: collections.Counter, top: int) -> None:
+    if not histogram:
+        return
+    print("{0} ({1} in total):".format(title, sum(histogram.values())))
+    for key, count in histogram.most_common(top):
+        print("{0:>9}  {1}".format(count, format_key(key)))
+    if len(histogram) > top:
+        print("           ... and {0} more".format(len(histogram) - top))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compares the annotations of two dataset versions, e.g., v1.0 and '
+                                                 'v2.0, and reports renamed, split, dropped and added nodes and the '
+                                                 'changed links')
+    parser.add_argument('old_directory', type=str,
+                        help='Dataset directory of the old version, or the directory of its annotation files')
+    parser.add_argument('new_directory', type=str,
+                        help='Dataset directory of the new version, or the directory of its annotation files')
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Number of processes that compare documents in parallel.")
+    parser.add_argument("--top", type=int, default=20,
+                        help="Number of entries that are listed for each histogram.")
+    parser.add_argument("--hash_cache_file", type=str, default=".structure_hashes.json",
+                        help="JSON file, where the structure hashes of parsed files are cached, so documents "
+                             "whose files were already compared are not parsed again. Empty to disable it.")
+    parser.add_argument("--report_file", type=str, default=None,
+                        help="JSON file, where the totals and the differences of every document should be written to.")
+
+    flags = parser.parse_args()
+
+    start = time.perf_counter()
+    structure_hashes = load_structure_hashes(flags.hash_cache_file) if flags.hash_cache_file else {}
+    diffs = diff_corpora(find_annotations_directory(flags.old_directory),
+                         find_annotations_directory(flags.new_directory), flags.workers, structure_hashes)
+    if flags.hash_cache_file:
+        save_structure_hashes(flags.hash_cache_file, structure_hashes)
+    duration = time.perf_counter() - start
+
+    totals = sum_diffs(diffs)
+    statuses = collections.Counter(diff.status for diff in diffs)
+    for diff in diffs:
+        if diff.status in ("only_old", "only_new"):
+            print("Document {0} exists only in the {1} version".format(diff.document, diff.status[len("only_"):]))
+    renamed_classes = collections.Counter({classes: count for classes, count in totals["class_mapping"].items()
+                                           if classes[0] != classes[1]})
+    print_histogram("Renamed nodes", renamed_classes, flags.top)
+    print_histogram("Nodes split off from existing nodes", totals["split_classes"], flags.top)
+    print_histogram("Dropped nodes", totals["dropped_classes"], flags.top)
+    print_histogram("Added nodes", totals["added_classes"], flags.top)
+    print_histogram("Removed edges", totals["removed_edges"], flags.top)
+    print_histogram("Added edges", totals["added_edges"], flags.top)
+
+    nodes = totals["nodes"]
+    print("Nodes: {0} matched ({1} renamed, {2} renumbered, {3} moved), {4} split off, {5} dropped, {6} added".format(
+        nodes["matched"], nodes["renamed"], nodes["renumbered"], nodes["moved"], nodes["split"], nodes["dropped"],
+        nodes["added"]))
+    print("Edges: {0} removed, {1} added".format(sum(totals["removed_edges"].values()),
+                                                 sum(totals["added_edges"].values())))
+    print("Compared {0} documents in {1:.2f} s: {2} changed, {3} unchanged, {4} identical files".format(
+        len(diffs), duration, statuses["changed"], statuses["unchanged"], statuses["identical"]))
+
+    if flags.report_file is not None:
+        with open(flags.report_file, "w") as file:
+            json.dump({"totals": {field: [[format_key(key), count] for key, count in total.most_common()]
+                                  for field, total in totals.items()},
+                       "documents": [{"document": diff.document, "status": diff.status,
+                                      "nodes": dict(diff.nodes),
+                                      "class_mapping": [[format_key(k), c] for k, c in diff.class_mapping.items()
+                                                        if k[0] != k[1]],
+                                      "split_classes": [[format_key(k), c] for k, c in diff.split_classes.items()],
+                                      "dropped_ids": diff.dropped_ids, "added_ids": diff.added_ids,
+                                      "removed_edges": [[format_key(k), c] for k, c in diff.removed_edges.items()],
+                                      "added_edges": [[format_key(k), c] for k, c in diff.added_edges.items()]}
+                                     for diff in diffs]}, file, indent=4)
@@ -0,0 +1,298 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+from typing import Collection, Dict, List, NamedTuple, Optional, Tuple
+from xml.etree.ElementTree import parse
+
+import numpy
+
+from corpus_cache import AnnotationCorpus, compile_corpus, is_replaceable_directory
+from notation_graph import NotationGraph, expand_ranges
+from training_records import read_testset
+
+INDEX_FORMAT_VERSION = 1
+MANIFEST_FILE_NAME = "manifest.json"
+MANIFEST_KEYS = ("version", "class_names", "documents", "sources")
+STATISTICS_FILE_NAME = "statistics.json"
+DOCUMENT_NAME_FORMAT = "CVC-MUSCIMA_W-{0}_N-{1}_D-ideal"
+BOX_PERCENTILES = (5, 25, 50, 75, 95)
+
+
+class NodeMatches(NamedTuple):
+    """ Nodes found in a ``ClassIndex``, ordered by their index in the corpus, so grouped by document """
+    document_indices: numpy.ndarray  # int32, index into the documents of the index
+    ids: numpy.ndarray  # int32, id of the node in its document
+    nodes: numpy.ndarray  # int64, index of the node in the corpus cache
+
+
+def read_image_list(image_list_path: str) -> Dict[str, Tuple[str, str]]:
+    """ Reads the CVC-MUSCIMA images the dataset was annotated on, one ``writer:page`` per line.
+
+    :returns: The writer and page of every document, keyed by the document name.
+    """
+    documents = {}
+    with open(image_list_path, "r") as file:
+        for line in file:
+            if line.strip():
+                writer, page = line.strip().split(":")
+                documents[DOCUMENT_NAME_FORMAT.format(writer, page)] = (writer, page)
+    return documents
+
+
+def read_class_groups(class_list_path: str) -> Dict[str, str]:
+    """ :returns: The group of every class of a class list, e.g. ``note-primitive`` for ``noteheadFull``,
+        whose group name is ``note-primitive/noteheadFull``. """
+    return {node_class.findtext("Name"): node_class.findtext("GroupName").split("/")[0]
+            for node_class in parse(class_list_path).getroot().iter("NodeClass")}
+
+
+def summarize_sizes(sizes: numpy.ndarray) -> Dict[str, float]:
+    percentiles = numpy.percentile(sizes, BOX_PERCENTILES)
+    summary = {"min": int(sizes.min()), "max": int(sizes.max()), "mean": round(float(sizes.mean()), 2)}
+    summary.update(("p{0}".format(p), float(value)) for p, value in zip(BOX_PERCENTILES, percentiles))
+    return summary
+
+
+def count_per_class(class_counts: numpy.ndarray, class_names: List[str]) -> Dict[str, int]:
+    return {class_names[code]: int(class_counts[code]) for code in numpy.flatnonzero(class_counts)}
+
+
+def compute_statistics(corpus: AnnotationCorpus, class_order: numpy.ndarray, class_offsets: numpy.ndarray,
+                       node_documents: numpy.ndarray, class_groups: Dict[str, str],
+                       image_list: Dict[str, Tuple[str, str]]) -> dict:
+    """ Computes the summary statistics of a corpus from its columns, grouped by class, class group,
+    writer and page. Classes missing from the class list have no group. """
+    class_names = corpus.class_names
+    number_of_classes = len(class_names)
+    class_codes = numpy.asarray(corpus.class_codes, dtype=numpy.int64)
+    widths = numpy.asarray(corpus.widths)[class_order]
+    heights = numpy.asarray(corpus.heights)[class_order]
+
+    # Nodes of every class in every document, the rows of all other breakdowns are sums of its rows
+    document_class_counts = numpy.bincount(node_documents * number_of_classes + class_codes,
+                                           minlength=len(corpus.documents) * number_of_classes
+                                           ).reshape(len(corpus.documents), number_of_classes)
+    group_names = sorted(set(class_groups.get(c) for c in class_names if c in class_groups))
+    group_codes = numpy.array([group_names.index(class_groups[c]) if c in class_groups else len(group_names)
+                               for c in class_names], dtype=numpy.int64)
+
+    def breakdown(documents: List[int]) -> dict:
+        class_counts = document_class_counts[documents].sum(axis=0)
+        group_counts = numpy.bincount(group_codes, weights=class_counts, minlength=len(group_names) + 1)
+        return {"documents": len(documents), "nodes": int(class_counts.sum()),
+                "groups": {group: int(count) for group, count in zip(group_names, group_counts) if count > 0},
+                "classes": count_per_class(class_counts, class_names)}
+
+    classes = {}
+    for code, class_name in enumerate(class_names):
+        start, end = class_offsets[code], class_offsets[code + 1]
+        classes[class_name] = {"group": class_groups.get(class_name), "count": int(end - start),
+                               "documents": int(numpy.count_nonzero(document_class_counts[:, code])),
+                               "width": summarize_sizes(widths[start:end]),
+                               "height": summarize_sizes(heights[start:end])}
+
+    groups = {}
+    for group_code, group in enumerate(group_names):
+        group_classes = [class_names[code] for code in numpy.flatnonzero(group_codes == group_code)]
+        groups[group] = {"count": sum(classes[c]["count"] for c in group_classes), "classes": group_classes}
+
+    writers = {}  # type: Dict[str, List[int]]
+    pages = {}  # type: Dict[str, List[int]]
+    unlisted_documents = []
+    for document_index, document in enumerate(corpus.documents):
+        if document not in image_list:
+            unlisted_documents.append(document)
+            continue
+        writer, page = image_list[document]
+        writers.setdefault(writer, []).append(document_index)
+        pages.setdefault(page, []).append(document_index)
+
+    graph = NotationGraph(corpus)
+    link_offsets, link_targets = graph.adjacency("out")
+    link_sources = numpy.repeat(numpy.arange(len(corpus), dtype=numpy.int64), numpy.diff(link_offsets))
+    link_counts = numpy.bincount(class_codes[link_sources] * number_of_classes + class_codes[link_targets],
+                                 minlength=number_of_classes * number_of_classes)
+    link_pairs = numpy.flatnonzero(link_counts)
+    link_pairs = link_pairs[numpy.argsort(-link_counts[link_pairs], kind="stable")]
+
+    return {"totals": {"documents": len(corpus.documents), "nodes": len(corpus), "classes": number_of_classes,
+                       "links": len(link_targets), "unresolved_links": graph.unresolved_links},
+            "groups": groups,
+            "classes": classes,
+            "writers": {writer: breakdown(documents) for writer, documents in sorted(writers.items())},
+            "pages": {page: breakdown(documents) for page, documents in sorted(pages.items())},
+            "unlisted_documents": unlisted_documents,
+            "links": [{"from": class_names[pair // number_of_classes], "to": class_names[pair % number_of_classes],
+                       "count": int(link_counts[pair])} for pair in link_pairs],
+            }
+
+
+def build_index(corpus: AnnotationCorpus, index_directory: str, class_groups: Dict[str, str],
+                image_list: Dict[str, Tuple[str, str]]) -> bool:
+    """ Writes the inverted index from every class to its nodes and the statistics of the corpus into the
+    index directory. Both are derived from the columns of the compiled corpus in one pass, documents are
+    only parsed when they changed since the corpus was last compiled. If neither the documents nor the
+    class list or the image list changed since the index was built, it is left as it is.
+
+    :returns: Whether the index was rebuilt.
+    """
+    sources = {"documents": {document["name"]: document["hash"] for document in corpus.manifest["documents"]},
+               "class_groups": class_groups,
+               "image_list": {document: list(writer_page) for document, writer_page in image_list.items()}}
+    if not is_replaceable_directory(index_directory, MANIFEST_FILE_NAME, MANIFEST_KEYS):
+        raise ValueError("{0} is not a class index and is not empty, refusing to replace it".format(index_directory))
+    manifest_path = os.path.join(index_directory, MANIFEST_FILE_NAME)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as file:
+            previous_manifest = json.load(file)
+        if previous_manifest.get("version") == INDEX_FORMAT_VERSION and previous_manifest["sources"] == sources:
+            return False
+
+    class_order = numpy.argsort(corpus.class_codes, kind="stable")
+    class_offsets = numpy.searchsorted(numpy.asarray(corpus.class_codes)[class_order],
+                                       numpy.arange(len(corpus.class_names) + 1)).astype(numpy.int64)
+    node_documents = numpy.repeat(numpy.arange(len(corpus.documents), dtype=numpy.int64),
+                                  numpy.diff(corpus.document_offsets))
+    statistics = compute_statistics(corpus, class_order, class_offsets, node_documents, class_groups, image_list)
+
+    temporary_directory = tempfile.mkdtemp(prefix=os.path.basename(os.path.normpath(index_directory)) + ".",
+                                           dir=os.path.dirname(os.path.abspath(index_directory)))
+    numpy.save(os.path.join(temporary_directory, "class_offsets.npy"), class_offsets)
+    numpy.save(os.path.join(temporary_directory, "nodes.npy"), class_order.astype(numpy.int64))
+    numpy.save(os.path.join(temporary_directory, "node_documents.npy"),
+               node_documents[class_order].astype(numpy.int32))
+    numpy.save(os.path.join(temporary_directory, "node_ids.npy"),
+               numpy.asarray(corpus.ids, dtype=numpy.int32)[class_order])
+    with open(os.path.join(temporary_directory, STATISTICS_FILE_NAME), "w") as file:
+        json.dump(statistics, file, indent=1)
+    manifest = {"version": INDEX_FORMAT_VERSION,
+                "class_names": corpus.class_names,
+                "documents": corpus.documents,
+                "sources": sources,
+                }
+    with open(os.path.join(temporary_directory, MANIFEST_FILE_NAME), "w") as file:
+        json.dump(manifest, file)
+
+    if os.path.exists(index_directory):
+        shutil.rmtree(index_directory)
+    os.replace(temporary_directory, index_directory)
+    return True
+
+
+class ClassIndex(object):
+    """ The inverted index of a corpus from every class to its nodes, written by ``build_index``.
+    The nodes of class i are at positions ``class_offsets[i]:class_offsets[i + 1]`` of the memory-mapped
+    node arrays, so finding all nodes of a class only reads these positions. """
+
+    def __init__(self, index_directory: str):
+        with open(os.path.join(index_directory, MANIFEST_FILE_NAME)) as file:
+            manifest = json.load(file)
+        if manifest["version"] != INDEX_FORMAT_VERSION:
+            raise ValueError("Class index in {0} has version {1}, expected {2}".format(
+                index_directory, manifest["version"], INDEX_FORMAT_VERSION))
+        self.class_names = manifest["class_names"]  # type: List[str]
+        self.documents = manifest["documents"]  # type: List[str]
+        self.__class_codes = {class_name: code for code, class_name in enumerate(self.class_names)}
+        self.__document_indices = {document: i for i, document in enumerate(self.documents)}
+        self.class_offsets = numpy.load(os.path.join(index_directory, "class_offsets.npy"))
+        self.nodes = numpy.load(os.path.join(index_directory, "nodes.npy"), mmap_mode="r")
+        self.node_documents = numpy.load(os.path.join(index_directory, "node_documents.npy"), mmap_mode="r")
+        self.node_ids = numpy.load(os.path.join(index_directory, "node_ids.npy"), mmap_mode="r")
+        self.statistics_path = os.path.join(index_directory, STATISTICS_FILE_NAME)
+
+    def count(self, class_name: str) -> int:
+        code = self.__class_codes.get(class_name)
+        return 0 if code is None else int(self.class_offsets[code + 1] - self.class_offsets[code])
+
+    def find(self, class_names: Collection[str], documents: Optional[Collection[str]] = None) -> NodeMatches:
+        """ Finds all nodes of the given classes, e.g. all ``accidentalDoubleFlat`` in the test set.
+        Unknown classes and documents are ignored.
+
+        :param documents: Only nodes of these documents are returned, by default the nodes of all documents.
+        """
+        codes = numpy.array(sorted(self.__class_codes[c] for c in set(class_names) if c in self.__class_codes),
+                            dtype=numpy.int64)
+        positions = expand_ranges(self.class_offsets[codes], self.class_offsets[codes + 1] - self.class_offsets[codes])
+        if documents is not None:
+            document_indices = [self.__document_indices[d] for d in documents if d in self.__document_indices]
+            positions = positions[numpy.isin(self.node_documents[positions], document_indices)]
+        positions = positions[numpy.argsort(self.nodes[positions], kind="stable")]
+        return NodeMatches(self.node_documents[positions], self.node_ids[positions], self.nodes[positions])
+
+    def read_statistics(self) -> dict:
+        with open(self.statistics_path) as file:
+            return json.load(file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Builds the inverted index from every class to its nodes and '
+                                                 'the summary statistics of a dataset, and answers queries for '
+                                                 'the nodes of classes')
+    parser.add_argument('--source_directory', type=str, default="v2.0",
+                        help='Directory of the MUSCIMA++ dataset v2.0 or newer')
+    parser.add_argument("--cache_directory", type=str, default=None,
+                        help="Directory of the compiled corpus cache, see corpus_cache.py. "
+                             "Defaults to data/corpus_cache inside of the source directory.")
+    parser.add_argument("--index_directory", type=str, default=None,
+                        help="Directory of the class index and the statistics. "
+                             "Defaults to data/class_index inside of the source directory.")
+    parser.add_argument('--class_list_file', type=str, default=None,
+                        help='List of classes, which defines the class groups, by default '
+                             'specifications/mff-muscima-mlclasses-annot.xml of the source directory')
+    parser.add_argument('--image_list_file', type=str, default=None,
+                        help='List of the writer and page of every document, by default '
+                             'specifications/cvc-muscima-image-list.txt of the source directory')
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Number of processes that parse changed annotation files in parallel.")
+    parser.add_argument("--query_class", type=str, nargs="+", default=None,
+                        help="Lists all nodes of these classes, e.g. accidentalDoubleFlat.")
+    parser.add_argument("--testset", type=str, default=None, choices=["independent", "dependent"],
+                        help="Restricts the query to the documents of the writer-independent or the "
+                             "writer-dependent test set.")
+
+    flags = parser.parse_args()
+    specifications_directory = os.path.join(flags.source_directory, "specifications")
+    annotations_directory = os.path.join(flags.source_directory, "data/annotations")
+    cache_directory = flags.cache_directory or os.path.join(flags.source_directory, "data/corpus_cache")
+    index_directory = flags.index_directory or os.path.join(flags.source_directory, "data/class_index")
+    class_list_file = flags.class_list_file or os.path.join(specifications_directory,
+                                                            "mff-muscima-mlclasses-annot.xml")
+    image_list_file = flags.image_list_file or os.path.join(specifications_directory, "cvc-muscima-image-list.txt")
+
+    start = time.perf_counter()
+    corpus = compile_corpus(annotations_directory, cache_directory, flags.workers)
+    rebuilt = build_index(corpus, index_directory, read_class_groups(class_list_file),
+                          read_image_list(image_list_file))
+    print("{0} class index in {1:.1f} ms".format("Built" if rebuilt else "Reused",
+                                                (time.perf_counter() - start) * 1000))
+
+    index = ClassIndex(index_directory)
+    statistics = index.read_statistics()
+    totals = statistics["totals"]
+    print("{0} nodes of {1} classes in {2} documents by {3} writers on {4} pages, {5} links".format(
+        totals["nodes"], totals["classes"], totals["documents"], len(statistics["writers"]),
+        len(statistics["pages"]), totals["links"]))
+    for group, group_statistics in sorted(statistics["groups"].items(), key=lambda item: -item[1]["count"]):
+        print("{0:<20} {1:>8} nodes of {2} classes".format(group, group_statistics["count"],
+                                                           len(group_statistics["classes"])))
+    if statistics["unlisted_documents"]:
+        print("Documents missing from the image list: {0}".format(", ".join(statistics["unlisted_documents"])))
+
+    if flags.query_class:
+        query_documents = None
+        if flags.testset is not None:
+            query_documents = read_testset(os.path.join(specifications_directory,
+                                                        "testset-{0}.txt".format(flags.testset)))
+        start = time.perf_counter()
+        matches = index.find(flags.query_class, query_documents)
+        duration = time.perf_counter() - start
+        print("{0} nodes of {1} found in {2:.2f} ms".format(len(matches.ids), ", ".join(flags.query_class),
+                                                            duration * 1000))
+        document_indices, counts = numpy.unique(matches.document_indices, return_counts=True)
+        for document_index, count in zip(document_indices, counts):
+            document_ids = matches.ids[matches.document_indices == document_index]
+            print("{0:<35} {1:>5}: {2}".format(index.documents[document_index], count,
+                                               " ".join(str(i) for i in document_ids)))
@@ -0,0 +1,250 @@
+import argparse
+import collections
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from fnmatch import fnmatchcase
+from typing import Dict, List, NamedTuple, Sequence, Tuple
+from xml.etree.ElementTree import parse
+
+import numpy
+
+from annotation_reader import iterate_nodes
+
+MAX_CARDINALITY = 10000
+NO_RULE = -1
+# The annotations of v2.0 and newer, and of v1.0
+ANNOTATION_SUBDIRECTORIES = ("data/annotations", "data/cropobjects_withstaff")
+
+
+class Violation(NamedTuple):
+    rule: str
+    document: str
+    node_id: int
+    detail: str
+
+
+class CompiledGrammar(object):
+    """ The rules of a ``.deprules`` file as lookup tables indexed by class codes. Wildcards are expanded
+    against the class list once, when the grammar is compiled. Every table has an extra last row (and column)
+    for classes that are not in the class list, so nodes of unknown classes need no special treatment.
+
+    Like ``mung.grammar.DependencyGrammar``, only the aggregate cardinalities (``noteheadFull{1,} |`` and
+    ``| stem{1,}``) are checked, cardinalities given for single class pairs are ignored. """
+
+    def __init__(self, class_names: Sequence[str]):
+        self.class_names = list(class_names)
+        self.class_codes = {class_name: code for code, class_name in enumerate(self.class_names)}
+        self.rules = []  # type: List[str]
+        self.unknown_class_names = collections.defaultdict(list)  # type: Dict[str, List[int]]
+
+        number_of_classes = len(self.class_names) + 1
+        # The index of the first rule that allows an edge between two classes
+        self.edge_rules = numpy.full((number_of_classes, number_of_classes), NO_RULE, dtype=numpy.int32)
+        self.inlink_cardinalities = numpy.tile(numpy.array([0, MAX_CARDINALITY], dtype=numpy.int64),
+                                               (number_of_classes, 1))
+        self.outlink_cardinalities = self.inlink_cardinalities.copy()
+        self.inlink_cardinality_rules = numpy.full(number_of_classes, NO_RULE, dtype=numpy.int32)
+        self.outlink_cardinality_rules = numpy.full(number_of_classes, NO_RULE, dtype=numpy.int32)
+
+    def unknown_class_code(self) -> int:
+        return len(self.class_names)
+
+    def expand(self, pattern: str, line_number: int) -> List[int]:
+        """ Returns the codes of all classes that match a class name with wildcards, such as ``notehead*`` """
+        if "*" in pattern:
+            return [code for code, class_name in enumerate(self.class_names) if fnmatchcase(class_name, pattern)]
+        if pattern not in self.class_codes:
+            self.unknown_class_names[pattern].append(line_number)
+            return []
+        return [self.class_codes[pattern]]
+
+    def classify(self, class_names: Sequence[str]) -> numpy.ndarray:
+        unknown_class_code = self.unknown_class_code()
+        return numpy.array([self.class_codes.get(class_name, unknown_class_code) for class_name in class_names],
+                           dtype=numpy.int64)
+
+
+def parse_token(token: str) -> Tuple[str, int, int]:
+    """ Splits a token such as ``notehead*{1,}`` into the class name pattern and its cardinality """
+    if "{" not in token:
+        return token, 0, MAX_CARDINALITY
+    pattern, cardinality = token[:-1].split("{")
+    if "," not in cardinality:
+        return pattern, int(cardinality), int(cardinality)
+    minimum, maximum = cardinality.split(",")
+    return pattern, int(minimum) if minimum else 0, int(maximum) if maximum else MAX_CARDINALITY
+
+
+def read_class_names(class_list_path: str) -> List[str]:
+    return [name.text for name in parse(class_list_path).getroot().iter("Name")]
+
+
+def compile_grammar(grammar_path: str, class_names: Sequence[str]) -> CompiledGrammar:
+    """ Reads a ``.deprules`` file the same way ``mung.grammar.DependencyGrammar`` does: only lines
+    with a ``|`` that are not comments are rules. """
+    grammar = CompiledGrammar(class_names)
+    with open(grammar_path, "r", encoding="utf-8") as file:
+        for line_number, line in enumerate(file, start=1):
+            line = line.strip()
+            if not line or line.startswith("#") or "|" not in line:
+                continue
+            rule = len(grammar.rules)
+            grammar.rules.append("line {0}: {1}".format(line_number, line))
+            left_hand_side, right_hand_side = line.split("|", 1)
+            left_tokens = [parse_token(token) for token in left_hand_side.split()]
+            right_tokens = [parse_token(token) for token in right_hand_side.split()]
+
+            if not right_tokens:
+                for pattern, minimum, maximum in left_tokens:
+                    codes = grammar.expand(pattern, line_number)
+                    grammar.outlink_cardinalities[codes] = (minimum, maximum)
+                    grammar.outlink_cardinality_rules[codes] = rule
+            elif not left_tokens:
+                for pattern, minimum, maximum in right_tokens:
+                    codes = grammar.expand(pattern, line_number)
+                    grammar.inlink_cardinalities[codes] = (minimum, maximum)
+                    grammar.inlink_cardinality_rules[codes] = rule
+            else:
+                left_codes = [code for pattern, _, _ in left_tokens for code in grammar.expand(pattern, line_number)]
+                right_codes = [code for pattern, _, _ in right_tokens for code in grammar.expand(pattern, line_number)]
+                allowed_edges = grammar.edge_rules[numpy.ix_(left_codes, right_codes)]
+                allowed_edges[allowed_edges == NO_RULE] = rule
+                grammar.edge_rules[numpy.ix_(left_codes, right_codes)] = allowed_edges
+    return grammar
+
+
+def validate_document(annotation_file_path: str, grammar: CompiledGrammar) -> Tuple[int, List[Violation]]:
+    """ Checks all nodes and edges of a document in a single pass over its nodes.
+
+    :returns: The number of nodes in the document and all violations of the grammar.
+    """
+    document = os.path.basename(annotation_file_path)
+    ids, class_names, sources, targets = [], [], [], []
+    for record in iterate_nodes(annotation_file_path, fields=["links"]):
+        ids.append(record.id)
+        class_names.append(record.class_name)
+        sources.extend([record.id] * len(record.outlinks))
+        targets.extend(record.outlinks)
+
+    ids = numpy.array(ids, dtype=numpy.int64)
+    codes = grammar.classify(class_names)
+    violations = []  # type: List[Violation]
+    for position in numpy.flatnonzero(codes == grammar.unknown_class_code()):
+        violations.append(Violation("class {0} is not in the class list".format(class_names[position]),
+                                    document, int(ids[position]), ""))
+
+    if len(ids) == 0:
+        return 0, violations
+
+    # Edges are identified by positions of the nodes in the document, duplicate edges are counted once
+    order = numpy.argsort(ids, kind="stable")
+    edges = numpy.unique(numpy.array([sources, targets], dtype=numpy.int64).reshape(2, -1), axis=1)
+    positions = order[numpy.minimum(numpy.searchsorted(ids, edges, sorter=order), len(ids) - 1)]
+    resolved = ids[positions[1]] == edges[1]
+    for source, target in edges[:, ~resolved].T:
+        violations.append(Violation("links to missing nodes", document, int(source),
+                                    "outlink to {0}".format(target)))
+    source_positions, target_positions = positions[:, resolved]
+
+    edge_rules = grammar.edge_rules[codes[source_positions], codes[target_positions]]
+    for source, target in zip(source_positions[edge_rules == NO_RULE], target_positions[edge_rules == NO_RULE]):
+        violations.append(Violation("no rule for {0} | {1}".format(class_names[source], class_names[target]),
+                                    document, int(ids[source]), "outlink to {0}".format(ids[target])))
+
+    for direction, degrees, cardinalities, cardinality_rules in [
+        ("outlinks", numpy.bincount(source_positions, minlength=len(ids)), grammar.outlink_cardinalities,
+         grammar.outlink_cardinality_rules),
+        ("inlinks", numpy.bincount(target_positions, minlength=len(ids)), grammar.inlink_cardinalities,
+         grammar.inlink_cardinality_rules)]:
+        minimums, maximums = cardinalities[codes].T
+        for position in numpy.flatnonzero((degrees < minimums) | (degrees > maximums)):
+            violations.append(Violation(grammar.rules[cardinality_rules[codes[position]]], document,
+                                        int(ids[position]), "{0} {1} of {2} {3}".format(
+                                            degrees[position], direction, class_names[position],
+                                            format_cardinality(minimums[position], maximums[position]))))
+    return len(ids), violations
+
+
+def format_cardinality(minimum: int, maximum: int) -> str:
+    if maximum == MAX_CARDINALITY:
+        return "(expected at least {0})".format(minimum)
+    return "(expected {0} to {1})".format(minimum, maximum)
+
+
+def validate_corpus(annotation_file_paths: Sequence[str], grammar: CompiledGrammar,
+                    workers: int) -> Tuple[int, List[Violation]]:
+    with ProcessPoolExecutor(max_workers=max(1, workers)) as executor:
+        results = list(executor.map(validate_document, annotation_file_paths,
+                                    [grammar] * len(annotation_file_paths)))
+    number_of_nodes = sum(nodes for nodes, _ in results)
+    return number_of_nodes, [violation for _, violations in results for violation in violations]
+
+
+def group_by_rule(violations: Sequence[Violation]) -> Dict[str, List[Violation]]:
+    """ Groups the violations by the rule they violate, the most violated rule first """
+    violations_by_rule = collections.defaultdict(list)  # type: Dict[str, List[Violation]]
+    for violation in violations:
+        violations_by_rule[violation.rule].append(violation)
+    return dict(sorted(violations_by_rule.items(), key=lambda item: (-len(item[1]), item[0])))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Validates the links of all annotations against the '
+                                                 'dependency grammar and reports the violations of each rule')
+    parser.add_argument('--source_directory', type=str, default="v2.0",
+                        help='Directory of a MUSCIMA++ dataset, the annotations are read from data/annotations '
+                             'or, for v1.0, from data/cropobjects_withstaff')
+    parser.add_argument('--grammar_file', type=str, default=None,
+                        help='Dependency grammar, by default specifications/mff-muscima-mlclasses-annot.deprules '
+                             'of the source directory')
+    parser.add_argument('--class_list_file', type=str, default=None,
+                        help='List of classes the wildcards of the grammar are expanded against, by default '
+                             'specifications/mff-muscima-mlclasses-annot.xml of the source directory')
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Number of processes that validate files in parallel.")
+    parser.add_argument("--examples", type=int, default=3,
+                        help="Number of violations that are listed for each rule.")
+    parser.add_argument("--report_file", type=str, default=None,
+                        help="JSON file, where all violations should be written to, grouped by rule.")
+
+    flags = parser.parse_args()
+
+    specifications_directory = os.path.join(flags.source_directory, "specifications")
+    grammar_file = flags.grammar_file or os.path.join(specifications_directory, "mff-muscima-mlclasses-annot.deprules")
+    class_list_file = flags.class_list_file or os.path.join(specifications_directory,
+                                                            "mff-muscima-mlclasses-annot.xml")
+    annotations_directories = [os.path.join(flags.source_directory, subdirectory)
+                               for subdirectory in ANNOTATION_SUBDIRECTORIES]
+    annotations_directory = next((d for d in annotations_directories if os.path.isdir(d)), None)
+    if annotations_directory is None:
+        parser.error("None of {0} exists".format(", ".join(annotations_directories)))
+    for required_file in (grammar_file, class_list_file):
+        if not os.path.isfile(required_file):
+            parser.error("{0} does not exist".format(required_file))
+
+    start = time.perf_counter()
+    grammar = compile_grammar(grammar_file, read_class_names(class_list_file))
+    for class_name, line_numbers in sorted(grammar.unknown_class_names.items()):
+        print("Grammar refers to class {0}, which is not in the class list (lines {1})".format(
+            class_name, ", ".join(map(str, line_numbers))))
+
+    annotation_files = [os.path.join(annotations_directory, annotation_file)
+                        for annotation_file in sorted(os.listdir(annotations_directory))
+                        if annotation_file.endswith(".xml")]
+    number_of_nodes, violations = validate_corpus(annotation_files, grammar, flags.workers)
+    duration = time.perf_counter() - start
+
+    violations_by_rule = group_by_rule(violations)
+    for rule, rule_violations in violations_by_rule.items():
+        print("{0:>7}  {1}".format(len(rule_violations), rule))
+        for violation in rule_violations[:flags.examples]:
+            print("         {0}, node {1} {2}".format(violation.document, violation.node_id, violation.detail))
+    print("Found {0} violations of {1} rules in {2} nodes of {3} documents in {4:.2f} s".format(
+        len(violations), len(violations_by_rule), number_of_nodes, len(annotation_files), duration))
+
+    if flags.report_file is not None:
+        with open(flags.report_file, "w") as file:
+            json.dump({rule: [violation._asdict() for violation in rule_violations]
+                       for rule, rule_violations in violations_by_rule.items()}, file, indent=4)
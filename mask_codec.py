@@ -0,0 +1,156 @@
+from typing import List, Optional, Sequence, Tuple
+
+import numpy
+
+POWERS_OF_TEN = 10 ** numpy.arange(19, dtype=numpy.int64)
+
+
+def parse_run_text(text: str) -> numpy.ndarray:
+    """ Parses runs like ``0:15 1:10 0:14`` into the integers ``0 15 1 10 0 14``. Raises a ValueError
+    for anything else than pairs of integers, separated by a colon, with a single space between pairs. """
+    characters = numpy.frombuffer(text.encode("ascii", errors="replace"), dtype=numpy.uint8)
+    if len(characters) == 0:
+        return numpy.zeros(0, dtype=numpy.int64)
+    separators = numpy.flatnonzero((characters == ord(":")) | (characters == ord(" ")))
+    is_digit = (characters >= ord("0")) & (characters <= ord("9"))
+    token_starts = numpy.concatenate(([0], separators + 1))
+    token_lengths = numpy.concatenate((separators, [len(characters)])) - token_starts
+    if len(separators) + numpy.count_nonzero(is_digit) != len(characters) or len(separators) % 2 == 0 \
+            or token_lengths.min() == 0 or token_lengths.max() >= len(POWERS_OF_TEN) \
+            or numpy.any(characters[separators[0::2]] != ord(":")) \
+            or numpy.any(characters[separators[1::2]] != ord(" ")):
+        raise ValueError("Masks are not run-length encoded: {0}...".format(text[:50]))
+
+    # The value of every digit is its place value in its integer, the integers are the sums of these values
+    digit_positions = numpy.flatnonzero(is_digit)
+    exponents = numpy.repeat(token_starts + token_lengths, token_lengths) - digit_positions - 1
+    place_values = POWERS_OF_TEN[exponents] * (characters[digit_positions] - ord("0"))
+    return numpy.add.reduceat(place_values, numpy.cumsum(token_lengths) - token_lengths)
+
+
+def parse_runs(mask_strings: Sequence[str]) -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+    """ Parses many run-length encoded masks, such as ``0:15 1:10 0:14``, at once.
+
+    :returns: The values and lengths of all runs of all masks concatenated, and the offsets
+        of the runs of each mask, i.e., the runs of mask i are ``run_offsets[i]:run_offsets[i + 1]``.
+    """
+    runs_per_mask = numpy.array([mask_string.count(":") for mask_string in mask_strings], dtype=numpy.int64)
+    run_offsets = numpy.zeros(len(mask_strings) + 1, dtype=numpy.int64)
+    numpy.cumsum(runs_per_mask, out=run_offsets[1:])
+
+    runs = parse_run_text(" ".join(mask_string for mask_string in mask_strings if mask_string))
+    if len(runs) != 2 * run_offsets[-1]:
+        raise ValueError("Masks are not run-length encoded")
+    runs = runs.reshape(-1, 2)
+    return runs[:, 0], runs[:, 1], run_offsets
+
+
+def is_canonical(values: numpy.ndarray, lengths: numpy.ndarray, run_offsets: numpy.ndarray) -> numpy.ndarray:
+    """ Checks for each mask whether it is written exactly the way ``encode_masks`` would write it:
+    runs alternate between 0 and 1, starting with a run of zeros, and only that first run may be empty. """
+    runs_per_mask = numpy.diff(run_offsets)
+    run_index_in_mask = numpy.arange(len(values)) - numpy.repeat(run_offsets[:-1], runs_per_mask)
+    valid_runs = (values == run_index_in_mask % 2) & ((lengths > 0) | (run_index_in_mask == 0))
+    invalid_runs_per_mask = numpy.add.reduceat(~valid_runs, run_offsets[:-1]) if len(values) > 0 \
+        else numpy.zeros(len(runs_per_mask), dtype=numpy.int64)
+    return (invalid_runs_per_mask == 0) | (runs_per_mask == 0)
+
+
+def decode_runs(values: numpy.ndarray, lengths: numpy.ndarray, run_offsets: numpy.ndarray,
+                shapes: Sequence[Tuple[int, int]]) -> List[numpy.ndarray]:
+    """ Expands parsed runs into one uint8 array per mask. All pixels are expanded with a single
+    ``numpy.repeat``, the returned masks are views into that buffer. """
+    pixels = numpy.repeat(values.astype(numpy.uint8), lengths)
+    sizes = numpy.array([height * width for height, width in shapes], dtype=numpy.int64)
+    if len(lengths) > 0:
+        pixels_per_mask = numpy.add.reduceat(lengths, numpy.minimum(run_offsets[:-1], len(lengths) - 1))
+        pixels_per_mask[numpy.diff(run_offsets) == 0] = 0
+    else:
+        pixels_per_mask = numpy.zeros(len(shapes), dtype=numpy.int64)
+    wrong_sizes = numpy.flatnonzero(pixels_per_mask != sizes)
+    if len(wrong_sizes) > 0:
+        raise ValueError("Mask {0} has {1} pixels, but its shape is {2}".format(
+            wrong_sizes[0], pixels_per_mask[wrong_sizes[0]], shapes[wrong_sizes[0]]))
+
+    masks = numpy.split(pixels, numpy.cumsum(sizes)[:-1])
+    return [mask.reshape(shape) for mask, shape in zip(masks, shapes)]
+
+
+def decode_mask(mask_string: str, shape: Tuple[int, int]) -> Optional[numpy.ndarray]:
+    """ Decodes a single ``<Mask>`` text. For many masks at once, ``decode_masks`` is faster. """
+    if mask_string == "None":
+        return None
+    runs = parse_run_text(mask_string)
+    mask = numpy.repeat(runs[0::2].astype(numpy.uint8), runs[1::2])
+    if len(mask) != shape[0] * shape[1]:
+        raise ValueError("Mask {0}... does not match the shape {1}".format(mask_string[:50], shape))
+    return mask.reshape(shape)
+
+
+def decode_masks(mask_strings: Sequence[str], shapes: Sequence[Tuple[int, int]]) -> List[Optional[numpy.ndarray]]:
+    """ Decodes the ``<Mask>`` texts of many nodes, e.g., of a whole document, into 2D uint8 arrays.
+    Masks given as ``None`` are decoded as None, like ``Node.decode_mask`` does. """
+    present = [i for i, mask_string in enumerate(mask_strings) if mask_string != "None"]
+    values, lengths, run_offsets = parse_runs([mask_strings[i] for i in present])
+    decoded_masks = decode_runs(values, lengths, run_offsets, [shapes[i] for i in present])
+
+    masks = [None] * len(mask_strings)  # type: List[Optional[numpy.ndarray]]
+    for i, mask in zip(present, decoded_masks):
+        masks[i] = mask
+    return masks
+
+
+def canonicalize_masks(mask_strings: Sequence[str], shapes: Sequence[Tuple[int, int]]) -> List[str]:
+    """ Returns the masks the way ``encode_masks`` would write them after decoding them. Masks that
+    are canonical already are returned as they are, without decoding them. """
+    present = [i for i, mask_string in enumerate(mask_strings) if mask_string != "None"]
+    values, lengths, run_offsets = parse_runs([mask_strings[i] for i in present])
+    canonical = is_canonical(values, lengths, run_offsets)
+
+    canonical_mask_strings = list(mask_strings)
+    other_masks = [i for i, mask_is_canonical in zip(present, canonical) if not mask_is_canonical]
+    if other_masks:
+        masks = decode_masks([mask_strings[i] for i in other_masks], [shapes[i] for i in other_masks])
+        for i, mask_string in zip(other_masks, encode_masks(masks)):
+            canonical_mask_strings[i] = mask_string
+    return canonical_mask_strings
+
+
+def encode_masks(masks: Sequence[Optional[numpy.ndarray]]) -> List[str]:
+    """ Encodes many masks into exactly the same text as ``Node.encode_mask_rle`` does for each of them.
+    Run boundaries of all masks are found in one pass over the concatenated pixels. """
+    present = [i for i, mask in enumerate(masks) if mask is not None]
+    flat_masks = [numpy.ravel(masks[i]) for i in present]
+    sizes = numpy.array([len(flat_mask) for flat_mask in flat_masks], dtype=numpy.int64)
+    mask_starts = numpy.zeros(len(present) + 1, dtype=numpy.int64)
+    numpy.cumsum(sizes, out=mask_starts[1:])
+
+    encoded_masks = ["None"] * len(masks)
+    if len(present) == 0:
+        return encoded_masks
+    pixels = numpy.concatenate(flat_masks)
+    if pixels.dtype == bool:
+        pixels = pixels.view(numpy.uint8)
+
+    is_run_start = numpy.ones(len(pixels), dtype=bool)
+    is_run_start[1:] = pixels[1:] != pixels[:-1]
+    is_run_start[mask_starts[:-1][sizes > 0]] = True
+    run_starts = numpy.flatnonzero(is_run_start)
+    run_ends = numpy.append(run_starts[1:], len(pixels))
+    values = pixels[run_starts].astype(numpy.int64)
+    lengths = run_ends - run_starts
+
+    # Every mask starts with a run of zeros, which is empty if the first pixel is not zero
+    first_runs = numpy.searchsorted(run_starts, mask_starts[:-1])
+    first_values = values[numpy.minimum(first_runs, len(values) - 1)] if len(values) > 0 else numpy.zeros_like(sizes)
+    needs_empty_zero_run = (sizes == 0) | (first_values != 0)
+    values = numpy.insert(values, first_runs[needs_empty_zero_run], 0)
+    lengths = numpy.insert(lengths, first_runs[needs_empty_zero_run], 0)
+    runs_per_mask = numpy.diff(numpy.append(first_runs, len(run_starts))) + needs_empty_zero_run
+    run_offsets = numpy.zeros(len(present) + 1, dtype=numpy.int64)
+    numpy.cumsum(runs_per_mask, out=run_offsets[1:])
+
+    tokens = numpy.char.add(numpy.char.add(values.astype(str), ":"), lengths.astype(str)).tolist()
+    for i, start, end in zip(present, run_offsets[:-1].tolist(), run_offsets[1:].tolist()):
+        encoded_masks[i] = " ".join(tokens[start:end])
+    return encoded_masks
@@ -0,0 +1,222 @@
+import argparse
+import os
+import time
+from typing import Collection, List, Optional, Tuple
+
+import numpy
+
+from corpus_cache import AnnotationCorpus, compile_corpus
+
+NOTEHEAD_CLASS_NAMES = frozenset(["noteheadFull", "noteheadHalf", "noteheadWhole", "noteheadFullSmall",
+                                  "noteheadHalfSmall"])
+STEM_FLAG_BEAM_CLASS_NAMES = frozenset(["stem", "beam", "flag8thUp", "flag8thDown", "flag16thUp", "flag16thDown",
+                                        "flag32ndUp", "flag32ndDown", "flag64thUp", "flag64thDown"])
+
+
+def expand_ranges(starts: numpy.ndarray, counts: numpy.ndarray) -> numpy.ndarray:
+    """ Concatenates ``arange(start, start + count)`` for all starts and counts without a Python loop """
+    total = int(counts.sum())
+    if total == 0:
+        return numpy.zeros(0, dtype=numpy.int64)
+    range_offsets = numpy.cumsum(counts) - counts
+    return numpy.repeat(starts - range_offsets, counts) + numpy.arange(total)
+
+
+class NotationGraph(object):
+    """ The notation graphs of all documents of a compiled corpus as one CSR adjacency over the global
+    node indices of the corpus (see ``AnnotationCorpus``), with an index of the nodes of each class.
+    Edges never cross documents, so every query over a set of nodes is answered for all their documents at once.
+
+    Opening the graph only maps the corpus, the adjacency is built from the links when it is first needed.
+    Links to ids that do not exist in a document are left out and counted in ``unresolved_links``. """
+
+    def __init__(self, corpus: AnnotationCorpus):
+        self.corpus = corpus
+        self.class_names = corpus.class_names
+        self.__class_codes = {class_name: code for code, class_name in enumerate(self.class_names)}
+        self.__adjacency = None  # type: Optional[dict]
+        self.__class_index = None  # type: Optional[Tuple[numpy.ndarray, numpy.ndarray]]
+        self.unresolved_links = 0
+
+    def __len__(self):
+        return len(self.corpus)
+
+    def __build_adjacency(self) -> dict:
+        corpus = self.corpus
+        node_documents = numpy.repeat(numpy.arange(len(corpus.documents), dtype=numpy.int64),
+                                      numpy.diff(corpus.document_offsets))
+        # Nodes are looked up by the pair of their document and id, packed into a single sortable key
+        keys = (node_documents << 32) | (numpy.asarray(corpus.ids, dtype=numpy.int64) & 0xFFFFFFFF)
+        key_order = numpy.argsort(keys, kind="stable")
+        sorted_keys = keys[key_order]
+
+        sources = numpy.repeat(numpy.arange(len(corpus), dtype=numpy.int64), numpy.diff(corpus.outlink_offsets))
+        target_keys = (node_documents[sources] << 32) | (numpy.asarray(corpus.outlinks, dtype=numpy.int64) & 0xFFFFFFFF)
+        positions = numpy.minimum(numpy.searchsorted(sorted_keys, target_keys), max(len(keys) - 1, 0))
+        resolved = sorted_keys[positions] == target_keys if len(keys) > 0 else numpy.zeros(0, dtype=bool)
+        self.unresolved_links = int(len(resolved) - numpy.count_nonzero(resolved))
+        sources, targets = sources[resolved], key_order[positions[resolved]]
+
+        incoming_order = numpy.argsort(targets, kind="stable")
+        out_offsets = numpy.zeros(len(corpus) + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(sources, minlength=len(corpus)), out=out_offsets[1:])
+        in_offsets = numpy.zeros(len(corpus) + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(targets, minlength=len(corpus)), out=in_offsets[1:])
+        return {"out": (out_offsets, targets), "in": (in_offsets, sources[incoming_order]),
+                "node_documents": node_documents}
+
+    def adjacency(self, direction: str = "out") -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """ :returns: The offsets and the neighbors of the CSR adjacency, the neighbors of node i in the
+            given direction (``out`` or ``in``) are ``neighbors[offsets[i]:offsets[i + 1]]``. """
+        if self.__adjacency is None:
+            self.__adjacency = self.__build_adjacency()
+        return self.__adjacency[direction]
+
+    @property
+    def node_documents(self) -> numpy.ndarray:
+        """ The index of the document of every node """
+        if self.__adjacency is None:
+            self.__adjacency = self.__build_adjacency()
+        return self.__adjacency["node_documents"]
+
+    def class_mask(self, class_names: Collection[str]) -> numpy.ndarray:
+        """ :returns: For every class code, whether it is one of the given classes. Unknown classes are ignored. """
+        mask = numpy.zeros(len(self.class_names), dtype=bool)
+        mask[[self.__class_codes[c] for c in class_names if c in self.__class_codes]] = True
+        return mask
+
+    def nodes_of_classes(self, class_names: Collection[str]) -> numpy.ndarray:
+        """ :returns: The indices of all nodes of the given classes in corpus order """
+        if self.__class_index is None:
+            class_order = numpy.argsort(self.corpus.class_codes, kind="stable")
+            class_offsets = numpy.searchsorted(numpy.asarray(self.corpus.class_codes)[class_order],
+                                               numpy.arange(len(self.class_names) + 1))
+            self.__class_index = (class_order, class_offsets)
+        class_order, class_offsets = self.__class_index
+        codes = numpy.flatnonzero(self.class_mask(class_names))
+        counts = class_offsets[codes + 1] - class_offsets[codes]
+        return numpy.sort(class_order[expand_ranges(class_offsets[codes], counts)])
+
+    def neighbors(self, nodes: numpy.ndarray, class_names: Optional[Collection[str]] = None,
+                  direction: str = "out") -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """ Finds the neighbors of many nodes at once.
+
+        :param class_names: Only neighbors of these classes are returned, by default all neighbors.
+        :returns: Pairs of the position of a node in ``nodes`` and the index of one of its neighbors,
+            ordered by the position.
+        """
+        nodes = numpy.asarray(nodes, dtype=numpy.int64)
+        offsets, adjacent = self.adjacency(direction)
+        counts = offsets[nodes + 1] - offsets[nodes]
+        positions = numpy.repeat(numpy.arange(len(nodes), dtype=numpy.int64), counts)
+        neighbors = adjacent[expand_ranges(offsets[nodes], counts)]
+        if class_names is not None:
+            keep = self.class_mask(class_names)[self.corpus.class_codes[neighbors]]
+            positions, neighbors = positions[keep], neighbors[keep]
+        return positions, neighbors
+
+    def neighbor_lists(self, nodes: numpy.ndarray, class_names: Optional[Collection[str]] = None,
+                       direction: str = "out") -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """ Like ``neighbors``, but returns a CSR list: the neighbors of ``nodes[i]`` are
+        ``neighbors[offsets[i]:offsets[i + 1]]``. E.g., the stems, flags and beams of all noteheads. """
+        positions, neighbors = self.neighbors(nodes, class_names, direction)
+        offsets = numpy.zeros(len(nodes) + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(positions, minlength=len(nodes)), out=offsets[1:])
+        return offsets, neighbors
+
+    def group_by_neighbor(self, nodes: numpy.ndarray, class_names: Collection[str],
+                          direction: str = "out") -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+        """ Groups nodes by their neighbors of the given classes, e.g., notes by their staff. A node with several
+        such neighbors is a member of several groups, nodes without any are left out.
+
+        :returns: The neighbor of every group and the members of the groups as a CSR list: the members
+            of ``groups[i]`` are ``members[offsets[i]:offsets[i + 1]]``, ordered by their index.
+        """
+        nodes = numpy.asarray(nodes, dtype=numpy.int64)
+        positions, neighbors = self.neighbors(nodes, class_names, direction)
+        members = nodes[positions]
+        order = numpy.lexsort((members, neighbors))
+        groups, group_starts = numpy.unique(neighbors[order], return_index=True)
+        offsets = numpy.append(group_starts, len(order)).astype(numpy.int64)
+        return groups, offsets, members[order]
+
+    def connected_components(self, class_names: Optional[Collection[str]] = None) -> Tuple[numpy.ndarray, int]:
+        """ Finds the composite symbols formed by the nodes of the given classes, e.g., notes with their stems
+        and beams, as the connected components of the graph restricted to these nodes, ignoring the direction
+        of the edges. Labels are propagated along all edges at once until they converge.
+
+        :returns: The component of every node, -1 for nodes that are not of the given classes, and the
+            number of components. Components are numbered in the order of their first node.
+        """
+        offsets, targets = self.adjacency("out")
+        sources = numpy.repeat(numpy.arange(len(self), dtype=numpy.int64), numpy.diff(offsets))
+        selected = numpy.ones(len(self), dtype=bool) if class_names is None \
+            else self.class_mask(class_names)[self.corpus.class_codes]
+        inside = selected[sources] & selected[targets]
+        sources, targets = sources[inside], targets[inside]
+
+        # Every node points to the smallest node of its component it has seen so far
+        labels = numpy.arange(len(self), dtype=numpy.int64)
+        while True:
+            smaller_labels = numpy.minimum(labels[sources], labels[targets])
+            new_labels = labels.copy()
+            numpy.minimum.at(new_labels, sources, smaller_labels)
+            numpy.minimum.at(new_labels, targets, smaller_labels)
+            new_labels = new_labels[new_labels]
+            if numpy.array_equal(new_labels, labels):
+                break
+            labels = new_labels
+
+        components = numpy.full(len(self), -1, dtype=numpy.int64)
+        roots, components[selected] = numpy.unique(labels[selected], return_inverse=True)
+        return components, len(roots)
+
+
+def load_notation_graph(source_directory: str, cache_directory: Optional[str] = None) -> NotationGraph:
+    """ Opens the graph of a dataset, compiling its corpus cache first, if it is missing or outdated """
+    annotations_directory = os.path.join(source_directory, "data/annotations")
+    corpus = compile_corpus(annotations_directory, cache_directory or os.path.join(source_directory,
+                                                                                   "data/corpus_cache"))
+    return NotationGraph(corpus)
+
+
+def measure(description: str, timings: List[Tuple[str, float]]):
+    """ Returns a function that runs a query and records its duration """
+    def run(query, *arguments):
+        start = time.perf_counter()
+        result = query(*arguments)
+        timings.append((description, time.perf_counter() - start))
+        return result
+    return run
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Runs example queries on the notation graphs of all documents '
+                                                 'and measures their duration')
+    parser.add_argument('--source_directory', type=str, default="v2.0",
+                        help='Directory of the MUSCIMA++ dataset v2.0 or newer')
+    parser.add_argument("--cache_directory", type=str, default=None,
+                        help="Directory of the compiled corpus cache, see corpus_cache.py. "
+                             "Defaults to data/corpus_cache inside of the source directory.")
+
+    flags = parser.parse_args()
+    graph = load_notation_graph(flags.source_directory, flags.cache_directory)
+    timings = []  # type: List[Tuple[str, float]]
+
+    measure("Build adjacency", timings)(graph.adjacency)
+    noteheads = measure("Find noteheads", timings)(graph.nodes_of_classes, NOTEHEAD_CLASS_NAMES)
+    offsets, attachments = measure("Noteheads with their stems, flags and beams", timings)(
+        graph.neighbor_lists, noteheads, STEM_FLAG_BEAM_CLASS_NAMES)
+    staffs, staff_offsets, _ = measure("Notes grouped by staff", timings)(graph.group_by_neighbor, noteheads,
+                                                                            ["staff"])
+    _, number_of_components = measure("Composite symbols of notes", timings)(
+        graph.connected_components, NOTEHEAD_CLASS_NAMES | STEM_FLAG_BEAM_CLASS_NAMES)
+
+    for description, duration in timings:
+        print("{0:<45} {1:>8.1f} ms".format(description, duration * 1000))
+    print("{0} nodes in {1} documents, {2} links to missing nodes".format(len(graph), len(graph.corpus.documents),
+                                                                            graph.unresolved_links))
+    print("{0} noteheads with {1} stems, flags and beams, {2} without any".format(
+        len(noteheads), len(attachments), int(numpy.count_nonzero(numpy.diff(offsets) == 0))))
+    print("{0} staffs with {1} notes, {2} composite symbols of notes".format(
+        len(staffs), int(staff_offsets[-1]), number_of_components))
@@ -0,0 +1,255 @@
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy
+from tqdm import tqdm
+
+from corpus_cache import AnnotationCorpus, compile_corpus
+from grammar_validator import read_class_names
+
+IMAGE_EXTENSIONS = (".npy", ".png", ".tif", ".tiff", ".bmp")
+BACKGROUND_LABEL = 0
+BACKGROUND_INSTANCE = -1
+
+# Corpora opened by the worker processes, so every process maps the corpus cache only once
+opened_corpora = {}  # type: Dict[str, AnnotationCorpus]
+
+
+class RasterizedDocument(NamedTuple):
+    document: str
+    nodes: int
+    foreground_pixels: int
+    crop_pixels: int
+    seconds: float
+
+
+def find_page_image(images_directory: str, document: str) -> Optional[str]:
+    """ Finds the CVC-MUSCIMA image of a document, which is named like the annotation file """
+    for extension in IMAGE_EXTENSIONS:
+        image_path = os.path.join(images_directory, document + extension)
+        if os.path.exists(image_path):
+            return image_path
+    return None
+
+
+def open_page_image(image_path: str, image_cache_directory: str) -> numpy.ndarray:
+    """ Returns the page as a read-only, memory-mapped 2D uint8 array. Images that are not stored as ``.npy``
+    already are decoded once into the image cache directory and mapped from there. """
+    if image_path.endswith(".npy"):
+        return numpy.load(image_path, mmap_mode="r")
+    cached_path = os.path.join(image_cache_directory, os.path.splitext(os.path.basename(image_path))[0] + ".npy")
+    if not os.path.exists(cached_path) or os.path.getmtime(cached_path) < os.path.getmtime(image_path):
+        try:
+            from PIL import Image
+        except ImportError:
+            raise ImportError("Decoding {0} requires Pillow, install it with 'pip install pillow' or convert the "
+                              "images to .npy files".format(image_path))
+        with Image.open(image_path) as image:
+            page = numpy.asarray(image.convert("L"), dtype=numpy.uint8)
+        os.makedirs(image_cache_directory, exist_ok=True)
+        temporary_path = cached_path + ".tmp.npy"
+        numpy.save(temporary_path, page)
+        os.replace(temporary_path, cached_path)
+    return numpy.load(cached_path, mmap_mode="r")
+
+
+def get_boxes(corpus: AnnotationCorpus, node_indices: range) -> numpy.ndarray:
+    """ :returns: The bounding boxes of the nodes as an n x 4 int64 array of top, left, bottom and right """
+    start, stop = node_indices.start, node_indices.stop
+    tops, lefts = numpy.asarray(corpus.tops[start:stop], numpy.int64), numpy.asarray(corpus.lefts[start:stop],
+                                                                                      numpy.int64)
+    return numpy.stack([tops, lefts, tops + corpus.heights[start:stop], lefts + corpus.widths[start:stop]], axis=1)
+
+
+def page_extent(boxes: numpy.ndarray) -> Tuple[int, int]:
+    """ The smallest page shape that contains all boxes, if the size of the image is unknown """
+    if len(boxes) == 0:
+        return 0, 0
+    return int(boxes[:, 2].max()), int(boxes[:, 3].max())
+
+
+def unpack_masks(corpus: AnnotationCorpus, node_indices: range) -> List[Optional[numpy.ndarray]]:
+    """ Unpacks the masks of many nodes with a single ``numpy.unpackbits``. The masks are boolean views
+    into one buffer, so no mask is unpacked or copied on its own. """
+    start, stop = node_indices.start, node_indices.stop
+    mask_offsets = numpy.asarray(corpus.mask_offsets[start:stop + 1], dtype=numpy.int64)
+    bits = numpy.unpackbits(numpy.asarray(corpus.masks[mask_offsets[0]:mask_offsets[-1]])).view(numpy.bool_)
+    bit_starts = ((mask_offsets[:-1] - mask_offsets[0]) * 8).tolist()
+    masks = []  # type: List[Optional[numpy.ndarray]]
+    for bit_start, has_mask, height, width in zip(bit_starts, corpus.has_mask[start:stop].tolist(),
+                                                  corpus.heights[start:stop].tolist(),
+                                                  corpus.widths[start:stop].tolist()):
+        masks.append(bits[bit_start:bit_start + height * width].reshape(height, width) if has_mask else None)
+    return masks
+
+
+def rasterize_document(corpus: AnnotationCorpus, document: str, page_shape: Tuple[int, int],
+                       class_labels: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """ Renders the masks of all nodes of a document into full-page maps. Where masks overlap, the node that
+    comes later in the document is drawn over the earlier ones. Pixels outside of the page are left out.
+
+    All masks are unpacked at once and drawn through views of the page, which only writes the pixels inside
+    the boxes. Scattering all foreground pixels with a single fancy index is several times slower, because the
+    staffs and staff spaces alone cover millions of pixels per page.
+
+    :param class_labels: The label of every class code of the corpus, see ``get_class_labels``.
+    :returns: The class label map (uint16, ``BACKGROUND_LABEL`` for the background) and the instance map,
+        which holds the id of the node of every pixel (int32, ``BACKGROUND_INSTANCE`` for the background).
+    """
+    node_indices = corpus.document_range(document)
+    start, stop = node_indices.start, node_indices.stop
+    height, width = page_shape
+    class_map = numpy.full(page_shape, BACKGROUND_LABEL, dtype=numpy.uint16)
+    instance_map = numpy.full(page_shape, BACKGROUND_INSTANCE, dtype=numpy.int32)
+    labels = class_labels[corpus.class_codes[start:stop]].tolist()
+
+    for mask, (top, left, bottom, right), node_id, label in zip(unpack_masks(corpus, node_indices),
+                                                                get_boxes(corpus, node_indices).tolist(),
+                                                                corpus.ids[start:stop].tolist(), labels):
+        if mask is None:
+            continue
+        visible_mask = mask[max(0, -top):max(0, height - top), max(0, -left):max(0, width - left)]
+        page_window = (slice(max(0, top), min(bottom, height)), slice(max(0, left), min(right, width)))
+        numpy.copyto(instance_map[page_window], node_id, where=visible_mask)
+        numpy.copyto(class_map[page_window], label, where=visible_mask)
+    return class_map, instance_map
+
+
+def get_class_labels(corpus: AnnotationCorpus, class_names: Sequence[str]) -> numpy.ndarray:
+    """ Maps the class codes of the corpus to labels, which are the position in the class list plus one,
+    because label 0 is the background """
+    label_of_name = {class_name: label + 1 for label, class_name in enumerate(class_names)}
+    unknown_classes = sorted(set(corpus.class_names) - set(label_of_name))
+    if unknown_classes:
+        raise ValueError("Classes {0} are not in the class list".format(", ".join(unknown_classes)))
+    return numpy.array([label_of_name[class_name] for class_name in corpus.class_names], dtype=numpy.uint16)
+
+
+def crop_views(page: numpy.ndarray, boxes: numpy.ndarray) -> List[numpy.ndarray]:
+    """ Cuts the crops of the boxes from the page as views, so no pixels are copied, or read from disk
+    before they are used, if the page is memory-mapped """
+    return [page[top:bottom, left:right] for top, left, bottom, right in boxes.tolist()]
+
+
+def gather_crops(page: numpy.ndarray, boxes: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """ Copies the crops of all boxes into one contiguous buffer, e.g., to store them together.
+
+    :returns: The pixels of all crops and their offsets, the crop of box i is
+        ``pixels[offsets[i]:offsets[i + 1]].reshape(bottom - top, right - left)``.
+    """
+    height, width = page.shape
+    if len(boxes) > 0 and (boxes[:, :2].min() < 0 or boxes[:, 2].max() > height or boxes[:, 3].max() > width):
+        raise ValueError("Boxes exceed the page of shape {0}".format(page.shape))
+    offsets = numpy.zeros(len(boxes) + 1, dtype=numpy.int64)
+    numpy.cumsum((boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]), out=offsets[1:])
+    pixels = numpy.empty(offsets[-1], dtype=page.dtype)
+    for crop, offset in zip(crop_views(page, boxes), offsets[:-1].tolist()):
+        pixels[offset:offset + crop.size].reshape(crop.shape)[...] = crop
+    return pixels, offsets
+
+
+def rasterize_corpus_document(cache_directory: str, document: str, destination_directory: str,
+                              class_labels: numpy.ndarray, image_path: Optional[str],
+                              image_cache_directory: str) -> Tuple[Optional[RasterizedDocument], Optional[str]]:
+    """ Writes the class and instance maps of a document and, if its image exists, the crops of its nodes.
+    Returns the error message instead, if the document failed, so one broken document does not stop the batch. """
+    start = time.perf_counter()
+    try:
+        if cache_directory not in opened_corpora:
+            opened_corpora[cache_directory] = AnnotationCorpus(cache_directory)
+        corpus = opened_corpora[cache_directory]
+        node_indices = corpus.document_range(document)
+        boxes = get_boxes(corpus, node_indices)
+
+        page = None if image_path is None else open_page_image(image_path, image_cache_directory)
+        page_shape = page_extent(boxes) if page is None else page.shape
+        class_map, instance_map = rasterize_document(corpus, document, page_shape, class_labels)
+        numpy.save(os.path.join(destination_directory, document + ".classes.npy"), class_map)
+        numpy.save(os.path.join(destination_directory, document + ".instances.npy"), instance_map)
+
+        crop_pixels = 0
+        if page is not None:
+            pixels, offsets = gather_crops(page, boxes)
+            numpy.savez(os.path.join(destination_directory, document + ".crops.npz"), pixels=pixels,
+                        offsets=offsets, boxes=boxes, ids=numpy.asarray(corpus.ids[node_indices.start:
+                                                                                  node_indices.stop]))
+            crop_pixels = len(pixels)
+    except Exception as exception:
+        return None, "{0}: {1}".format(type(exception).__name__, exception)
+    foreground_pixels = int(numpy.count_nonzero(instance_map != BACKGROUND_INSTANCE))
+    return RasterizedDocument(document, len(node_indices), foreground_pixels, crop_pixels,
+                              time.perf_counter() - start), None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Renders full-page class label and instance maps from the masks '
+                                                 'of all nodes and cuts the crops of the nodes from the '
+                                                 'CVC-MUSCIMA images, e.g., to train segmentation models')
+    parser.add_argument('--source_directory', type=str, default="v2.0",
+                        help='Directory of the MUSCIMA++ dataset v2.0 or newer')
+    parser.add_argument("--destination_directory", type=str, default=None,
+                        help="Directory, where the maps and crops are written to. "
+                             "Defaults to data/segmentation inside of the source directory.")
+    parser.add_argument("--images_directory", type=str, default=None,
+                        help="Directory of the CVC-MUSCIMA images, named like the annotation files. "
+                             "Defaults to data/images inside of the source directory. Documents without an "
+                             "image are rendered on a page that just contains all their nodes, without crops.")
+    parser.add_argument("--cache_directory", type=str, default=None,
+                        help="Directory of the compiled corpus cache, see corpus_cache.py. "
+                             "Defaults to data/corpus_cache inside of the source directory.")
+    parser.add_argument('--class_list_file', type=str, default=None,
+                        help='List of classes, whose order defines the class labels, by default '
+                             'specifications/mff-muscima-mlclasses-annot.xml of the source directory')
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Number of processes that render documents in parallel.")
+
+    flags = parser.parse_args()
+    annotations_directory = os.path.join(flags.source_directory, "data/annotations")
+    cache_directory = flags.cache_directory or os.path.join(flags.source_directory, "data/corpus_cache")
+    destination_directory = flags.destination_directory or os.path.join(flags.source_directory,
+                                                                         "data/segmentation")
+    images_directory = flags.images_directory or os.path.join(flags.source_directory, "data/images")
+    class_list_file = flags.class_list_file or os.path.join(flags.source_directory, "specifications",
+                                                            "mff-muscima-mlclasses-annot.xml")
+
+    corpus = compile_corpus(annotations_directory, cache_directory)
+    class_names = read_class_names(class_list_file)
+    class_labels = get_class_labels(corpus, class_names)
+    os.makedirs(destination_directory, exist_ok=True)
+    with open(os.path.join(destination_directory, "class_labels.json"), "w") as file:
+        json.dump({"background": BACKGROUND_LABEL, "labels": {c: i + 1 for i, c in enumerate(class_names)}},
+                  file, indent=4)
+
+    start = time.perf_counter()
+    rasterized_documents = []  # type: List[RasterizedDocument]
+    failed_documents = {}  # type: Dict[str, str]
+    with ProcessPoolExecutor(max_workers=max(1, flags.workers)) as executor:
+        futures = {executor.submit(rasterize_corpus_document, os.path.abspath(cache_directory), document,
+                                   destination_directory, class_labels,
+                                   find_page_image(images_directory, document),
+                                   os.path.join(images_directory, ".page_cache")): document
+                   for document in corpus.documents}
+        for future in tqdm(as_completed(futures), "Rendering documents", total=len(futures)):
+            rasterized_document, error = future.result()
+            if error is None:
+                rasterized_documents.append(rasterized_document)
+            else:
+                failed_documents[futures[future]] = error
+
+    with_crops = [d for d in rasterized_documents if d.crop_pixels > 0]
+    seconds_per_document = sum(d.seconds for d in rasterized_documents) / max(1, len(rasterized_documents))
+    print("Rendered {0} documents with {1} nodes and {2} foreground pixels in {3:.2f} s ({4:.1f} ms per document "
+          "and process)".format(len(rasterized_documents), sum(d.nodes for d in rasterized_documents),
+                                sum(d.foreground_pixels for d in rasterized_documents), time.perf_counter() - start,
+                                1000 * seconds_per_document))
+    print("Cut the crops of {0} documents, {1} documents have no image in {2}".format(
+        len(with_crops), len(rasterized_documents) - len(with_crops), images_directory))
+    for document, error in sorted(failed_documents.items()):
+        print("Error while rendering {0}. Skipping document. {1}".format(document, error))
+    if failed_documents:
+        sys.exit(1)
@@ -0,0 +1,293 @@
+import argparse
+import os
+import time
+from typing import List, Optional, Sequence, Tuple
+
+import numpy
+
+from annotation_reader import iterate_nodes
+
+MINIMUM_CELL_SIZE = 16
+
+
+class SpatialIndex(object):
+    """ A hierarchy of uniform grids over the bounding boxes of the nodes of a single document. The cells of
+    each level are twice as high or twice as wide as those of the previous levels and every box is stored
+    exactly once: in the cell of its top left corner, on the level with the smallest cells that are at least
+    as high and as wide as the box. Long, thin boxes like staff lines therefore end up in long, thin cells.
+    The entries of all cells are kept in one array that is sorted by cell, so building the index takes
+    a single sort. Queries are answered for many boxes at once by gathering the nodes of all cells that may
+    hold intersecting boxes and filtering them exactly with array operations.
+
+    Boxes are half-open, i.e., a node covers the rows ``top`` to ``bottom - 1``, like ``Node.bottom`` and
+    ``Node.right`` are defined. Query boxes are given as an array of ``(top, left, bottom, right)`` rows. """
+
+    def __init__(self, ids: Sequence[int], tops: Sequence[int], lefts: Sequence[int], bottoms: Sequence[int],
+                 rights: Sequence[int], masks: Optional[Sequence[Optional[numpy.ndarray]]] = None,
+                 cell_size: Optional[int] = None):
+        """
+        :param masks: Optional masks of the nodes, used to refine queries with ``refine_with_masks``.
+            Nodes without a mask are treated as if their whole bounding box was foreground.
+        :param cell_size: Size of the smallest cells in pixels, by default the median size of the boxes.
+        """
+        self.ids = numpy.asarray(ids, dtype=numpy.int64)
+        self.boxes = numpy.stack([numpy.asarray(coordinates, dtype=numpy.int64).reshape(-1)
+                                  for coordinates in (tops, lefts, bottoms, rights)], axis=1)
+        self.masks = masks
+        box_sizes = self.boxes[:, 2:] - self.boxes[:, :2]
+        if cell_size is None:
+            cell_size = max(MINIMUM_CELL_SIZE, int(numpy.median(box_sizes.max(axis=1)))) if len(self.ids) > 0 \
+                else MINIMUM_CELL_SIZE
+        self.cell_size = cell_size
+        self.origin = self.boxes[:, :2].min(axis=0) if len(self.ids) > 0 else numpy.zeros(2, dtype=numpy.int64)
+
+        # Levels are numbered row level * number of levels + column level
+        row_levels, column_levels = grid_levels(box_sizes[:, 0], cell_size), grid_levels(box_sizes[:, 1], cell_size)
+        number_of_levels = int(max(row_levels.max(initial=0), column_levels.max(initial=0))) + 1
+        levels = row_levels * number_of_levels + column_levels
+        self.occupied_levels = numpy.unique(levels)
+        level_sizes = cell_size << numpy.arange(number_of_levels)
+        self.level_cell_sizes = numpy.stack(numpy.meshgrid(level_sizes, level_sizes, indexing="ij"),
+                                            axis=-1).reshape(-1, 2)
+        corner_extent = self.boxes[:, :2].max(axis=0, initial=0) - self.origin
+        self.level_shapes = corner_extent // self.level_cell_sizes + 1
+        self.level_shapes[~numpy.isin(numpy.arange(len(self.level_shapes)), self.occupied_levels)] = 0
+        self.level_offsets = numpy.zeros(len(self.level_shapes) + 1, dtype=numpy.int64)
+        numpy.cumsum(self.level_shapes[:, 0] * self.level_shapes[:, 1], out=self.level_offsets[1:])
+
+        corner_cells = (self.boxes[:, :2] - self.origin) // self.level_cell_sizes[levels]
+        cells = self.level_offsets[levels] + corner_cells[:, 0] * self.level_shapes[levels, 1] + corner_cells[:, 1]
+        self.cell_entries = numpy.argsort(cells, kind="stable")
+        self.cell_offsets = numpy.zeros(self.level_offsets[-1] + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(cells, minlength=len(self.cell_offsets) - 1), out=self.cell_offsets[1:])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __query_row_spans(self, query_boxes: numpy.ndarray) \
+            -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+        """ Lists the entries of all cells that may hold boxes intersecting the query boxes. A box with its corner
+        in a cell reaches at most one cell height below and one cell width right of it. Cells of the same row
+        are numbered consecutively, so the cells a query covers in one row are a single range of entries.
+
+        :returns: The query, the first and the end entry of each such range.
+        """
+        all_queries, all_first_entries, all_end_entries = [], [], []
+        for level in self.occupied_levels:
+            cell_size, shape = self.level_cell_sizes[level], self.level_shapes[level]
+            first_cells = numpy.maximum((query_boxes[:, :2] - cell_size + 1 - self.origin) // cell_size, 0)
+            last_cells = numpy.minimum((query_boxes[:, 2:] - 1 - self.origin) // cell_size, shape - 1)
+            rows_per_query = numpy.where(last_cells[:, 1] >= first_cells[:, 1],
+                                         numpy.maximum(last_cells[:, 0] - first_cells[:, 0] + 1, 0), 0)
+            queries = numpy.repeat(numpy.arange(len(query_boxes)), rows_per_query)
+            rows = first_cells[queries, 0] + numpy.arange(len(queries)) - numpy.repeat(
+                numpy.cumsum(rows_per_query) - rows_per_query, rows_per_query)
+            row_starts = self.level_offsets[level] + rows * shape[1]
+            all_queries.append(queries)
+            all_first_entries.append(self.cell_offsets[row_starts + first_cells[queries, 1]])
+            all_end_entries.append(self.cell_offsets[row_starts + last_cells[queries, 1] + 1])
+        return numpy.concatenate(all_queries), numpy.concatenate(all_first_entries), \
+            numpy.concatenate(all_end_entries)
+
+    def __candidate_pairs(self, query_boxes: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """ Returns all pairs of query box and node position whose boxes intersect """
+        query_boxes = numpy.asarray(query_boxes, dtype=numpy.int64).reshape(-1, 4)
+        if len(self.ids) == 0 or len(query_boxes) == 0:
+            return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+
+        queries, first_entries, end_entries = self.__query_row_spans(query_boxes)
+        entries_per_span = end_entries - first_entries
+        entry_in_span = numpy.arange(entries_per_span.sum()) - numpy.repeat(
+            numpy.cumsum(entries_per_span) - entries_per_span, entries_per_span)
+        queries = numpy.repeat(queries, entries_per_span)
+        positions = self.cell_entries[numpy.repeat(first_entries, entries_per_span) + entry_in_span]
+
+        query_boxes, boxes = query_boxes[queries], self.boxes[positions]
+        intersect = (query_boxes[:, 0] < boxes[:, 2]) & (boxes[:, 0] < query_boxes[:, 2]) & \
+                    (query_boxes[:, 1] < boxes[:, 3]) & (boxes[:, 1] < query_boxes[:, 3])
+        return queries[intersect], positions[intersect]
+
+    def __mask(self, position: int) -> Optional[numpy.ndarray]:
+        return None if self.masks is None else self.masks[position]
+
+    def query_range(self, query_boxes: numpy.ndarray, refine_with_masks: bool = False) -> List[numpy.ndarray]:
+        """ Returns for each query box the ids of all nodes whose bounding box intersects it, or with
+        ``refine_with_masks``, whose mask has a foreground pixel inside of it. """
+        query_boxes = numpy.asarray(query_boxes, dtype=numpy.int64).reshape(-1, 4)
+        queries, positions = self.__candidate_pairs(query_boxes)
+        order = numpy.lexsort((positions, queries))
+        queries, positions = queries[order], positions[order]
+        if refine_with_masks:
+            keep = numpy.array([masks_intersect(query_boxes[query], None, self.boxes[position],
+                                                self.__mask(position))
+                                for query, position in zip(queries, positions)], dtype=bool)
+            queries, positions = queries[keep], positions[keep]
+        results_per_query = numpy.bincount(queries, minlength=len(query_boxes))
+        return numpy.split(self.ids[positions], numpy.cumsum(results_per_query)[:-1])
+
+    def query_nearest(self, query_boxes: numpy.ndarray, k: int = 1) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """ Finds the k nodes nearest to each query box, measured as the euclidean distance between
+        the boxes, which is zero if they intersect.
+
+        :returns: Two arrays of shape (number of queries, k) with the ids of the nearest nodes, ordered
+            by distance, and their distances. If the index has less than k nodes, missing entries have
+            the id -1 and the distance infinity.
+        """
+        query_boxes = numpy.asarray(query_boxes, dtype=numpy.int64).reshape(-1, 4)
+        nearest_ids = numpy.full((len(query_boxes), k), -1, dtype=numpy.int64)
+        nearest_distances = numpy.full((len(query_boxes), k), numpy.inf)
+        required_neighbours = min(k, len(self.ids))
+        if required_neighbours == 0:
+            return nearest_ids, nearest_distances
+
+        # Searches an ever growing range around the unresolved queries, until it contains enough nodes that
+        # are closer than its radius: all other nodes are further away than these.
+        pending = numpy.arange(len(query_boxes))
+        radius = self.cell_size
+        while len(pending) > 0:
+            # One more pixel on each side, so the half-open range also holds nodes at a distance of exactly radius
+            expanded_boxes = query_boxes[pending] + numpy.array([-radius - 1, -radius - 1, radius + 1, radius + 1])
+            queries, positions = self.__candidate_pairs(expanded_boxes)
+            distances = box_distances(query_boxes[pending[queries]], self.boxes[positions])
+            within_radius = distances <= radius
+            resolved = numpy.bincount(queries[within_radius], minlength=len(pending)) >= required_neighbours
+
+            selected = within_radius & resolved[queries]
+            queries, positions, distances = queries[selected], positions[selected], distances[selected]
+            order = numpy.lexsort((positions, distances, queries))
+            queries, positions, distances = queries[order], positions[order], distances[order]
+            first_of_query = numpy.searchsorted(queries, queries)
+            ranks = numpy.arange(len(queries)) - first_of_query
+            keep = ranks < k
+            nearest_ids[pending[queries[keep]], ranks[keep]] = self.ids[positions[keep]]
+            nearest_distances[pending[queries[keep]], ranks[keep]] = distances[keep]
+
+            pending = pending[~resolved]
+            radius *= 2
+        return nearest_ids, nearest_distances
+
+    def query_overlaps(self, other: Optional["SpatialIndex"] = None,
+                       refine_with_masks: bool = False) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """ Finds all pairs of nodes whose bounding boxes intersect, or with ``refine_with_masks``,
+        whose masks share a foreground pixel.
+
+        :param other: Another index, e.g., over the staff lines of the same document. Without it,
+            the nodes of this index are paired with each other and every pair is returned once.
+        :returns: The ids of the nodes of this index and the ids of the nodes they overlap with.
+        """
+        other_index = self if other is None else other
+        other_positions, positions = self.__candidate_pairs(other_index.boxes)
+        if other is None:
+            distinct = positions < other_positions
+            other_positions, positions = other_positions[distinct], positions[distinct]
+        if refine_with_masks:
+            keep = numpy.array([masks_intersect(self.boxes[position], self.__mask(position),
+                                                other_index.boxes[other_position],
+                                                other_index.__mask(other_position))
+                                for position, other_position in zip(positions, other_positions)], dtype=bool)
+            other_positions, positions = other_positions[keep], positions[keep]
+        return self.ids[positions], other_index.ids[other_positions]
+
+
+def grid_levels(sizes: numpy.ndarray, cell_size: int) -> numpy.ndarray:
+    """ Returns for each size the smallest level l with ``cell_size * 2 ** l >= size`` """
+    levels = numpy.zeros(len(sizes), dtype=numpy.int64)
+    while numpy.any(sizes > cell_size << levels):
+        levels += sizes > cell_size << levels
+    return levels
+
+
+def box_distances(boxes: numpy.ndarray, other_boxes: numpy.ndarray) -> numpy.ndarray:
+    """ Euclidean distances between the closest points of pairs of boxes """
+    vertical_gaps = numpy.maximum(0, numpy.maximum(other_boxes[:, 0] - boxes[:, 2], boxes[:, 0] - other_boxes[:, 2]))
+    horizontal_gaps = numpy.maximum(0, numpy.maximum(other_boxes[:, 1] - boxes[:, 3],
+                                                     boxes[:, 1] - other_boxes[:, 3]))
+    return numpy.hypot(vertical_gaps, horizontal_gaps)
+
+
+def masks_intersect(box: numpy.ndarray, mask: Optional[numpy.ndarray], other_box: numpy.ndarray,
+                    other_mask: Optional[numpy.ndarray]) -> bool:
+    """ Checks whether two masks, placed at their bounding boxes, share a foreground pixel.
+    A missing mask counts as a completely filled box. """
+    top, left = max(box[0], other_box[0]), max(box[1], other_box[1])
+    bottom, right = min(box[2], other_box[2]), min(box[3], other_box[3])
+    if top >= bottom or left >= right:
+        return False
+    regions = [m[top - b[0]:bottom - b[0], left - b[1]:right - b[1]] != 0
+               for b, m in ((box, mask), (other_box, other_mask)) if m is not None]
+    if not regions:
+        return True
+    if len(regions) == 1:
+        return bool(regions[0].any())
+    return bool(numpy.logical_and(regions[0], regions[1]).any())
+
+
+def build_spatial_index(nodes: Sequence, use_masks: bool = False, cell_size: Optional[int] = None) -> SpatialIndex:
+    """ Builds an index over ``mung`` Nodes, ``muscima`` CropObjects or records from
+    ``annotation_reader.iterate_nodes``. """
+    ids = [node.objid if hasattr(node, "objid") else node.id for node in nodes]
+    tops = numpy.array([node.top for node in nodes], dtype=numpy.int64)
+    lefts = numpy.array([node.left for node in nodes], dtype=numpy.int64)
+    heights = numpy.array([node.height for node in nodes], dtype=numpy.int64)
+    widths = numpy.array([node.width for node in nodes], dtype=numpy.int64)
+    masks = [node.mask for node in nodes] if use_masks else None
+    return SpatialIndex(ids, tops, lefts, tops + heights, lefts + widths, masks, cell_size)
+
+
+def build_corpus_document_index(corpus, document: str, use_masks: bool = False) -> SpatialIndex:
+    """ Builds an index over one document of a compiled ``corpus_cache.AnnotationCorpus`` """
+    node_range = corpus.document_range(document)
+    node_indices = slice(node_range.start, node_range.stop)
+    tops, lefts = numpy.asarray(corpus.tops[node_indices]), numpy.asarray(corpus.lefts[node_indices])
+    masks = [corpus.get_mask(i) for i in node_range] if use_masks else None
+    return SpatialIndex(corpus.ids[node_indices], tops, lefts, tops + corpus.heights[node_indices],
+                        lefts + corpus.widths[node_indices], masks)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Builds a spatial index for every annotation file and '
+                                                 'compares its overlap queries with a brute-force search')
+    parser.add_argument('--source_directory', type=str, default="v2.0",
+                        help='Directory of the MUSCIMA++ dataset v2.0 or newer')
+    parser.add_argument('--refine_with_masks', action="store_true",
+                        help='Only count nodes as overlapping, if their masks share a foreground pixel')
+
+    flags = parser.parse_args()
+
+    annotations_directory = os.path.join(flags.source_directory, "data/annotations")
+    build_duration, query_duration, brute_force_duration = 0.0, 0.0, 0.0
+    number_of_pairs, number_of_differences = 0, 0
+    for annotation_file in sorted(os.listdir(annotations_directory)):
+        if not annotation_file.endswith(".xml"):
+            continue
+        fields = ["mask"] if flags.refine_with_masks else []
+        records = list(iterate_nodes(os.path.join(annotations_directory, annotation_file), fields))
+
+        start = time.perf_counter()
+        spatial_index = build_spatial_index(records, use_masks=flags.refine_with_masks)
+        build_duration += time.perf_counter() - start
+        start = time.perf_counter()
+        pairs = set(zip(*spatial_index.query_overlaps(refine_with_masks=flags.refine_with_masks)))
+        query_duration += time.perf_counter() - start
+
+        start = time.perf_counter()
+        boxes = spatial_index.boxes
+        intersect = (boxes[:, None, 0] < boxes[None, :, 2]) & (boxes[None, :, 0] < boxes[:, None, 2]) & \
+                    (boxes[:, None, 1] < boxes[None, :, 3]) & (boxes[None, :, 1] < boxes[:, None, 3])
+        brute_force_pairs = set()
+        for position, other_position in zip(*numpy.nonzero(numpy.triu(intersect, k=1))):
+            if not flags.refine_with_masks or masks_intersect(boxes[position], records[position].mask,
+                                                              boxes[other_position], records[other_position].mask):
+                brute_force_pairs.add((records[position].id, records[other_position].id))
+        brute_force_duration += time.perf_counter() - start
+
+        number_of_pairs += len(pairs)
+        if pairs != brute_force_pairs:
+            number_of_differences += 1
+            print("{0}: {1} pairs differ".format(annotation_file, len(pairs ^ brute_force_pairs)))
+
+    print("Found {0} overlapping pairs, building took {1:.2f} s, querying {2:.2f} s, "
+          "the brute-force search {3:.2f} s".format(number_of_pairs, build_duration, query_duration,
+                                                    brute_force_duration))
+    if number_of_differences > 0:
+        raise SystemExit("{0} documents differ".format(number_of_differences))
@@ -0,0 +1,60 @@
+import os
+import xml.dom.minidom
+from xml.etree.ElementTree import Element, ElementTree, SubElement, parse
+
+import pytest
+
+from xml_writer import write_pretty_element_tree
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+XSI_NAMESPACE = "{http://www.w3.org/2001/XMLSchema-instance}"
+
+
+def write_with_minidom(path: str, root: Element) -> None:
+    """ Writes the tree the way the upgrade scripts did before the streaming writer. The dataset was written
+    with the ``xml.dom.minidom`` of Python 3.7 and older, which sorted the attributes of every element. """
+    ElementTree(root).write(path, encoding="utf-8", xml_declaration=True)
+    dom = xml.dom.minidom.parse(path)
+    for element in dom.getElementsByTagName("*"):
+        attributes = sorted(element.attributes.items())
+        for name, _ in attributes:
+            element.removeAttribute(name)
+        for name, value in attributes:
+            element.setAttribute(name, value)
+    pretty_xml_as_string = dom.toprettyxml(indent="    ", newl="\n")
+    pretty_xml_as_string = '\n'.join(filter(lambda x: len(x.strip()), pretty_xml_as_string.split('\n')))
+    pretty_xml_as_string = pretty_xml_as_string.replace('version="1.0" ?>', 'version="1.0" encoding="utf-8"?>')
+    with open(path, "w") as file:
+        file.write(pretty_xml_as_string)
+
+
+def build_short_page() -> Element:
+    root = Element("Nodes", {"dataset": "MUSCIMA-pp_2.0", "document": "CVC-MUSCIMA_W-01_N-10_D-ideal",
+                             XSI_NAMESPACE + "noNamespaceSchemaLocation": "CVC-MUSCIMA_Schema.xsd"})
+    for node_id, class_name, outlinks in ((0, "noteheadFull", "1 2"), (1, "stem", None), (2, "staff", None)):
+        node = SubElement(root, "Node")
+        for tag, text in (("Id", str(node_id)), ("ClassName", class_name), ("Top", "120"), ("Left", "37"),
+                          ("Width", "14"), ("Height", "11"), ("Mask", "0:3 1:8 0:5")):
+            SubElement(node, tag).text = text
+        if outlinks is not None:
+            SubElement(node, "Outlinks").text = outlinks
+    data = SubElement(root[0], "Data")
+    SubElement(data, "DataItem", {"key": "text_transcription", "type": "str"}).text = "a < b & \"c\" > d"
+    SubElement(data, "DataItem", {"key": "empty", "type": "str"})
+    return root
+
+
+def test_short_page_matches_minidom(tmp_path):
+    root = build_short_page()
+    write_with_minidom(str(tmp_path / "minidom.xml"), root)
+    write_pretty_element_tree(str(tmp_path / "streamed.xml"), root)
+    assert (tmp_path / "streamed.xml").read_bytes() == (tmp_path / "minidom.xml").read_bytes()
+
+
+def test_committed_annotations_are_reproduced(tmp_path):
+    annotation_file = os.path.join(SCRIPT_DIRECTORY, "v2.0/data/annotations/CVC-MUSCIMA_W-01_N-10_D-ideal.xml")
+    if not os.path.exists(annotation_file):
+        pytest.skip("The v2.0 annotations are not available")
+    write_pretty_element_tree(str(tmp_path / "streamed.xml"), parse(annotation_file).getroot())
+    with open(annotation_file, "rb") as file:
+        assert (tmp_path / "streamed.xml").read_bytes() == file.read()
@@ -0,0 +1,310 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import struct
+import tempfile
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, NamedTuple, Optional, Sequence
+
+import numpy
+from tqdm import tqdm
+
+from corpus_cache import AnnotationCorpus, compile_corpus, is_replaceable_directory
+from grammar_validator import read_class_names
+
+RECORDS_FORMAT_VERSION = 1
+INDEX_FILE_NAME = "index.json"
+INDEX_KEYS = ("version", "class_names", "shards", "records")
+
+# Every record is prefixed with the length of its payload and the CRC32 of the payload.
+# The payload starts with a header of counts, followed by the arrays of the document in the order of
+# decreasing item size, so each array is aligned to its item size, and is padded to RECORD_ALIGNMENT bytes.
+RECORD_PREFIX = struct.Struct("<II")
+RECORD_HEADER = struct.Struct("<IIII")  # nodes, edges, bytes of packed masks, bytes of the document name
+RECORD_ALIGNMENT = 8
+
+
+class TrainingRecord(NamedTuple):
+    """ All nodes of one document. Nodes are addressed by their index in the arrays, the edges are
+    pairs of node indices (from, to), following the outlinks of the nodes. The masks are packed with
+    ``numpy.packbits`` like in the corpus cache, the mask of node i is
+    ``masks[mask_offsets[i]:mask_offsets[i + 1]]`` and empty, if the node has no mask. """
+    document: str
+    ids: numpy.ndarray  # int32, n
+    class_codes: numpy.ndarray  # int16, n, index into the class names of the index file
+    boxes: numpy.ndarray  # int32, n x 4, top, left, bottom, right, like Node.bounding_box
+    edges: numpy.ndarray  # int32, e x 2
+    mask_offsets: numpy.ndarray  # int64, n + 1
+    masks: numpy.ndarray  # uint8
+
+    def get_mask(self, node_index: int) -> Optional[numpy.ndarray]:
+        packed_mask = self.masks[self.mask_offsets[node_index]:self.mask_offsets[node_index + 1]]
+        if len(packed_mask) == 0:
+            return None
+        top, left, bottom, right = self.boxes[node_index].tolist()
+        height, width = bottom - top, right - left
+        return numpy.unpackbits(packed_mask, count=height * width).reshape(height, width)
+
+
+class RecordLocation(NamedTuple):
+    document: str
+    split: str
+    path: str
+    offset: int
+    length: int
+
+
+def read_testset(path: str) -> List[str]:
+    with open(path, "r") as file:
+        return [line.strip() for line in file if line.strip()]
+
+
+def document_to_record(corpus: AnnotationCorpus, document: str, class_codes: numpy.ndarray) -> TrainingRecord:
+    """ Collects the nodes of a document from the corpus cache.
+
+    :param class_codes: Maps the class codes of the corpus to the class codes of the records.
+    """
+    node_indices = corpus.document_range(document)
+    start, stop = node_indices.start, node_indices.stop
+    ids = numpy.array(corpus.ids[start:stop], dtype=numpy.int32)
+    tops, lefts = corpus.tops[start:stop], corpus.lefts[start:stop]
+    boxes = numpy.stack([tops, lefts, tops + corpus.heights[start:stop], lefts + corpus.widths[start:stop]],
+                        axis=1).astype(numpy.int32)
+
+    outlink_offsets = numpy.asarray(corpus.outlink_offsets[start:stop + 1])
+    sources = numpy.repeat(numpy.arange(len(ids), dtype=numpy.int32), numpy.diff(outlink_offsets))
+    target_ids = numpy.asarray(corpus.outlinks[outlink_offsets[0]:outlink_offsets[-1]])
+    id_order = numpy.argsort(ids, kind="stable")
+    positions = numpy.minimum(numpy.searchsorted(ids, target_ids, sorter=id_order), max(len(ids) - 1, 0))
+    unknown_targets = numpy.flatnonzero(ids[id_order[positions]] != target_ids) if len(target_ids) > 0 else []
+    if len(unknown_targets) > 0:
+        raise ValueError("{0}: node {1} links to node {2}, which does not exist".format(
+            document, ids[sources[unknown_targets[0]]], target_ids[unknown_targets[0]]))
+    edges = numpy.stack([sources, id_order[positions].astype(numpy.int32)], axis=1)
+
+    mask_offsets = numpy.asarray(corpus.mask_offsets[start:stop + 1])
+    masks = numpy.array(corpus.masks[mask_offsets[0]:mask_offsets[-1]])
+    return TrainingRecord(document, ids, class_codes[corpus.class_codes[start:stop]].astype(numpy.int16),
+                          boxes, edges.reshape(-1, 2), mask_offsets - mask_offsets[0], masks)
+
+
+def encode_record(record: TrainingRecord) -> bytes:
+    """ Serializes a record including its prefix """
+    name = record.document.encode("utf-8")
+    payload = b"".join([RECORD_HEADER.pack(len(record.ids), len(record.edges), len(record.masks), len(name)),
+                        record.mask_offsets.astype("<i8").tobytes(),
+                        record.boxes.astype("<i4").tobytes(),
+                        record.ids.astype("<i4").tobytes(),
+                        record.edges.astype("<i4").tobytes(),
+                        record.class_codes.astype("<i2").tobytes(),
+                        record.masks.tobytes(),
+                        name])
+    payload += b"\0" * (-len(payload) % RECORD_ALIGNMENT)
+    return RECORD_PREFIX.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def decode_record(buffer: bytes) -> TrainingRecord:
+    """ Deserializes a record including its prefix. The arrays are read-only views into the buffer. """
+    length, checksum = RECORD_PREFIX.unpack_from(buffer)
+    payload = memoryview(buffer)[RECORD_PREFIX.size:RECORD_PREFIX.size + length]
+    if len(payload) != length or zlib.crc32(payload) != checksum:
+        raise ValueError("Record is truncated or corrupted")
+
+    nodes, edges, mask_bytes, name_bytes = RECORD_HEADER.unpack_from(payload)
+    offset = RECORD_HEADER.size
+    arrays = []
+    for dtype, count in (("<i8", nodes + 1), ("<i4", nodes * 4), ("<i4", nodes), ("<i4", edges * 2),
+                         ("<i2", nodes), ("u1", mask_bytes)):
+        arrays.append(numpy.frombuffer(payload, dtype=dtype, count=count, offset=offset))
+        offset += arrays[-1].nbytes
+    mask_offsets, boxes, ids, edge_array, class_codes, masks = arrays
+    document = bytes(payload[offset:offset + name_bytes]).decode("utf-8")
+    return TrainingRecord(document, ids, class_codes, boxes.reshape(nodes, 4), edge_array.reshape(edges, 2),
+                          mask_offsets, masks)
+
+
+def export_records(corpus: AnnotationCorpus, destination_directory: str, class_names: Sequence[str],
+                   test_documents: Sequence[str], shard_bytes: int) -> None:
+    """ Writes the documents of the corpus into shards of at most ``shard_bytes`` bytes (unless a single record
+    is larger) and the index file, which locates every record. Documents in ``test_documents`` form the
+    test split, all others the training split, every shard belongs to a single split. """
+    if not is_replaceable_directory(destination_directory, INDEX_FILE_NAME, INDEX_KEYS):
+        raise ValueError("{0} is not an export of training records and is not empty, refusing to replace it".format(
+            destination_directory))
+    class_code_of_name = {class_name: code for code, class_name in enumerate(class_names)}
+    unknown_classes = sorted(set(corpus.class_names) - set(class_code_of_name))
+    if unknown_classes:
+        raise ValueError("Classes {0} are not in the class list".format(", ".join(unknown_classes)))
+    class_codes = numpy.array([class_code_of_name[class_name] for class_name in corpus.class_names], numpy.int16)
+
+    test_documents = set(test_documents)
+    splits = {"train": [d for d in corpus.documents if d not in test_documents],
+              "test": [d for d in corpus.documents if d in test_documents]}
+    missing_documents = sorted(test_documents - set(corpus.documents))
+    if missing_documents:
+        print("Test documents {0} are not in the corpus".format(", ".join(missing_documents)))
+
+    temporary_directory = tempfile.mkdtemp(prefix=os.path.basename(os.path.normpath(destination_directory)) + ".",
+                                           dir=os.path.dirname(os.path.abspath(destination_directory)))
+    shards = []  # type: List[Dict]
+    records = []  # type: List[Dict]
+    for split, documents in splits.items():
+        shard_file = None
+        for document in tqdm(documents, "Exporting {0} records".format(split)):
+            record = encode_record(document_to_record(corpus, document, class_codes))
+            if shard_file is None or (shards[-1]["size"] > 0 and shards[-1]["size"] + len(record) > shard_bytes):
+                if shard_file is not None:
+                    shard_file.close()
+                shards.append({"file": "{0}-{1:05d}.records".format(split, len(shards)), "split": split, "size": 0})
+                shard_file = open(os.path.join(temporary_directory, shards[-1]["file"]), "wb")
+            records.append({"document": document, "split": split, "shard": len(shards) - 1,
+                            "offset": shards[-1]["size"], "length": len(record)})
+            shard_file.write(record)
+            shards[-1]["size"] += len(record)
+        if shard_file is not None:
+            shard_file.close()
+
+    index = {"version": RECORDS_FORMAT_VERSION,
+             "class_names": list(class_names),
+             "shards": shards,
+             "records": records,
+             }
+    with open(os.path.join(temporary_directory, INDEX_FILE_NAME), "w") as file:
+        json.dump(index, file, indent=1)
+
+    if os.path.exists(destination_directory):
+        shutil.rmtree(destination_directory)
+    os.replace(temporary_directory, destination_directory)
+
+
+class RecordIndex(object):
+    """ Random access to the records of an export by their position in the index """
+
+    def __init__(self, records_directory: str):
+        with open(os.path.join(records_directory, INDEX_FILE_NAME)) as file:
+            index = json.load(file)
+        if index["version"] != RECORDS_FORMAT_VERSION:
+            raise ValueError("Records in {0} have version {1}, expected {2}".format(
+                records_directory, index["version"], RECORDS_FORMAT_VERSION))
+        self.class_names = index["class_names"]  # type: List[str]
+        self.locations = [RecordLocation(record["document"], record["split"],
+                                         os.path.join(records_directory, index["shards"][record["shard"]]["file"]),
+                                         record["offset"], record["length"])
+                          for record in index["records"]]  # type: List[RecordLocation]
+
+    def __len__(self):
+        return len(self.locations)
+
+    def split(self, split: str) -> List[RecordLocation]:
+        return [location for location in self.locations if location.split == split]
+
+    def __getitem__(self, position: int) -> TrainingRecord:
+        return read_record(self.locations[position])
+
+
+def read_record(location: RecordLocation) -> TrainingRecord:
+    with open(location.path, "rb") as file:
+        file.seek(location.offset)
+        return decode_record(file.read(location.length))
+
+
+def stream_records(locations: Sequence[RecordLocation], workers: int = 2, prefetch: int = 8,
+                   shuffle: bool = False, seed: Optional[int] = None) -> Iterator[TrainingRecord]:
+    """ Yields the records at the given locations, which are read and decoded by a pool of processes.
+    Up to ``prefetch`` records are read ahead of the consumer, they are yielded in the order of the
+    locations (or in a random order, if ``shuffle`` is set), no matter which process finishes first.
+
+    :param workers: Number of reading processes, 0 reads the records in the calling process.
+    """
+    locations = list(locations)
+    if shuffle:
+        random.Random(seed).shuffle(locations)
+    if workers <= 0:
+        for location in locations:
+            yield read_record(location)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for location in locations:
+            pending.append(executor.submit(read_record, location))
+            if len(pending) >= max(1, prefetch):
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def verify_records(index: RecordIndex, corpus: AnnotationCorpus, workers: int, prefetch: int = 8) -> List[str]:
+    """ Reads all records back and returns the documents, whose nodes differ from the corpus """
+    class_codes = numpy.array([index.class_names.index(c) for c in corpus.class_names], dtype=numpy.int16)
+    differing_documents = []
+    for record in tqdm(stream_records(index.locations, workers, prefetch), "Verifying records", total=len(index)):
+        expected_record = document_to_record(corpus, record.document, class_codes)
+        if not all(numpy.array_equal(actual, expected) for actual, expected in zip(record[1:], expected_record[1:])):
+            differing_documents.append(record.document)
+    return differing_documents
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Exports the MUSCIMA++ annotations into sharded binary records '
+                                                 'with the train and test splits for training data loaders')
+    parser.add_argument('--source_directory', type=str, default="v2.0",
+                        help='Directory of the MUSCIMA++ dataset v2.0 or newer')
+    parser.add_argument("--destination_directory", type=str, default=None,
+                        help="Directory, where the shards and the index are written to. "
+                             "Defaults to data/training_records inside of the source directory.")
+    parser.add_argument("--cache_directory", type=str, default=None,
+                        help="Directory of the compiled corpus cache, see corpus_cache.py. "
+                             "Defaults to data/corpus_cache inside of the source directory.")
+    parser.add_argument("--testset", type=str, default="independent", choices=["independent", "dependent"],
+                        help="Which of the test sets in specifications defines the test split, the writer-"
+                             "independent or the writer-dependent one.")
+    parser.add_argument('--class_list_file', type=str, default=None,
+                        help='List of classes, whose order defines the class codes, by default '
+                             'specifications/mff-muscima-mlclasses-annot.xml of the source directory')
+    parser.add_argument("--shard_megabytes", type=float, default=64,
+                        help="Maximum size of a shard.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Number of processes that read the records back for verification.")
+    parser.add_argument("--prefetch", type=int, default=8,
+                        help="Number of records the streaming reader reads ahead of the consumer.")
+    parser.add_argument("--verify", action="store_true",
+                        help="Read all records back with the streaming reader and compare them to the corpus.")
+
+    flags = parser.parse_args()
+    specifications_directory = os.path.join(flags.source_directory, "specifications")
+    annotations_directory = os.path.join(flags.source_directory, "data/annotations")
+    cache_directory = flags.cache_directory or os.path.join(flags.source_directory, "data/corpus_cache")
+    destination_directory = flags.destination_directory or os.path.join(flags.source_directory,
+                                                                         "data/training_records")
+    class_list_file = flags.class_list_file or os.path.join(specifications_directory,
+                                                            "mff-muscima-mlclasses-annot.xml")
+
+    corpus = compile_corpus(annotations_directory, cache_directory)
+    test_documents = read_testset(os.path.join(specifications_directory,
+                                               "testset-{0}.txt".format(flags.testset)))
+    export_records(corpus, destination_directory, read_class_names(class_list_file), test_documents,
+                   int(flags.shard_megabytes * 1024 * 1024))
+
+    index = RecordIndex(destination_directory)
+    for split in ("train", "test"):
+        print("{0}: {1} documents".format(split, len(index.split(split))))
+
+    start = time.perf_counter()
+    records = stream_records(index.locations, flags.workers, flags.prefetch)
+    nodes = sum(len(record.ids) for record in records)
+    print("Streamed {0} records with {1} nodes in {2:.1f} ms".format(len(index), nodes,
+                                                                     (time.perf_counter() - start) * 1000))
+
+    if flags.verify:
+        differing_documents = verify_records(index, corpus, flags.workers, flags.prefetch)
+        for document in differing_documents:
+            print("Record of document {0} differs from the corpus".format(document))
+        if differing_documents:
+            raise SystemExit("{0} records differ".format(len(differing_documents)))
+        print("All records match the corpus")
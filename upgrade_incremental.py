@@ -0,0 +1,381 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+from xml.etree.ElementTree import Element, fromstring, parse
+
+from muscima.cropobject import CropObject
+from tqdm import tqdm
+
+from mask_codec import canonicalize_masks
+from upgrade_profiling import DocumentProfile
+from upgrade_rules import compute_converter_hash, compute_file_hash, load_script
+from xml_writer import serialize_child, write_pretty_xml_chunks
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+upgrade_to_v2_1_directly = load_script(os.path.join(SCRIPT_DIRECTORY, "upgrade_v1.0_to_v2.1.py"))
+upgrade_to_v2_0 = upgrade_to_v2_1_directly.upgrade_to_v2_0
+upgrade_to_v2_1 = upgrade_to_v2_1_directly.upgrade_to_v2_1
+
+STATE_FORMAT_VERSION = 1
+CROP_OBJECT_PATTERN = re.compile(r"<CropObject[\s>][^<]*(?:<(?!/CropObject>)[^<]*)*</CropObject>")
+CROP_OBJECT_START_PATTERN = re.compile(r"<CropObject[\s>/]")
+
+# The nodes of these classes depend on more than their own links, see ``find_affected_nodes``
+DYNAMICS_CLASS_NAMES = frozenset(upgrade_to_v2_0.DYNAMICS_LETTER_NAME_MAPPING) | frozenset(["dynamics_text"])
+OUTPUT_VERSIONS = {"v2.0": "MUSCIMA-pp_2.0", "v2.1": "MUSCIMA-pp_2.1"}
+
+
+class SourceNode(NamedTuple):
+    """ Everything the upgrade reads from a crop-object of the source document, except for its mask """
+    fingerprint: str
+    id: int
+    class_name: str
+    top: int
+    left: int
+    width: int
+    height: int
+    outlinks: List[int]
+    inlinks: List[int]
+    uid: str
+
+    def to_crop_object(self) -> CropObject:
+        return CropObject(objid=self.id, clsname=self.class_name, top=self.top, left=self.left, width=self.width,
+                          height=self.height, outlinks=list(self.outlinks), inlinks=list(self.inlinks),
+                          uid=self.uid)
+
+
+class DocumentUpdate(NamedTuple):
+    document: str
+    mode: str  # unchanged, patched or rebuilt
+    changed_nodes: int
+    upgraded_nodes: int
+    seconds: float
+
+
+def fingerprint(chunk: str) -> str:
+    return hashlib.sha1(chunk.encode("utf-8")).hexdigest()
+
+
+def split_crop_objects(source_text: str) -> Optional[List[str]]:
+    """ Splits the source document into the texts of its crop-objects, without parsing it.
+    Returns None, if the document can not be split reliably, e.g., because of self-closing crop-objects. """
+    chunks = CROP_OBJECT_PATTERN.findall(source_text)
+    if len(chunks) != len(CROP_OBJECT_START_PATTERN.findall(source_text)):
+        return None
+    return chunks
+
+
+def read_source_node(crop_object_node: Element, chunk_fingerprint: str) -> SourceNode:
+    crop_object = upgrade_to_v2_0.read_crop_object(crop_object_node)
+    return SourceNode(chunk_fingerprint, crop_object.objid, crop_object.clsname, crop_object.top, crop_object.left,
+                      crop_object.width, crop_object.height, crop_object.outlinks, crop_object.inlinks,
+                      crop_object.uid)
+
+
+def upgrade_to_chunks(crop_object_nodes: List[Element], index, document: str) -> Tuple[List[str], List[str]]:
+    """ Upgrades the crop-object nodes and serializes the resulting nodes of each of them,
+    as they appear in the v2.0 and the v2.1 file """
+    upgraded_nodes = upgrade_to_v2_0.upgrade_crop_object_nodes(crop_object_nodes, index,
+                                                                upgrade_to_v2_0.UPGRADE_RULES,
+                                                                DocumentProfile(document))
+    elements = [element for elements in upgraded_nodes for element in elements]
+    nodes = upgrade_to_v2_1.upgrade_xml_file([upgrade_to_v2_1_directly.element_to_node(element, "MUSCIMA-pp_2.1",
+                                                                                       document)
+                                              for element in elements])
+    mask_strings = canonicalize_masks([element.findtext("Mask") for element in elements],
+                                      [(node.height, node.width) for node in nodes])
+    v2_1_chunks = iter([serialize_child(upgrade_to_v2_1.node_to_element(node, mask_string))
+                        for node, mask_string in zip(nodes, mask_strings)])
+
+    v2_0_document_chunks, v2_1_document_chunks = [], []
+    for elements_of_crop_object in upgraded_nodes:
+        v2_0_document_chunks.append("".join(serialize_child(element) for element in elements_of_crop_object))
+        v2_1_document_chunks.append("".join(next(v2_1_chunks) for _ in elements_of_crop_object))
+    return v2_0_document_chunks, v2_1_document_chunks
+
+
+def find_affected_nodes(old_nodes: List[SourceNode], new_nodes: List[SourceNode],
+                        changed_ids: Set[int]) -> Set[int]:
+    """ Finds the nodes, whose upgrade may differ after the nodes with the given ids were changed, added
+    or removed. Besides the changed nodes themselves, these are
+
+    - the nodes that link to a changed node, because flags, fermatas and empty noteheads are split
+      depending on the class and position of their linked nodes,
+    - all dynamics letters and texts, if any of them is affected or the highest id changed, because letters
+      of dynamics get consecutive new ids and are added to the outlinks of their dynamics text.
+    """
+    old_classes = {node.id: node.class_name for node in old_nodes}
+    affected_ids = {node.id for node in new_nodes
+                    if node.id in changed_ids or not changed_ids.isdisjoint(node.inlinks)
+                    or not changed_ids.isdisjoint(node.outlinks)}
+    new_classes = {node.id: node.class_name for node in new_nodes}
+    involved_classes = {old_classes[i] for i in changed_ids | affected_ids if i in old_classes} | \
+                       {new_classes[i] for i in changed_ids | affected_ids if i in new_classes}
+
+    highest_id_changed = max(old_classes, default=-1) != max(new_classes, default=-1)
+    if highest_id_changed or not involved_classes.isdisjoint(DYNAMICS_CLASS_NAMES):
+        affected_ids.update(node.id for node in new_nodes if node.class_name in DYNAMICS_CLASS_NAMES)
+    return affected_ids
+
+
+class IncrementalUpgrade(object):
+    """ Keeps the v2.0 and v2.1 versions of the v1.0 documents up to date, upgrading only the nodes that are
+    affected by a change of the source document. The state of every document, i.e., the crop-objects of its last
+    seen version and the length of the upgraded text of each of them in both output files, is stored as JSON
+    in the state directory. The upgraded texts of the affected nodes are spliced into the existing output files,
+    the result is identical to upgrading the whole document. """
+
+    def __init__(self, v2_0_directory: str, v2_1_directory: str, state_directory: str):
+        self.output_directories = {"v2.0": v2_0_directory, "v2.1": v2_1_directory}
+        self.state_directory = state_directory
+        self.converter_hash = compute_converter_hash()
+        for directory in (v2_0_directory, v2_1_directory, state_directory):
+            os.makedirs(directory, exist_ok=True)
+
+    def output_path(self, version: str, document: str) -> str:
+        return os.path.join(self.output_directories[version], document + ".xml")
+
+    def state_path(self, document: str) -> str:
+        return os.path.join(self.state_directory, document + ".json")
+
+    def update(self, source_path: str, force: bool = False) -> DocumentUpdate:
+        start = time.perf_counter()
+        document = os.path.splitext(os.path.basename(source_path))[0]
+        with open(source_path, "r", encoding="utf-8") as file:
+            source_text = file.read()
+        source_hash = hashlib.sha256(source_text.encode("utf-8")).hexdigest()
+
+        state = None if force else self.load_state(document)
+        if state is not None and state["source_hash"] == source_hash:
+            return DocumentUpdate(document, "unchanged", 0, 0, time.perf_counter() - start)
+
+        patched = None if state is None else self.patch(document, source_text, source_hash, state)
+        if patched is None:
+            changed_nodes = upgraded_nodes = self.rebuild(document, source_path, source_text, source_hash)
+            mode = "rebuilt"
+        else:
+            changed_nodes, upgraded_nodes = patched
+            mode = "patched"
+        return DocumentUpdate(document, mode, changed_nodes, upgraded_nodes, time.perf_counter() - start)
+
+    def load_state(self, document: str) -> Optional[Dict]:
+        """ Returns the state of a document, unless it is outdated, or its output files were changed since """
+        if not os.path.exists(self.state_path(document)):
+            return None
+        with open(self.state_path(document)) as file:
+            state = json.load(file)
+        if state.get("version") != STATE_FORMAT_VERSION or state.get("converter") != self.converter_hash:
+            return None
+        for version, output in state["outputs"].items():
+            output_path = self.output_path(version, document)
+            if not os.path.exists(output_path) or compute_file_hash(output_path) != output["hash"]:
+                return None
+        return state
+
+    def rebuild(self, document: str, source_path: str, source_text: str, source_hash: str) -> int:
+        """ Upgrades the whole document like ``upgrade_v1.0_to_v2.0.py`` and ``upgrade_v2.0_to_v2.1.py``
+        and stores its state, if it can be split into its crop-objects for later patches. """
+        tree = parse(source_path)
+        crop_object_nodes = tree.findall("*/CropObject")
+        crop_objects = upgrade_to_v2_0.read_crop_objects(tree)
+        source_chunks = split_crop_objects(source_text)
+        source_nodes = None
+        if source_chunks is not None and len(source_chunks) == len(crop_object_nodes):
+            # Stored before the upgrade, which adds the ids of dynamics letters to the outlinks of their texts
+            source_nodes = [SourceNode(fingerprint(chunk), c.objid, c.clsname, c.top, c.left, c.width, c.height,
+                                       list(c.outlinks), list(c.inlinks), c.uid)
+                            for chunk, c in zip(source_chunks, crop_objects)]
+
+        index = upgrade_to_v2_0.DocumentIndex(crop_objects, crop_object_nodes)
+        chunks = dict(zip(OUTPUT_VERSIONS, upgrade_to_chunks(crop_object_nodes, index, document)))
+        for version, dataset in OUTPUT_VERSIONS.items():
+            write_pretty_xml_chunks(self.output_path(version, document), "Nodes",
+                                    upgrade_to_v2_0.nodes_root_attributes(dataset, document),
+                                    (chunk for chunk in chunks[version] if chunk))
+
+        if source_nodes is None or not all(any(version_chunks) for version_chunks in chunks.values()):
+            self.remove_state(document)
+        else:
+            self.save_state(document, source_hash, source_nodes, chunks,
+                            {version: self.read_output(version, document) for version in OUTPUT_VERSIONS})
+        return len(crop_object_nodes)
+
+    def patch(self, document: str, source_text: str, source_hash: str, state: Dict) -> Optional[Tuple[int, int]]:
+        """ Upgrades only the affected nodes and splices them into the output files.
+
+        :returns: The number of changed and of upgraded nodes, or None, if the document has to be rebuilt,
+            e.g., because ids are not unique or nodes were reordered.
+        """
+        source_chunks = split_crop_objects(source_text)
+        if source_chunks is None:
+            return None
+        old_nodes = [SourceNode(*node) for node in state["nodes"]]
+        old_nodes_by_fingerprint = {node.fingerprint: node for node in old_nodes}
+        old_ids = [node.id for node in old_nodes]
+        if len(old_nodes_by_fingerprint) != len(old_nodes) or len(set(old_ids)) != len(old_ids):
+            return None
+
+        new_nodes, new_elements = [], {}  # type: List[SourceNode], Dict[int, Element]
+        for chunk in source_chunks:
+            chunk_fingerprint = fingerprint(chunk)
+            if chunk_fingerprint in old_nodes_by_fingerprint:
+                new_nodes.append(old_nodes_by_fingerprint[chunk_fingerprint])
+            else:
+                element = fromstring(chunk)
+                new_nodes.append(read_source_node(element, chunk_fingerprint))
+                new_elements[new_nodes[-1].id] = element
+        new_ids = [node.id for node in new_nodes]
+        if len(set(new_ids)) != len(new_ids) or len(new_nodes) == 0:
+            return None
+        common_ids = set(old_ids) & set(new_ids)
+        if [i for i in old_ids if i in common_ids] != [i for i in new_ids if i in common_ids]:
+            return None
+
+        changed_ids = set(new_elements) | (set(old_ids) - set(new_ids))
+        affected_ids = find_affected_nodes(old_nodes, new_nodes, changed_ids)
+        affected_positions = [position for position, node in enumerate(new_nodes) if node.id in affected_ids]
+        for position in affected_positions:
+            if new_nodes[position].id not in new_elements:
+                new_elements[new_nodes[position].id] = fromstring(source_chunks[position])
+
+        # Only the objects the affected nodes can look at are needed, in document order to resolve links like
+        # the full upgrade does
+        context_ids = set(affected_ids)
+        for position in affected_positions:
+            context_ids.update(new_nodes[position].inlinks)
+            context_ids.update(new_nodes[position].outlinks)
+        index = upgrade_to_v2_0.DocumentIndex([node.to_crop_object() for node in new_nodes if node.id in context_ids],
+                                              [new_elements[new_nodes[p].id] for p in affected_positions])
+        index.next_free_id = max(new_ids) + 1
+        upgraded_chunks = upgrade_to_chunks([new_elements[new_nodes[p].id] for p in affected_positions], index,
+                                            document)
+
+        chunks = {}
+        old_outputs = {version: self.read_output(version, document) for version in OUTPUT_VERSIONS}
+        for version, upgraded_version_chunks in zip(OUTPUT_VERSIONS, upgraded_chunks):
+            old_chunks = dict(zip(old_ids, self.split_output(old_outputs[version], state["outputs"][version])))
+            version_chunks = [old_chunks.get(node.id) for node in new_nodes]
+            for position, chunk in zip(affected_positions, upgraded_version_chunks):
+                version_chunks[position] = chunk
+            if not any(version_chunks):
+                return None
+            chunks[version] = version_chunks
+
+        new_outputs = {}
+        for version in OUTPUT_VERSIONS:
+            output, output_state = old_outputs[version], state["outputs"][version]
+            body_end = output_state["header_length"] + sum(output_state["chunk_lengths"])
+            new_outputs[version] = output[:output_state["header_length"]] + "".join(chunks[version]) + output[body_end:]
+            self.write_output(version, document, new_outputs[version])
+        self.save_state(document, source_hash, new_nodes, chunks, new_outputs)
+        return len(changed_ids), len(affected_positions)
+
+    def read_output(self, version: str, document: str) -> str:
+        with open(self.output_path(version, document), "r", encoding="utf-8", newline="") as file:
+            return file.read()
+
+    def write_output(self, version: str, document: str, text: str) -> None:
+        output_path = self.output_path(version, document)
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(output_path), suffix=".tmp")
+        with os.fdopen(file_descriptor, "w", encoding="utf-8", newline="") as file:
+            file.write(text)
+        os.replace(temporary_path, output_path)
+
+    @staticmethod
+    def split_output(output: str, output_state: Dict) -> List[str]:
+        chunks = []
+        start = output_state["header_length"]
+        for length in output_state["chunk_lengths"]:
+            chunks.append(output[start:start + length])
+            start += length
+        return chunks
+
+    def save_state(self, document: str, source_hash: str, source_nodes: List[SourceNode],
+                   chunks: Dict[str, List[str]], outputs: Dict[str, str]) -> None:
+        """ Stores the crop-objects and where the upgraded text of each of them is in the output files.
+        The header of a file ends after the start tag of the root, which is the second line.
+        The state is written after the output files, so an interrupted update is detected by their hashes. """
+        output_states = {}
+        for version, output in outputs.items():
+            header_length = output.index("\n", output.index("\n") + 1) + 1
+            chunk_lengths = [len(chunk) for chunk in chunks[version]]
+            if output[header_length:header_length + sum(chunk_lengths)] != "".join(chunks[version]):
+                self.remove_state(document)
+                return
+            output_states[version] = {"hash": hashlib.sha256(output.encode("utf-8")).hexdigest(),
+                                      "header_length": header_length, "chunk_lengths": chunk_lengths}
+        state = {"version": STATE_FORMAT_VERSION, "converter": self.converter_hash, "source_hash": source_hash,
+                 "outputs": output_states, "nodes": [list(node) for node in source_nodes]}
+        temporary_path = self.state_path(document) + ".tmp"
+        with open(temporary_path, "w") as file:
+            file.write(json.dumps(state))
+        os.replace(temporary_path, self.state_path(document))
+
+    def remove_state(self, document: str) -> None:
+        if os.path.exists(self.state_path(document)):
+            os.remove(self.state_path(document))
+
+
+def verify_document(upgrade: IncrementalUpgrade, source_path: str) -> List[str]:
+    """ Upgrades the whole document again into a temporary directory and returns the versions, whose
+    output files differ from the incrementally updated ones """
+    document = os.path.splitext(os.path.basename(source_path))[0]
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        reference = IncrementalUpgrade(os.path.join(temporary_directory, "v2.0"),
+                                       os.path.join(temporary_directory, "v2.1"),
+                                       os.path.join(temporary_directory, "state"))
+        reference.update(source_path, force=True)
+        return [version for version in OUTPUT_VERSIONS
+                if upgrade.read_output(version, document) != reference.read_output(version, document)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Updates MUSCIMA++ v2.0 and v2.1 after changes of MUSCIMA++ v1.0, '
+                                                 'upgrading only the nodes that are affected by the changes')
+    parser.add_argument('--source_directory', type=str, default="v1.0",
+                        help='Directory of the MUSCIMA++ dataset v1.0')
+    parser.add_argument("--v2_0_directory", type=str, default="v2.0",
+                        help="Directory of the MUSCIMA++ dataset v2.0, that should be kept up to date.")
+    parser.add_argument("--v2_1_directory", type=str, default="v2.1",
+                        help="Directory of the MUSCIMA++ dataset v2.1, that should be kept up to date.")
+    parser.add_argument("--state_directory", type=str, default=None,
+                        help="Directory, where the last seen version of every source document is stored. "
+                             "Defaults to data/.incremental_state inside of the v2.0 directory.")
+    parser.add_argument("--force", action="store_true",
+                        help="Upgrade all documents completely, even if they did not change since the last run.")
+    parser.add_argument("--verify", action="store_true",
+                        help="Check that every updated document is identical to upgrading it completely.")
+
+    flags = parser.parse_args()
+
+    source = os.path.join(flags.source_directory, "data/cropobjects_withstaff")
+    upgrade = IncrementalUpgrade(os.path.join(flags.v2_0_directory, "data/annotations"),
+                                 os.path.join(flags.v2_1_directory, "data/annotations"),
+                                 flags.state_directory or os.path.join(flags.v2_0_directory,
+                                                                       "data/.incremental_state"))
+    updates = []  # type: List[DocumentUpdate]
+    differing_documents = []  # type: List[str]
+    for annotation_file in tqdm(sorted(f for f in os.listdir(source) if f.endswith(".xml")), "Updating annotations"):
+        update = upgrade.update(os.path.join(source, annotation_file), flags.force)
+        updates.append(update)
+        if flags.verify and update.mode != "unchanged":
+            differing_versions = verify_document(upgrade, os.path.join(source, annotation_file))
+            if differing_versions:
+                differing_documents.append("{0} ({1})".format(update.document, ", ".join(differing_versions)))
+
+    for update in updates:
+        if update.mode == "patched":
+            print("Patched {0}: {1} changed nodes, {2} nodes upgraded in {3:.1f} ms".format(
+                update.document, update.changed_nodes, update.upgraded_nodes, update.seconds * 1000))
+    modes = {mode: [u for u in updates if u.mode == mode] for mode in ("unchanged", "patched", "rebuilt")}
+    print("{0} documents unchanged, {1} patched, {2} rebuilt in {3:.2f} s".format(
+        len(modes["unchanged"]), len(modes["patched"]), len(modes["rebuilt"]), sum(u.seconds for u in updates)))
+    for document in differing_documents:
+        print("Document {0} differs from a complete upgrade".format(document))
+    if differing_documents:
+        raise SystemExit("{0} documents differ".format(len(differing_documents)))
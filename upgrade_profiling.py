@@ -0,0 +1,107 @@
+import csv
+import json
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, List, Sequence
+
+
+class DocumentProfile(object):
+    """ Instrumentation of the upgrade of a single document: the wall time and peak memory of every stage,
+    how often each rule was applied and counters of objects, that could not be upgraded regularly,
+    together with the uids of those objects.
+
+    Peak memory is the peak of the memory traced by ``tracemalloc`` during a stage, so it is only
+    measured if tracing was started, see ``start_memory_tracing``. Stages that are entered repeatedly,
+    e.g., once per node, accumulate their time and keep their highest peak. """
+
+    def __init__(self, document: str):
+        self.document = document
+        self.stage_seconds = {}  # type: Dict[str, float]
+        self.stage_peak_memory = {}  # type: Dict[str, int]
+        self.rule_hits = Counter()  # type: Counter
+        self.counters = Counter()  # type: Counter
+        self.objects = {}  # type: Dict[str, List[str]]
+
+    @contextmanager
+    def stage(self, name: str):
+        tracing_memory = tracemalloc.is_tracing()
+        if tracing_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + time.perf_counter() - start
+            if tracing_memory:
+                self.stage_peak_memory[name] = max(self.stage_peak_memory.get(name, 0),
+                                                   tracemalloc.get_traced_memory()[1])
+
+    def count(self, counter: str, uid: str) -> None:
+        """ Counts an object that was skipped, or whose new class had to be guessed """
+        self.counters[counter] += 1
+        self.objects.setdefault(counter, []).append(uid)
+
+    @property
+    def total_seconds(self) -> float:
+        return sum(self.stage_seconds.values())
+
+    def to_dict(self) -> Dict:
+        return {"document": self.document,
+                "total_seconds": self.total_seconds,
+                "stages": {name: {"seconds": seconds, "peak_memory_bytes": self.stage_peak_memory.get(name)}
+                           for name, seconds in self.stage_seconds.items()},
+                "rule_hits": dict(self.rule_hits),
+                "counters": dict(self.counters),
+                "objects": self.objects,
+                }
+
+
+def start_memory_tracing() -> None:
+    """ Enables the peak memory measurement of the profiles in this process. Tracing slows the upgrade
+    down noticeably, so it should only be enabled when a profile is written. """
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def sum_counters(profiles: Sequence[DocumentProfile]) -> Counter:
+    total = Counter()  # type: Counter
+    for profile in profiles:
+        total.update(profile.counters)
+    return total
+
+
+def write_profile_report(profiles: Sequence[DocumentProfile], path: str) -> None:
+    """ Writes the profiles as JSON, or as CSV with one row per document and measured value,
+    if the path ends with ``.csv``. """
+    profiles = sorted(profiles, key=lambda profile: profile.document)
+    if path.endswith(".csv"):
+        with open(path, "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["document", "kind", "name", "seconds", "peak_memory_bytes", "count"])
+            for profile in profiles:
+                for name, seconds in profile.stage_seconds.items():
+                    writer.writerow([profile.document, "stage", name, "{0:.6f}".format(seconds),
+                                     profile.stage_peak_memory.get(name, ""), ""])
+                for name, hits in sorted(profile.rule_hits.items()):
+                    writer.writerow([profile.document, "rule", name, "", "", hits])
+                for name, count in sorted(profile.counters.items()):
+                    writer.writerow([profile.document, "counter", name, "", "", count])
+        return
+
+    stage_seconds = Counter()  # type: Counter
+    rule_hits = Counter()  # type: Counter
+    for profile in profiles:
+        stage_seconds.update(profile.stage_seconds)
+        rule_hits.update(profile.rule_hits)
+    report = {"totals": {"documents": len(profiles),
+                         "seconds": sum(stage_seconds.values()),
+                         "stage_seconds": dict(stage_seconds),
+                         "rule_hits": dict(rule_hits),
+                         "counters": dict(sum_counters(profiles)),
+                         },
+              "documents": [profile.to_dict() for profile in profiles],
+              }
+    with open(path, "w") as file:
+        json.dump(report, file, indent=4)
@@ -0,0 +1,159 @@
+import hashlib
+import importlib.util
+import os
+from collections import Counter
+from typing import Callable, Dict, FrozenSet, List, NamedTuple, Optional, Sequence, Tuple, Union
+from xml.etree.ElementTree import Element
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+# The upgrade scripts and the modules they use or share helpers with. A change of any of these may change
+# the upgraded files, so it invalidates everything that was converted before.
+CONVERTER_FILES = ("upgrade_v1.0_to_v2.0.py", "upgrade_v2.0_to_v2.1.py", "upgrade_v1.0_to_v2.1.py", "upgrade_rules.py",
+                   "upgrade_incremental.py", "upgrade_profiling.py", "mask_codec.py", "xml_writer.py",
+                   "annotation_reader.py", "corpus_cache.py")
+
+
+class RenameClasses(NamedTuple):
+    """ Gives all nodes of the classes in the mapping their new class name """
+    mapping: Dict[str, str]
+
+
+class SplitClasses(NamedTuple):
+    """ Lets ``split`` decide the new class of each node of the given classes from its context.
+    It is called with the node and the context of the upgrade and returns the node, or None to drop it. """
+    class_names: FrozenSet[str]
+    split: Callable
+
+
+class InsertNodes(NamedTuple):
+    """ Lets ``insert`` create an additional node for each node of the given classes. It is called like
+    ``SplitClasses.split`` and returns the new node, which is placed right before the node, or None. """
+    class_names: FrozenSet[str]
+    insert: Callable
+
+
+Rule = Union[RenameClasses, SplitClasses, InsertNodes]
+
+
+class ClassRules(NamedTuple):
+    """ Everything that happens to the nodes of a single class """
+    rename: Optional[str] = None
+    steps: Tuple[Union[SplitClasses, InsertNodes], ...] = ()
+    # Renames of upgrades that were fused into this one, applied to the classes the steps produce
+    renames_after_steps: Optional[Dict[str, str]] = None
+
+
+class RuleTable(object):
+    """ An upgrade expressed as a table of rules, which is compiled into a dispatch table from class name to
+    the rules of that class. Upgrading a node is a single lookup of its class, only the rules of that class run.
+    Renames are applied first, splits and insertions afterwards in the order of the table. """
+
+    def __init__(self, rules: Sequence[Rule]):
+        self.rules = list(rules)
+        self.renames = {}  # type: Dict[str, str]
+        steps = {}  # type: Dict[str, List[Union[SplitClasses, InsertNodes]]]
+        for rule in self.rules:
+            if isinstance(rule, RenameClasses):
+                self.renames = compose_renames(self.renames, rule.mapping)
+            else:
+                for class_name in rule.class_names:
+                    steps.setdefault(class_name, []).append(rule)
+        self.dispatch = {class_name: ClassRules(self.renames.get(class_name), tuple(steps.get(class_name, ())))
+                         for class_name in set(self.renames) | set(steps)}  # type: Dict[str, ClassRules]
+
+    def rules_for(self, class_name: str) -> Optional[ClassRules]:
+        return self.dispatch.get(class_name)
+
+    def rename(self, class_name: str) -> str:
+        class_rules = self.dispatch.get(class_name)
+        if class_rules is None or class_rules.rename is None:
+            return class_name
+        return class_rules.rename
+
+    def then(self, later_upgrade: "RuleTable") -> "RuleTable":
+        """ Fuses a later upgrade into this one, so chained upgrades, e.g., from v1.0 over v2.0 to v2.1, run in
+        a single pass. The later upgrade may only rename classes, because its splits would have to look at
+        the context of nodes in the upgraded document, which does not exist in a single pass. """
+        if any(not isinstance(rule, RenameClasses) for rule in later_upgrade.rules):
+            raise ValueError("Only upgrades that merely rename classes can be fused into a previous upgrade")
+        fused_upgrade = RuleTable(self.rules + later_upgrade.rules)
+        for class_name in set(self.dispatch) | set(later_upgrade.renames):
+            class_rules = self.dispatch.get(class_name, ClassRules())
+            if class_rules.steps:
+                renames_after_steps = compose_renames(class_rules.renames_after_steps or {}, later_upgrade.renames)
+                fused_upgrade.dispatch[class_name] = class_rules._replace(renames_after_steps=renames_after_steps)
+            else:
+                fused_upgrade.dispatch[class_name] = ClassRules(later_upgrade.rename(self.rename(class_name)))
+        return fused_upgrade
+
+
+def compose_renames(first: Dict[str, str], second: Dict[str, str]) -> Dict[str, str]:
+    """ Returns the renames of applying ``first`` and then ``second`` """
+    composed = {class_name: second.get(new_class_name, new_class_name) for class_name, new_class_name in first.items()}
+    for class_name, new_class_name in second.items():
+        composed.setdefault(class_name, new_class_name)
+    return composed
+
+
+def upgrade_element(node: Element, class_rules: Optional[ClassRules], *context,
+                    rule_hits: Optional[Counter] = None) -> List[Element]:
+    """ Applies the rules of its class to a node, whose class name is stored in its ``ClassName`` child.
+
+    :param context: Passed on to the splits and insertions, e.g., the original object and the document index.
+    :param rule_hits: Counts how often each rule was applied, the renames as ``rename`` and splits and
+        insertions by the name of their function.
+    :returns: The upgraded node and the inserted nodes, or nothing, if the node was dropped.
+    """
+    if class_rules is None:
+        return [node]
+    if rule_hits is not None and (class_rules.rename is not None or class_rules.renames_after_steps):
+        # A node is renamed at most once, even if a fused upgrade renames it before and after the steps
+        rule_hits["rename"] += 1
+    if class_rules.rename is not None:
+        node.find("ClassName").text = class_rules.rename
+
+    upgraded_nodes = []
+    for step in class_rules.steps:
+        if rule_hits is not None:
+            rule_hits[(step.split if isinstance(step, SplitClasses) else step.insert).__name__] += 1
+        if isinstance(step, SplitClasses):
+            node = step.split(node, *context)
+            if node is None:
+                break
+        else:
+            new_node = step.insert(node, *context)
+            if new_node is not None:
+                upgraded_nodes.append(new_node)
+    if node is not None:
+        upgraded_nodes.append(node)
+
+    if class_rules.renames_after_steps:
+        for upgraded_node in upgraded_nodes:
+            class_name = upgraded_node.find("ClassName")
+            class_name.text = class_rules.renames_after_steps.get(class_name.text, class_name.text)
+    return upgraded_nodes
+
+
+def load_script(path: str):
+    """ The upgrade scripts cannot be imported by name, because their file names contain dots. """
+    module_name = os.path.splitext(os.path.basename(path))[0].replace(".", "_")
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def compute_file_hash(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def compute_converter_hash() -> str:
+    """ Hashes all ``CONVERTER_FILES`` into a single version of the upgrade """
+    sha256 = hashlib.sha256()
+    for converter_file in CONVERTER_FILES:
+        sha256.update(compute_file_hash(os.path.join(SCRIPT_DIRECTORY, converter_file)).encode())
+    return sha256.hexdigest()
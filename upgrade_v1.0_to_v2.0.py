@@ -1,13 +1,19 @@
 import argparse
+import json
 import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from copy import deepcopy
 from xml.etree.ElementTree import parse, ElementTree, Element
-import xml.dom.minidom
 
 from muscima.cropobject import CropObject
-from muscima.io import parse_cropobject_list
 from tqdm import tqdm
-from typing import List, Dict, Union
+from typing import List, Dict, Union, Optional, Tuple
+
+from upgrade_profiling import DocumentProfile, start_memory_tracing, sum_counters, write_profile_report
+from upgrade_rules import (InsertNodes, RenameClasses, RuleTable, SplitClasses, compute_converter_hash,
+                           compute_file_hash, upgrade_element)
+from xml_writer import write_pretty_element_tree
 
 CLASS_NAME_MAPPING = {"notehead-full": "noteheadFull",
                       "grace-notehead-full": "noteheadFullSmall",
@@ -168,74 +174,114 @@ DYNAMICS_LETTER_NAME_MAPPING = {"letter_p": "dynamicLetterP",
                                 }
 
 
-def upgrade_xml_file(element_tree: ElementTree, crop_objects: List[CropObject], dataset: str,
-                     document: str) -> ElementTree:
-    nodes = Element("Nodes", attrib={'xmlns:xsi': "http://www.w3.org/2001/XMLSchema-instance",
-                                     "xsi:noNamespaceSchemaLocation": "CVC-MUSCIMA_Schema.xsd",
-                                     "dataset": dataset, "document": document})
 
-    id_to_cropobject_mapping = {o.objid: o for o in crop_objects}  # type: Dict[int, CropObject]
+# Objects that could not be upgraded regularly are counted in the profile of their document
+COUNTER_DESCRIPTIONS = {"skipped_unattached_flags": "flags were not attached to any notehead and thus could not be "
+                                                    "converted. They are not included in the output.",
+                        "fermatas_defaulted_to_above": "fermatas were not attached to anything and defaulted to "
+                                                       "fermataAbove.",
+                        }
 
-    crop_object_nodes = element_tree.findall("*/CropObject")
-    for crop_object_node in crop_object_nodes:
-        # Copy all values from an existing crop-object
-        node = deepcopy(crop_object_node)  # type: Element
-        id = int(node.find("Id").text)
-        crop_object = id_to_cropobject_mapping[id]
 
-        node = remove_node_id_attribute(node)
-        node = rename_CropObject_to_Node(node)
-        node = rename_MLClassName_to_ClassName(node)
-        node = map_class_to_new_name(node)
+class DocumentIndex(object):
+    """ Lookup tables over the crop objects and XML nodes of a single document. They are built once per
+    upgraded file, so resolving the links of a node does not require scanning the whole document.
 
-        if crop_object.clsname == "notehead-empty":
-            node = split_notehead_empty_into_notheadHalf_or_noteheadWhole(node, crop_object,
-                                                                          crop_objects)
+    Linked objects are returned in document order, exactly like ``CropObject.get_inlink_objects``
+    and ``CropObject.get_outlink_objects`` do. """
 
-        if crop_object.clsname == "fermata":
-            node = split_fermata_into_fermataAbove_or_fermataBelow(node, crop_object, crop_objects)
+    def __init__(self, crop_objects: List[CropObject], crop_object_nodes: List[Element]):
+        self.crop_objects = crop_objects
+        self.id_to_crop_object = {}  # type: Dict[int, CropObject]
+        self.id_to_position = {}  # type: Dict[int, int]
+        for position, crop_object in enumerate(crop_objects):
+            self.id_to_crop_object[crop_object.objid] = crop_object
+            self.id_to_position.setdefault(crop_object.objid, position)
+        self.id_to_node = {int(n.find("Id").text): n for n in crop_object_nodes}  # type: Dict[int, Element]
+        self.next_free_id = max(self.id_to_crop_object.keys(), default=-1) + 1
 
-        if "_flag" in crop_object.clsname:
-            node = split_flag_into_flagUp_or_flagDown(node, crop_object, crop_objects)
+    def get_inlink_objects(self, crop_object: CropObject) -> List[CropObject]:
+        return self.__resolve(crop_object.inlinks)
 
-        if "letter_" in crop_object.clsname:
-            new_node = introduce_dynamic_letters(node, crop_object, crop_objects, crop_object_nodes)
-            if new_node is not None:
-                nodes.append(new_node)
+    def get_outlink_objects(self, crop_object: CropObject) -> List[CropObject]:
+        return self.__resolve(crop_object.outlinks)
 
-        if node is not None:
-            nodes.append(node)
+    def add_crop_object(self, crop_object: CropObject) -> None:
+        self.id_to_position[crop_object.objid] = len(self.crop_objects)
+        self.id_to_crop_object[crop_object.objid] = crop_object
+        self.crop_objects.append(crop_object)
+        self.next_free_id = max(self.next_free_id, crop_object.objid + 1)
 
+    def __resolve(self, objids: List[int]) -> List[CropObject]:
+        positions = sorted(set(self.id_to_position[objid] for objid in objids if objid in self.id_to_position))
+        return [self.crop_objects[position] for position in positions]
+
+
+def upgrade_xml_file(element_tree: ElementTree, crop_objects: List[CropObject], dataset: str,
+                     document: str, rule_table: Optional[RuleTable] = None,
+                     profile: Optional[DocumentProfile] = None) -> ElementTree:
+    """ Upgrades every node in a single visit, running only the rules of its class.
+
+    :param rule_table: The rules to apply, by default ``UPGRADE_RULES``. Chained upgrades can pass
+        a table fused with ``RuleTable.then``.
+    :param profile: Receives the time spent in the stages of the upgrade, the rule hits and the counters
+        of objects that could not be upgraded regularly.
+    """
+    rule_table = rule_table or UPGRADE_RULES
+    profile = profile or DocumentProfile(document)
+    nodes = Element("Nodes", attrib=nodes_root_attributes(dataset, document))
+
+    with profile.stage("index"):
+        crop_object_nodes = element_tree.findall("*/CropObject")
+        index = DocumentIndex(crop_objects, crop_object_nodes)
+
+    for upgraded_nodes in upgrade_crop_object_nodes(crop_object_nodes, index, rule_table, profile):
+        nodes.extend(upgraded_nodes)
     return ElementTree(nodes)
 
 
-def rename_CropObject_to_Node(node):
-    node.tag = "Node"
-    return node
+def nodes_root_attributes(dataset: str, document: str) -> Dict[str, str]:
+    return {"dataset": dataset, "document": document,
+            'xmlns:xsi': "http://www.w3.org/2001/XMLSchema-instance",
+            "xsi:noNamespaceSchemaLocation": "CVC-MUSCIMA_Schema.xsd"}
+
 
+def upgrade_crop_object_nodes(crop_object_nodes: List[Element], index: DocumentIndex, rule_table: RuleTable,
+                              profile: DocumentProfile) -> List[List[Element]]:
+    """ Upgrades the given crop-object nodes in their order. The index has to contain the crop-objects of the
+    whole document, but only the nodes that are upgraded.
 
-def rename_MLClassName_to_ClassName(node):
-    """ Removes the leading ML prefix from MLClassName, in case it still exists """
+    :returns: The upgraded nodes for every crop-object node, which are none, if it was dropped.
+    """
+    upgraded_nodes = []
+    for crop_object_node in crop_object_nodes:
+        with profile.stage("copy"):
+            # Copy all values from an existing crop-object
+            node = convert_crop_object_to_node(deepcopy(crop_object_node))
+            crop_object = index.id_to_crop_object[int(node.find("Id").text)]
+        with profile.stage("rules"):
+            upgraded_nodes.append(upgrade_element(node, rule_table.rules_for(crop_object.clsname), crop_object,
+                                                  index, profile, rule_hits=profile.rule_hits))
+    return upgraded_nodes
+
+
+def convert_crop_object_to_node(node: Element) -> Element:
+    """ Renames the CropObject to a Node without its xml:id attribute and removes the leading ML prefix
+    from MLClassName, in case it still exists """
+    node.tag = "Node"
+    node.attrib.pop("{http://www.w3.org/XML/1998/namespace}id")
     for child in node:
         if child.tag == "MLClassName":
             child.tag = "ClassName"
     return node
 
 
-def map_class_to_new_name(node):
-    for child in node:
-        if child.tag == "ClassName":
-            if child.text in CLASS_NAME_MAPPING:
-                child.text = CLASS_NAME_MAPPING[child.text]
-    return node
-
-
 def split_notehead_empty_into_notheadHalf_or_noteheadWhole(node: Element,
                                                            notehead_empty: CropObject,
-                                                           crop_objects: List[
-                                                               CropObject]) -> Element:
+                                                           index: DocumentIndex,
+                                                           profile: DocumentProfile) -> Element:
     notehead_has_a_stem_attached = False
-    for outgoing_object in notehead_empty.get_outlink_objects(crop_objects):  # type: CropObject
+    for outgoing_object in index.get_outlink_objects(notehead_empty):  # type: CropObject
         if outgoing_object.clsname == "stem":
             notehead_has_a_stem_attached = True
 
@@ -246,12 +292,12 @@ def split_notehead_empty_into_notheadHalf_or_noteheadWhole(node: Element,
     return node
 
 
-def split_flag_into_flagUp_or_flagDown(node: Element, flag: CropObject,
-                                       crop_objects: List[CropObject]) -> Union[None, Element]:
+def split_flag_into_flagUp_or_flagDown(node: Element, flag: CropObject, index: DocumentIndex,
+                                       profile: DocumentProfile) -> Union[None, Element]:
     center_of_flag = flag.top + (flag.bottom - flag.top) / 2.0
 
     flag_converted_successfully = False
-    for incoming_object in flag.get_inlink_objects(crop_objects):  # type: CropObject
+    for incoming_object in index.get_inlink_objects(flag):  # type: CropObject
         if "notehead" in incoming_object.clsname:
             center_of_notehead = incoming_object.top + (
                     incoming_object.bottom - incoming_object.top) / 2.0
@@ -265,23 +311,21 @@ def split_flag_into_flagUp_or_flagDown(node: Element, flag: CropObject,
                 break
 
     if not flag_converted_successfully:
-        print("Found a flag that is not attached to any notehead and thus could not be converted. "
-              "Skipping object {0} (will not be included in the output).".format(flag.uid))
+        profile.count("skipped_unattached_flags", flag.uid)
         return None
     return node
 
 
-def split_fermata_into_fermataAbove_or_fermataBelow(node: Element, fermata: CropObject,
-                                                    crop_objects: List[CropObject]) -> Union[
-    None, Element]:
+def split_fermata_into_fermataAbove_or_fermataBelow(node: Element, fermata: CropObject, index: DocumentIndex,
+                                                    profile: DocumentProfile) -> Union[None, Element]:
     center_of_fermata = fermata.top + (fermata.bottom - fermata.top) / 2.0
+    inlink_objects = index.get_inlink_objects(fermata)  # type: List[CropObject]
 
-    if len(fermata.get_inlink_objects(crop_objects)) == 0:
-        print("Found a fermata that is not attached to anything. "
-              "Defaulting to fermataAbove. {0} ".format(fermata.uid))
+    if len(inlink_objects) == 0:
+        profile.count("fermatas_defaulted_to_above", fermata.uid)
         node.find("ClassName").text = "fermataAbove"
 
-    for incoming_object in fermata.get_inlink_objects(crop_objects):  # type: CropObject
+    for incoming_object in inlink_objects:  # type: CropObject
         center_of_incoming_object = incoming_object.top + (
                 incoming_object.bottom - incoming_object.top) / 2.0
         if center_of_fermata < center_of_incoming_object:
@@ -293,12 +337,12 @@ def split_fermata_into_fermataAbove_or_fermataBelow(node: Element, fermata: Crop
     return node
 
 
-def introduce_dynamic_letters(node: Element, letter: CropObject, crop_objects: List[CropObject],
-                              crop_object_nodes: List[Element]) -> Union[None, Element]:
+def introduce_dynamic_letters(node: Element, letter: CropObject, index: DocumentIndex,
+                              profile: DocumentProfile) -> Union[None, Element]:
     if letter.clsname not in DYNAMICS_LETTER_NAME_MAPPING.keys():
         return None
 
-    inlink_objects = letter.get_inlink_objects(crop_objects)  # type: List[CropObject]
+    inlink_objects = index.get_inlink_objects(letter)  # type: List[CropObject]
     letter_has_no_incoming_connection = len(inlink_objects) < 1
     if letter_has_no_incoming_connection:
         return None
@@ -313,34 +357,98 @@ def introduce_dynamic_letters(node: Element, letter: CropObject, crop_objects: L
     dynamics_letter.clsname = new_class_name
     new_node.find("ClassName").text = new_class_name
 
-    objids = [c.objid for c in crop_objects]
-    new_id = max(objids) + 1
+    new_id = index.next_free_id
     dynamics_letter.objid = new_id
     new_node.find("Id").text = str(new_id)
 
     inlink_objects[0].outlinks.append(new_id)
-    inlink_node = \
-        [n for n in crop_object_nodes if n.find("Id").text == str(inlink_objects[0].objid)][0]
+    inlink_node = index.id_to_node[inlink_objects[0].objid]
     inlink_node.find("Outlinks").text += " {0}".format(new_id)
-    crop_objects.append(dynamics_letter)
+    index.add_crop_object(dynamics_letter)
 
     return new_node
 
 
-def remove_node_id_attribute(node):
-    node.attrib.pop("{http://www.w3.org/XML/1998/namespace}id")
-    return node
-
-
-def prettify_xml_file(path):
-    dom = xml.dom.minidom.parse(path)
-    pretty_xml_as_string = dom.toprettyxml(indent="    ", newl="\n")
-    pretty_xml_as_string = '\n'.join(
-        list(filter(lambda x: len(x.strip()), pretty_xml_as_string.split('\n'))))
-    pretty_xml_as_string = pretty_xml_as_string.replace('version="1.0" ?>',
-                                                        'version="1.0" encoding="utf-8"?>')
-    with open(path, "w") as file:
-        file.write(pretty_xml_as_string)
+UPGRADE_RULES = RuleTable([
+    RenameClasses(CLASS_NAME_MAPPING),
+    SplitClasses(frozenset(["notehead-empty"]), split_notehead_empty_into_notheadHalf_or_noteheadWhole),
+    SplitClasses(frozenset(["fermata"]), split_fermata_into_fermataAbove_or_fermataBelow),
+    SplitClasses(frozenset(UPWARDS_FLAG_NAME_MAPPING), split_flag_into_flagUp_or_flagDown),
+    InsertNodes(frozenset(DYNAMICS_LETTER_NAME_MAPPING), introduce_dynamic_letters),
+])
+
+
+def read_crop_objects(element_tree: ElementTree) -> List[CropObject]:
+    """ Creates the CropObjects from an already parsed tree. Masks are not decoded, because the upgrade
+    copies them verbatim from the XML nodes anyway. """
+    return [read_crop_object(crop_object_node) for crop_object_node in element_tree.findall("*/CropObject")]
+
+
+def read_crop_object(crop_object_node: Element) -> CropObject:
+    inlinks_text = crop_object_node.findtext("Inlinks")
+    outlinks_text = crop_object_node.findtext("Outlinks")
+    return CropObject(objid=int(float(crop_object_node.find("Id").text)),
+                      clsname=crop_object_node.findtext("MLClassName", crop_object_node.findtext("ClassName")),
+                      top=int(crop_object_node.find("Top").text),
+                      left=int(crop_object_node.find("Left").text),
+                      width=int(crop_object_node.find("Width").text),
+                      height=int(crop_object_node.find("Height").text),
+                      outlinks=list(map(int, outlinks_text.split())) if outlinks_text else [],
+                      inlinks=list(map(int, inlinks_text.split())) if inlinks_text else [],
+                      uid=crop_object_node.get("{http://www.w3.org/XML/1998/namespace}id"))
+
+
+def convert_annotation_file(source_file_path: str, destination_file_path: str, dataset: str) -> DocumentProfile:
+    document = os.path.splitext(os.path.basename(source_file_path))[0]
+    profile = DocumentProfile(document)
+    with profile.stage("parse"):
+        tree = parse(source_file_path)
+    with profile.stage("read_crop_objects"):
+        crop_objects = read_crop_objects(tree)
+    upgraded_tree = upgrade_xml_file(tree, crop_objects, dataset, document, profile=profile)
+
+    with profile.stage("write"):
+        write_pretty_element_tree(destination_file_path, upgraded_tree.getroot())
+    return profile
+
+
+def load_manifest(path: str, converter_hash: str) -> Dict[str, str]:
+    """ Returns the source hashes of the files that were converted by the same version of the converter,
+    or an empty dictionary if there is no manifest yet or any of the ``CONVERTER_FILES`` has changed since. """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        manifest = json.load(file)
+    if manifest.get("converter") != converter_hash:
+        return {}
+    return manifest.get("files", {})
+
+
+def save_manifest(path: str, converter_hash: str, file_hashes: Dict[str, str]) -> None:
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w") as file:
+        json.dump({"converter": converter_hash, "files": file_hashes}, file, indent=4, sort_keys=True)
+    os.replace(temporary_path, path)
+
+
+def convert_annotation_file_safely(source_file_path: str, destination_file_path: str, dataset: str,
+                                   profile_memory: bool = False) -> Tuple[str, Optional[DocumentProfile],
+                                                                          Optional[str]]:
+    """ Converts a single file and returns its source hash and profile together with the error message,
+    if the conversion failed, so one broken file does not stop the whole batch. """
+    if profile_memory:
+        start_memory_tracing()
+    source_hash = compute_file_hash(source_file_path)
+    try:
+        profile = convert_annotation_file(source_file_path, destination_file_path, dataset)
+    except Exception as exception:
+        return source_hash, None, "{0}: {1}".format(type(exception).__name__, exception)
+    return source_hash, profile, None
+
+
+def print_counters(profiles: List[DocumentProfile], counter_descriptions: Dict[str, str]) -> None:
+    for counter, count in sorted(sum_counters(profiles).items()):
+        print("{0} {1}".format(count, counter_descriptions.get(counter, counter)))
 
 
 if __name__ == "__main__":
@@ -349,6 +457,17 @@ if __name__ == "__main__":
                         help='Directory of the MUSCIMA++ dataset v1.0')
     parser.add_argument("--destination_directory", type=str, default="v2.0",
                         help="Directory, where the upgraded MUSCIMA++ v2.0 dataset should be written to.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Number of processes that convert files in parallel.")
+    parser.add_argument("--force", action="store_true",
+                        help="Convert all files, even if their source did not change since the last run.")
+    parser.add_argument("--profile-out", dest="profile_out", type=str, default=None,
+                        help="File, where the time of every stage, the rule hits and the counters "
+                             "of skipped or defaulted objects are written to for every converted document. "
+                             "Written as CSV, if the file name ends with .csv, otherwise as JSON.")
+    parser.add_argument("--profile-memory", dest="profile_memory", action="store_true",
+                        help="Also measure the peak memory of every stage for the profile. Tracing the memory "
+                             "slows the conversion down several times, which distorts the measured times.")
 
     flags = parser.parse_args()
 
@@ -356,18 +475,48 @@ if __name__ == "__main__":
     destination_directory = flags.destination_directory
 
     directory_mapping = {"data/cropobjects_withstaff": "data/annotations"}
+    converter_hash = compute_converter_hash()
+    failed_files = {}  # type: Dict[str, str]
+    profiles = []  # type: List[DocumentProfile]
 
     for source_subdirectory, destination_subdirectory in directory_mapping.items():
         source = os.path.join(source_directory, source_subdirectory)
         destination = os.path.join(destination_directory, destination_subdirectory)
-
-        for annotation_file in tqdm(os.listdir(source), "Converting annotations"):
-            annotation_file_path = os.path.join(source, annotation_file)
-            crop_objects = parse_cropobject_list(annotation_file_path)
-            tree = parse(annotation_file_path)
-            document = os.path.splitext(annotation_file)[0]
-            upgraded_tree = upgrade_xml_file(tree, crop_objects, "MUSCIMA-pp_2.0", document)
-
-            upgraded_tree.write(os.path.join(destination, annotation_file), encoding="utf-8",
-                                xml_declaration=True)
-            prettify_xml_file(os.path.join(destination, annotation_file))
+        os.makedirs(destination, exist_ok=True)
+
+        # Kept outside of the annotations, which are the input of the upgrade to v2.1
+        manifest_path = os.path.join(destination_directory, ".upgrade_manifest.json")
+        file_hashes = {} if flags.force else load_manifest(manifest_path, converter_hash)
+
+        annotation_files = []
+        for annotation_file in sorted(os.listdir(source)):
+            up_to_date = file_hashes.get(annotation_file) == compute_file_hash(os.path.join(source, annotation_file))
+            if not up_to_date or not os.path.exists(os.path.join(destination, annotation_file)):
+                file_hashes.pop(annotation_file, None)
+                annotation_files.append(annotation_file)
+
+        with ProcessPoolExecutor(max_workers=max(1, flags.workers)) as executor:
+            futures = {executor.submit(convert_annotation_file_safely, os.path.join(source, annotation_file),
+                                       os.path.join(destination, annotation_file),
+                                       "MUSCIMA-pp_2.0", flags.profile_memory): annotation_file
+                       for annotation_file in annotation_files}
+            for future in tqdm(as_completed(futures), "Converting annotations", total=len(futures)):
+                annotation_file = futures[future]
+                source_hash, profile, error = future.result()
+                if error is None:
+                    profiles.append(profile)
+                    file_hashes[annotation_file] = source_hash
+                    save_manifest(manifest_path, converter_hash, file_hashes)
+                else:
+                    failed_files[os.path.join(source, annotation_file)] = error
+
+        save_manifest(manifest_path, converter_hash, file_hashes)
+
+    print_counters(profiles, COUNTER_DESCRIPTIONS)
+    if flags.profile_out is not None:
+        write_profile_report(profiles, flags.profile_out)
+
+    for annotation_file_path, error in sorted(failed_files.items()):
+        print("Error while converting {0}. Skipping file. {1}".format(annotation_file_path, error))
+    if failed_files:
+        sys.exit(1)
@@ -0,0 +1,113 @@
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Optional, Tuple
+from xml.etree.ElementTree import Element, parse
+
+from mung.node import Node
+from tqdm import tqdm
+
+from annotation_reader import parse_data_item, parse_links
+from mask_codec import canonicalize_masks
+from upgrade_profiling import DocumentProfile, start_memory_tracing, write_profile_report
+from upgrade_rules import load_script
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+upgrade_to_v2_0 = load_script(os.path.join(SCRIPT_DIRECTORY, "upgrade_v1.0_to_v2.0.py"))
+upgrade_to_v2_1 = load_script(os.path.join(SCRIPT_DIRECTORY, "upgrade_v2.0_to_v2.1.py"))
+UPGRADE_RULES = upgrade_to_v2_0.UPGRADE_RULES.then(upgrade_to_v2_1.UPGRADE_RULES)
+
+
+def element_to_node(element: Element, dataset: str, document: str) -> Node:
+    """ Creates the node that ``mung.io.read_nodes_from_file`` would read from the element, except for
+    the mask, which is not decoded """
+    data = element.find("Data")
+    if data is not None:
+        data = {item.get("key"): parse_data_item(item.get("type"), item.text) for item in data.iterfind("DataItem")}
+    return Node(int(float(element.findtext("Id"))), element.findtext("ClassName"), int(element.findtext("Top")),
+                int(element.findtext("Left")), int(element.findtext("Width")), int(element.findtext("Height")),
+                parse_links(element.findtext("Outlinks")), parse_links(element.findtext("Inlinks")), None,
+                dataset, document, data)
+
+
+def convert_annotation_file(source_file_path: str, destination_file_path: str, dataset: str) -> DocumentProfile:
+    """ Upgrades a v1.0 file to v2.1 in a single pass over its nodes, producing the same file as upgrading
+    it to v2.0 and the v2.0 file to v2.1 """
+    document = os.path.splitext(os.path.basename(source_file_path))[0]
+    profile = DocumentProfile(document)
+    with profile.stage("parse"):
+        tree = parse(source_file_path)
+    with profile.stage("read_crop_objects"):
+        crop_objects = upgrade_to_v2_0.read_crop_objects(tree)
+    upgraded_elements = list(upgrade_to_v2_0.upgrade_xml_file(tree, crop_objects, dataset, document,
+                                                              UPGRADE_RULES, profile).getroot())
+
+    with profile.stage("convert_to_nodes"):
+        nodes = [element_to_node(element, dataset, document) for element in upgraded_elements]
+    with profile.stage("encode_masks"):
+        mask_strings = canonicalize_masks([element.findtext("Mask") for element in upgraded_elements],
+                                          [(node.height, node.width) for node in nodes])
+    with profile.stage("write"):
+        upgrade_to_v2_1.write_nodes_to_pretty_xml_file(nodes, destination_file_path, document, dataset,
+                                                       mask_strings)
+    return profile
+
+
+def convert_annotation_file_safely(source_file_path: str, destination_file_path: str, dataset: str,
+                                   profile_memory: bool = False) -> Tuple[Optional[DocumentProfile], Optional[str]]:
+    if profile_memory:
+        start_memory_tracing()
+    try:
+        profile = convert_annotation_file(source_file_path, destination_file_path, dataset)
+    except Exception as exception:
+        return None, "{0}: {1}".format(type(exception).__name__, exception)
+    return profile, None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Converts MUSCIMA++ v1.0 directly to MUSCIMA++ v2.1, '
+                                                 'without writing the intermediate v2.0 files')
+    parser.add_argument('--source_directory', type=str, default="v1.0",
+                        help='Directory of the MUSCIMA++ dataset v1.0')
+    parser.add_argument("--destination_directory", type=str, default="v2.1",
+                        help="Directory, where the upgraded MUSCIMA++ v2.1 dataset should be written to.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Number of processes that convert files in parallel.")
+    parser.add_argument("--profile-out", dest="profile_out", type=str, default=None,
+                        help="File, where the time of every stage, the rule hits and the counters "
+                             "of skipped or defaulted objects are written to for every converted document. "
+                             "Written as CSV, if the file name ends with .csv, otherwise as JSON.")
+    parser.add_argument("--profile-memory", dest="profile_memory", action="store_true",
+                        help="Also measure the peak memory of every stage for the profile. Tracing the memory "
+                             "slows the conversion down several times, which distorts the measured times.")
+
+    flags = parser.parse_args()
+
+    source = os.path.join(flags.source_directory, "data/cropobjects_withstaff")
+    destination = os.path.join(flags.destination_directory, "data/annotations")
+    os.makedirs(destination, exist_ok=True)
+    failed_files = {}  # type: Dict[str, str]
+    profiles = []  # type: List[DocumentProfile]
+
+    annotation_files = sorted(os.listdir(source))  # type: List[str]
+    with ProcessPoolExecutor(max_workers=max(1, flags.workers)) as executor:
+        futures = {executor.submit(convert_annotation_file_safely, os.path.join(source, annotation_file),
+                                   os.path.join(destination, annotation_file), "MUSCIMA-pp_2.1",
+                                   flags.profile_memory): annotation_file
+                   for annotation_file in annotation_files}
+        for future in tqdm(as_completed(futures), "Converting annotations", total=len(futures)):
+            profile, error = future.result()
+            if error is None:
+                profiles.append(profile)
+            else:
+                failed_files[os.path.join(source, futures[future])] = error
+
+    upgrade_to_v2_0.print_counters(profiles, upgrade_to_v2_0.COUNTER_DESCRIPTIONS)
+    if flags.profile_out is not None:
+        write_profile_report(profiles, flags.profile_out)
+
+    for annotation_file_path, error in sorted(failed_files.items()):
+        print("Error while converting {0}. Skipping file. {1}".format(annotation_file_path, error))
+    if failed_files:
+        sys.exit(1)
@@ -1,39 +1,89 @@
 import argparse
 import os
-from typing import List
+from typing import List, Optional
+from xml.etree.ElementTree import Element, SubElement, fromstring
 
-import xml.dom.minidom
-from mung.io import read_nodes_from_file, write_nodes_to_file
 from mung.node import Node
 from tqdm import tqdm
 
+from annotation_reader import iterate_nodes, read_root_attributes
+from mask_codec import encode_masks
+from upgrade_profiling import DocumentProfile, start_memory_tracing, write_profile_report
+from upgrade_rules import RenameClasses, RuleTable
+from xml_writer import write_pretty_xml_file
+
 CLASS_NAME_MAPPING = {"cClef": "clefC",
                       "fClef": "clefF",
                       "gClef": "clefG",
                       "multiMeasureRest": "restHBar",
                       }
 
+UPGRADE_RULES = RuleTable([RenameClasses(CLASS_NAME_MAPPING)])
+
+
+def read_nodes(path: str) -> List[Node]:
+    attributes = read_root_attributes(path)
+    dataset, document = attributes.get("dataset", "Unknown"), attributes.get("document", "Unknown")
+    return [Node(record.id, record.class_name, record.top, record.left, record.width, record.height, record.outlinks,
+                 record.inlinks, record.mask, dataset, document, record.data) for record in iterate_nodes(path)]
 
-def upgrade_xml_file(nodes: List[Node]) -> List[Node]:
+
+def upgrade_xml_file(nodes: List[Node], profile: Optional[DocumentProfile] = None) -> List[Node]:
     new_nodes = []
     for node in nodes:
-        new_class_name = node.class_name
-        if node.class_name in CLASS_NAME_MAPPING:
-            new_class_name = CLASS_NAME_MAPPING[node.class_name]
-        new_node = Node(node.id, new_class_name, node.top, node.left, node.width, node.height, node.outlinks,
+        if profile is not None and UPGRADE_RULES.rules_for(node.class_name) is not None:
+            profile.rule_hits["rename"] += 1
+        new_node = Node(node.id, UPGRADE_RULES.rename(node.class_name), node.top, node.left, node.width, node.height, node.outlinks,
                         node.inlinks, node.mask, node.dataset, node.document, node.data)
         new_nodes.append(new_node)
     return new_nodes
 
 
-def prettify_xml_file(path):
-    dom = xml.dom.minidom.parse(path)
-    pretty_xml_as_string = dom.toprettyxml(indent="    ", newl="\n")
-    pretty_xml_as_string = '\n'.join(list(filter(lambda x: len(x.strip()), pretty_xml_as_string.split('\n'))))
-    pretty_xml_as_string = pretty_xml_as_string.replace('version="1.0" ?>',
-                                                        'version="1.0" encoding="utf-8"?>')
-    with open(path, "w") as file:
-        file.write(pretty_xml_as_string)
+def node_to_element(node: Node, mask_string: str) -> Element:
+    """ Creates the same XML element that ``mung.io.write_nodes_to_file`` writes for the node,
+    given its already encoded mask """
+    element = Element("Node")
+    SubElement(element, "Id").text = str(node.id)
+    SubElement(element, "ClassName").text = node.class_name
+    SubElement(element, "Top").text = str(node.top)
+    SubElement(element, "Left").text = str(node.left)
+    SubElement(element, "Width").text = str(node.width)
+    SubElement(element, "Height").text = str(node.height)
+    SubElement(element, "Mask").text = mask_string
+    if len(node.inlinks) > 0:
+        SubElement(element, "Inlinks").text = " ".join(map(str, node.inlinks))
+    if len(node.outlinks) > 0:
+        SubElement(element, "Outlinks").text = " ".join(map(str, node.outlinks))
+    data_string = node.encode_data()
+    if data_string is not None:
+        element.append(fromstring("<Data>{0}</Data>".format(data_string)))
+    return element
+
+
+def write_nodes_to_pretty_xml_file(nodes: List[Node], path: str, document: str, dataset: str,
+                                   mask_strings: Optional[List[str]] = None) -> None:
+    """ :param mask_strings: The already encoded masks of the nodes, by default their masks are encoded """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if mask_strings is None:
+        mask_strings = encode_masks([node.mask for node in nodes])
+    write_pretty_xml_file(path, "Nodes", {"dataset": dataset, "document": document,
+                                          "xmlns:xsi": "http://www.w3.org/2001/XMLSchema-instance",
+                                          "xsi:noNamespaceSchemaLocation": "CVC-MUSCIMA_Schema.xsd"},
+                          (node_to_element(node, mask_string) for node, mask_string in zip(nodes, mask_strings)))
+
+
+def convert_annotation_file(annotation_file_path: str, output_file_path: str, document: str) -> DocumentProfile:
+    profile = DocumentProfile(document)
+    with profile.stage("read"):
+        nodes = read_nodes(annotation_file_path)
+    with profile.stage("upgrade"):
+        upgraded_nodes = upgrade_xml_file(nodes, profile)
+    with profile.stage("encode_masks"):
+        mask_strings = encode_masks([node.mask for node in upgraded_nodes])
+    with profile.stage("write"):
+        write_nodes_to_pretty_xml_file(upgraded_nodes, output_file_path, document=document, dataset="MUSCIMA-pp_2.1",
+                                       mask_strings=mask_strings)
+    return profile
 
 
 if __name__ == "__main__":
@@ -42,6 +92,13 @@ if __name__ == "__main__":
                         help='Directory of the MUSCIMA++ dataset v2.0')
     parser.add_argument("--destination_directory", type=str, default="v2.1",
                         help="Directory, where the upgraded MUSCIMA++ v2.1 dataset should be written to.")
+    parser.add_argument("--profile-out", dest="profile_out", type=str, default=None,
+                        help="File, where the time of every stage and the rule hits are written "
+                             "to for every converted document. Written as CSV, if the file name ends with .csv, "
+                             "otherwise as JSON.")
+    parser.add_argument("--profile-memory", dest="profile_memory", action="store_true",
+                        help="Also measure the peak memory of every stage for the profile. Tracing the memory "
+                             "slows the conversion down several times, which distorts the measured times.")
 
     flags = parser.parse_args()
     source_directory = flags.source_directory
@@ -49,15 +106,19 @@ if __name__ == "__main__":
 
     source = os.path.join(source_directory, "data/annotations")
     destination = os.path.join(destination_directory, "data/annotations")
+    profiles = []  # type: List[DocumentProfile]
+    if flags.profile_memory:
+        start_memory_tracing()
 
-    for annotation_file in tqdm(os.listdir(source), "Converting annotations"):
+    annotation_files = sorted(f for f in os.listdir(source) if f.endswith(".xml"))
+    for annotation_file in tqdm(annotation_files, "Converting annotations"):
         try:
             annotation_file_path = os.path.join(source, annotation_file)
             output_file_path = os.path.join(destination, annotation_file)
             document = os.path.splitext(annotation_file)[0]
-            nodes = read_nodes_from_file(annotation_file_path)
-            upgraded_nodes = upgrade_xml_file(nodes)
-            write_nodes_to_file(upgraded_nodes, output_file_path, document=document, dataset="MUSCIMA-pp_2.1")
-            prettify_xml_file(output_file_path)
+            profiles.append(convert_annotation_file(annotation_file_path, output_file_path, document))
         except:
             print("Error while reading {0}. Skipping file".format(annotation_file))
+
+    if flags.profile_out is not None:
+        write_profile_report(profiles, flags.profile_out)
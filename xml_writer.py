@@ -0,0 +1,151 @@
+import argparse
+import os
+import tempfile
+from typing import Dict, Iterable, List, Optional
+from xml.etree.ElementTree import Element, parse
+
+XML_DECLARATION = '<?xml version="1.0" encoding="utf-8"?>'
+INDENT = "    "
+NAMESPACE_PREFIXES = {"http://www.w3.org/XML/1998/namespace": "xml",
+                      "http://www.w3.org/2001/XMLSchema-instance": "xsi",
+                      }
+NAMESPACES = {prefix: namespace for namespace, prefix in NAMESPACE_PREFIXES.items()}
+
+
+def escape(text: str) -> str:
+    """ Escapes text and attribute values the same way as ``xml.dom.minidom`` does """
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace("\"", "&quot;").replace(">", "&gt;")
+
+
+def qualified_name(name: str) -> str:
+    """ Turns names of parsed elements and attributes, such as ``{http://www.w3.org/2001/XMLSchema-instance}type``,
+    back into their prefixed form ``xsi:type``. """
+    if not name.startswith("{"):
+        return name
+    namespace, local_name = name[1:].split("}", 1)
+    return "{0}:{1}".format(NAMESPACE_PREFIXES[namespace], local_name)
+
+
+def start_tag(element: Element, declare_namespaces: bool = False) -> str:
+    """ If ``declare_namespaces`` is set, the namespaces used by the attributes are declared right before
+    the first attribute that uses them, unless the element declares them explicitly already. """
+    attributes = []
+    declared_prefixes = {"xml"}
+    for name, value in element.attrib.items():
+        name = qualified_name(name)
+        prefix = name.split(":", 1)[0]
+        if declare_namespaces and prefix in NAMESPACES and prefix not in declared_prefixes \
+                and "xmlns:" + prefix not in element.attrib:
+            attributes.append(' xmlns:{0}="{1}"'.format(prefix, escape(NAMESPACES[prefix])))
+            declared_prefixes.add(prefix)
+        attributes.append(' {0}="{1}"'.format(name, escape(value)))
+    return "<{0}{1}".format(qualified_name(element.tag), "".join(attributes))
+
+
+def serialize_element(element: Element, indent: str, parts: List[str]) -> None:
+    """ Serializes an element like ``Element.writexml`` from ``xml.dom.minidom`` does, when being called
+    through ``toprettyxml``: elements with only text inside are written on a single line,
+    all other children are written on lines of their own with one more level of indentation. """
+    children = list(element)
+    if not children and not element.text:
+        parts.append("{0}{1}/>\n".format(indent, start_tag(element)))
+    elif not children:
+        parts.append("{0}{1}>{2}</{3}>\n".format(indent, start_tag(element), escape(element.text),
+                                                   qualified_name(element.tag)))
+    else:
+        parts.append("{0}{1}>\n".format(indent, start_tag(element)))
+        if element.text:
+            parts.append("{0}{1}\n".format(indent + INDENT, escape(element.text)))
+        for child in children:
+            serialize_element(child, indent + INDENT, parts)
+            if child.tail:
+                parts.append("{0}{1}\n".format(indent + INDENT, escape(child.tail)))
+        parts.append("{0}</{1}>\n".format(indent, qualified_name(element.tag)))
+
+
+def remove_blank_lines(text: str) -> List[str]:
+    return [line for line in text.split("\n") if len(line.strip())]
+
+
+def serialize_child(element: Element) -> str:
+    """ Serializes a child of the root element exactly like ``write_pretty_xml_file`` writes it into the file """
+    parts = []  # type: List[str]
+    serialize_element(element, INDENT, parts)
+    if element.tail:
+        parts.append("{0}{1}\n".format(INDENT, escape(element.tail)))
+    return "".join(line + "\n" for line in remove_blank_lines("".join(parts)))
+
+
+def write_pretty_xml_file(path: str, root_tag: str, root_attributes: Dict[str, str],
+                          elements: Iterable[Element]) -> None:
+    """ Writes the elements as children of a root element into the file in a single pass, one element
+    at a time. The output is byte-identical to writing the same tree with ``ElementTree.write``
+    and pretty-printing the written file with ``xml.dom.minidom`` (``toprettyxml`` with four spaces
+    of indentation, blank lines removed and the encoding added to the XML declaration). """
+    write_pretty_xml_chunks(path, root_tag, root_attributes, (serialize_child(element) for element in elements))
+
+
+def write_pretty_xml_chunks(path: str, root_tag: str, root_attributes: Dict[str, str],
+                            chunks: Iterable[str]) -> None:
+    """ Like ``write_pretty_xml_file``, but takes the children already serialized with ``serialize_child`` """
+    root = Element(root_tag, attrib=root_attributes)
+    with open(path, "w", encoding="utf-8") as file:
+        file.write(XML_DECLARATION)
+        file.write("\n")
+        has_children = False
+        for chunk in chunks:
+            if not has_children:
+                file.write(start_tag(root, declare_namespaces=True) + ">\n")
+                has_children = True
+            file.write(chunk)
+        if has_children:
+            file.write("</{0}>".format(qualified_name(root_tag)))
+        else:
+            file.write(start_tag(root, declare_namespaces=True) + "/>")
+
+
+def write_pretty_element_tree(path: str, root: Element) -> None:
+    write_pretty_xml_file(path, root.tag, root.attrib, iter(root))
+
+
+def verify_file(path: str, temporary_path: str) -> Optional[str]:
+    """ Parses a prettified file, writes it back through the streaming writer and returns a description
+    of the first difference to the original file, or None if both are byte-identical. """
+    write_pretty_element_tree(temporary_path, parse(path).getroot())
+    with open(temporary_path, "rb") as file:
+        streamed = file.read()
+    with open(path, "rb") as file:
+        golden = file.read()
+
+    if streamed == golden:
+        return None
+    for line_number, (streamed_line, golden_line) in enumerate(zip(streamed.split(b"\n"), golden.split(b"\n"))):
+        if streamed_line != golden_line:
+            return "line {0}: {1!r} != {2!r}".format(line_number + 1, streamed_line[:80], golden_line[:80])
+    return "lengths differ: {0} != {1} bytes".format(len(streamed), len(golden))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Verifies that the streaming XML writer reproduces prettified '
+                                                 'annotation files byte by byte')
+    parser.add_argument('directories', type=str, nargs="+",
+                        help='Directories with prettified annotation files, e.g., v2.0/data/annotations')
+
+    flags = parser.parse_args()
+
+    file_descriptor, temporary_file = tempfile.mkstemp(suffix=".xml")
+    os.close(file_descriptor)
+    number_of_differences = 0
+    for directory in flags.directories:
+        for annotation_file in sorted(os.listdir(directory)):
+            if not annotation_file.endswith(".xml"):
+                continue
+            difference = verify_file(os.path.join(directory, annotation_file), temporary_file)
+            if difference is not None:
+                number_of_differences += 1
+                print("{0} differs, {1}".format(os.path.join(directory, annotation_file), difference))
+    os.remove(temporary_file)
+
+    if number_of_differences > 0:
+        raise SystemExit("{0} files differ".format(number_of_differences))
+    print("All files are identical")